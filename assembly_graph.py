@@ -0,0 +1,417 @@
+"""
+compact array backed representation of a disassembly graph
+"""
+from array import array
+from collections import Counter
+from grammar import Node, part_types
+
+try:
+	import numpy as np
+except ImportError: # level and reachability sweeps fall back to plain python
+	np = None
+
+
+"""
+Read-only handle onto one node of an AssemblyGraph. Exposes the same
+attributes as grammar.Node so that traversal and program building code
+such as greedy_order and build_program work unchanged on it.
+Views are created on demand and compare equal when they refer to the
+same node of the same graph.
+"""
+class NodeView:
+	__slots__ = ("graph", "index")
+
+	def __init__(self, graph, index):
+		self.graph = graph
+		self.index = index
+
+	@property
+	def ID(self):
+		return self.graph.ids[self.index]
+
+	@property
+	def children(self):
+		graph = self.graph
+		start = graph.child_offsets[self.index]
+		end = graph.child_offsets[self.index + 1]
+		return [NodeView(graph, i) for i in graph.child_indices[start:end]]
+
+	@property
+	def parents(self):
+		graph = self.graph
+		start = graph.parent_offsets[self.index]
+		end = graph.parent_offsets[self.index + 1]
+		return [NodeView(graph, i) for i in graph.parent_indices[start:end]]
+
+	@property
+	def is_fastener(self):
+		return bool(self.graph.is_fastener[self.index])
+
+	@property
+	def part_type_code(self):
+		return self.graph.part_type_codes[self.index]
+
+	@property
+	def part_type(self):
+		return part_types.names[self.graph.part_type_codes[self.index]]
+
+	@property
+	def is_unique(self):
+		return bool(self.graph.is_unique[self.index])
+
+	@property
+	def instance_count(self):
+		count = self.graph.instance_counts[self.index]
+		return None if count == 0 else count
+
+	@instance_count.setter
+	def instance_count(self, count):
+		self.graph.instance_counts[self.index] = 0 if count is None else count
+		self.graph.phrases[self.index] = None
+
+	@property
+	def phrase(self):
+		return self.graph.phrases[self.index]
+
+	@phrase.setter
+	def phrase(self, phrase):
+		self.graph.phrases[self.index] = phrase
+
+	def __eq__(self, other):
+		return isinstance(other, NodeView) and self.graph is other.graph and self.index == other.index
+
+	def __hash__(self):
+		return hash((id(self.graph), self.index))
+
+	def __str__(self):
+		return f"id {self.ID} {self.part_type}"
+
+
+"""
+Disassembly graph with node IDs renumbered to dense indices 0..n-1 and
+all adjacency kept in flat CSR style buffers: the children of node i
+are child_indices[child_offsets[i]:child_offsets[i+1]], and likewise
+for parents and fastener contact lists. Part types are stored as
+their codes in the shared grammar.part_types table.
+ids maps a dense index back to the original node ID.
+"""
+class AssemblyGraph:
+	__slots__ = ("ids", "index_of", "root_index",
+				"is_fastener", "is_unique", "instance_counts", "phrases",
+				"part_type_codes",
+				"child_offsets", "child_indices",
+				"parent_offsets", "parent_indices",
+				"has_contact_list", "contact_offsets", "contact_indices")
+
+	def __init__(self, ids, part_type_codes, is_fastener,
+				child_lists, parent_lists, contact_lists, root_index):
+		self.ids = ids
+		self.index_of = {ID: i for i, ID in enumerate(ids)}
+		self.root_index = root_index
+
+		self.part_type_codes = array("l", part_type_codes)
+		self.is_fastener = array("b", is_fastener)
+
+		self.child_offsets, self.child_indices = build_csr(child_lists)
+		self.parent_offsets, self.parent_indices = build_csr(parent_lists)
+
+		self.has_contact_list = array("b", [contact_list is not None for contact_list in contact_lists])
+		self.contact_offsets, self.contact_indices = build_csr([contact_list or () for contact_list in contact_lists])
+
+		type_counts = Counter(self.part_type_codes)
+		self.is_unique = array("b", [type_counts[code] == 1 for code in self.part_type_codes])
+		self.instance_counts = array("l", bytes(len(ids) * array("l").itemsize))
+		self.phrases = [None] * len(ids)
+
+	"""
+	builds the compact graph from an unparallelized Node graph
+	nodes: every node of the graph, e.g. the values of an ID2node_map
+	contact_lists: dict mapping each fastener ID to the parts it perforates
+	"""
+	@classmethod
+	def from_nodes(cls, nodes, contact_lists):
+		nodes = list(nodes)
+		index_of = {node.ID: i for i, node in enumerate(nodes)}
+
+		root_index = None
+		for i, node in enumerate(nodes):
+			if len(node.parents) == 0:
+				root_index = i
+
+		return cls([node.ID for node in nodes], [node.part_type_code for node in nodes],
+				[node.is_fastener for node in nodes],
+				[[index_of[child.ID] for child in node.children] for node in nodes],
+				[[index_of[parent.ID] for parent in node.parents] for node in nodes],
+				[[index_of[part.ID] for part in contact_lists[node.ID]] if node.ID in contact_lists else None for node in nodes],
+				root_index)
+
+	"""
+	builds the compact graph straight from json disassembly records
+	without creating Node objects
+	infer_part_type: maps a record's part name to its part type
+	"""
+	@classmethod
+	def from_records(cls, records, infer_part_type):
+		index_of = {}
+		for record in records:
+			index_of[record["id"]] = len(index_of)
+
+		ids = []
+		codes = []
+		is_fastener = []
+		child_lists = []
+		parent_lists = []
+		contact_lists = []
+		root_index = None
+		for record in records:
+			codes.append(part_types.code(infer_part_type(record["name"])))
+			ids.append(record["id"])
+			is_fastener.append(record["is_fastener"])
+			child_lists.append([index_of[c] for c in record["children"]])
+			parent_lists.append([index_of[p] for p in record["parents"]])
+			if record["is_fastener"]:
+				contact_lists.append([index_of[p] for p in record["fastened_parts"]])
+			else:
+				contact_lists.append(None)
+			if len(record["parents"]) == 0:
+				root_index = len(ids) - 1
+
+		return cls(ids, codes, is_fastener, child_lists, parent_lists, contact_lists, root_index)
+
+	def __len__(self):
+		return len(self.ids)
+
+	@property
+	def root(self):
+		return NodeView(self, self.root_index)
+
+	def node(self, ID):
+		return NodeView(self, self.index_of[ID])
+
+	def id2node_map(self):
+		return {ID: NodeView(self, i) for i, ID in enumerate(self.ids)}
+
+	def contact_lists(self):
+		contact_lists = {}
+		for i, ID in enumerate(self.ids):
+			if self.has_contact_list[i]:
+				start = self.contact_offsets[i]
+				end = self.contact_offsets[i + 1]
+				contact_lists[ID] = [NodeView(self, j) for j in self.contact_indices[start:end]]
+		return contact_lists
+
+	def part_counts(self):
+		type_counts = Counter(self.part_type_codes)
+		return {part_types.name(code): type_counts[code] for code in dict.fromkeys(self.part_type_codes)}
+
+	"""
+	expands the compact graph back into mutable Node objects, e.g. for
+	parallelize_where_possible which rewrites children lists in place.
+	returns root, ID2node_map, contact_lists, part_counts like json2graph
+	"""
+	def to_nodes(self):
+		nodes = [Node(ID, [], [], bool(self.is_fastener[i]), part_types.name(self.part_type_codes[i]), None)
+				for i, ID in enumerate(self.ids)]
+		contact_lists = {}
+		for i, node in enumerate(nodes):
+			node.children = [nodes[j] for j in self.child_indices[self.child_offsets[i]:self.child_offsets[i + 1]]]
+			node.parents = [nodes[j] for j in self.parent_indices[self.parent_offsets[i]:self.parent_offsets[i + 1]]]
+			node.is_unique = bool(self.is_unique[i])
+			if self.has_contact_list[i]:
+				contact_lists[node.ID] = [nodes[j] for j in self.contact_indices[self.contact_offsets[i]:self.contact_offsets[i + 1]]]
+
+		ID2node_map = {node.ID: node for node in nodes}
+		root = nodes[self.root_index] if self.root_index is not None else None
+		return root, ID2node_map, contact_lists, self.part_counts()
+
+	"""
+	returns the longest-path level of every node by dense index,
+	as a NumPy array when NumPy is installed and a list otherwise
+	"""
+	def level_array(self):
+		return levels_from_csr(self.child_offsets, self.parent_offsets, self.parent_indices)
+
+	"""
+	returns node_levels and levels_dict like grammar.get_levels,
+	keyed by the original node IDs and covering the nodes reachable 
+	from the root. Buckets hold the same nodes as get_levels, listed 
+	in dense index order rather than depth first finishing order.
+	"""
+	def get_levels(self):
+		levels = self.level_array()
+		reachable = reachable_from_csr(self.child_offsets, self.child_indices, self.root_index)
+		return bucket_levels(levels, reachable, self.ids)
+
+
+"""
+packs a list of index lists into (offsets, indices) arrays where the
+i-th list is indices[offsets[i]:offsets[i+1]]
+"""
+def build_csr(index_lists):
+	offsets = array("l", [0])
+	indices = array("l")
+	for index_list in index_lists:
+		indices.extend(index_list)
+		offsets.append(len(indices))
+	return offsets, indices
+
+
+"""
+Computes longest-path levels (height above the leaves, as in 
+grammar.topological_sort) of every node of a CSR graph a whole 
+frontier at a time: the leaves are level 0, and a node joins the 
+frontier of level k+1 once the frontier of level k has settled all 
+of its children. Runs on NumPy arrays when NumPy is available.
+"""
+def levels_from_csr(child_offsets, parent_offsets, parent_indices):
+	if np is None:
+		return levels_from_csr_python(child_offsets, parent_offsets, parent_indices)
+
+	child_offsets = np.asarray(child_offsets, dtype=np.int64)
+	parent_offsets = np.asarray(parent_offsets, dtype=np.int64)
+	parent_indices = np.asarray(parent_indices, dtype=np.int64)
+
+	remaining_children = np.diff(child_offsets)
+	levels = np.full(len(remaining_children), -1, dtype=np.int64)
+	frontier = np.flatnonzero(remaining_children == 0)
+	level = 0
+	while frontier.size:
+		levels[frontier] = level
+		parents, settled = np.unique(gather_csr(parent_offsets, parent_indices, frontier), return_counts=True)
+		remaining_children[parents] -= settled
+		frontier = parents[remaining_children[parents] == 0]
+		level += 1
+
+	if (levels < 0).any():
+		raise Exception(f"cycle detected through node index {int(np.flatnonzero(levels < 0)[0])}")
+	return levels
+
+
+def levels_from_csr_python(child_offsets, parent_offsets, parent_indices):
+	num_nodes = len(child_offsets) - 1
+	remaining_children = [child_offsets[i + 1] - child_offsets[i] for i in range(num_nodes)]
+	levels = [-1] * num_nodes
+	frontier = [i for i in range(num_nodes) if remaining_children[i] == 0]
+	level = 0
+	while frontier:
+		next_frontier = []
+		for i in frontier:
+			levels[i] = level
+			for parent in parent_indices[parent_offsets[i]:parent_offsets[i + 1]]:
+				remaining_children[parent] -= 1
+				if remaining_children[parent] == 0:
+					next_frontier.append(parent)
+		frontier = sorted(next_frontier)
+		level += 1
+
+	if -1 in levels:
+		raise Exception(f"cycle detected through node index {levels.index(-1)}")
+	return levels
+
+
+"""
+returns a mask of the nodes reachable from root along children,
+a NumPy bool array when NumPy is available
+"""
+def reachable_from_csr(child_offsets, child_indices, root):
+	if np is None:
+		reachable = [False] * (len(child_offsets) - 1)
+		reachable[root] = True
+		stack = [root]
+		while stack:
+			i = stack.pop()
+			for child in child_indices[child_offsets[i]:child_offsets[i + 1]]:
+				if not reachable[child]:
+					reachable[child] = True
+					stack.append(child)
+		return reachable
+
+	child_offsets = np.asarray(child_offsets, dtype=np.int64)
+	child_indices = np.asarray(child_indices, dtype=np.int64)
+	reachable = np.zeros(len(child_offsets) - 1, dtype=bool)
+	reachable[root] = True
+	frontier = np.array([root], dtype=np.int64)
+	while frontier.size:
+		children = gather_csr(child_offsets, child_indices, frontier)
+		children = np.sort(children[~reachable[children]])
+		frontier = children[np.concatenate(([True], children[1:] != children[:-1]))] if children.size else children
+		reachable[frontier] = True
+	return reachable
+
+
+"""
+returns the concatenation of the CSR rows listed in rows
+"""
+def gather_csr(offsets, indices, rows):
+	starts = offsets[rows]
+	counts = offsets[rows + 1] - starts
+	total = int(counts.sum())
+	if total == 0:
+		return np.empty(0, dtype=np.int64)
+	row_starts_in_output = np.cumsum(counts) - counts
+	positions = np.repeat(starts - row_starts_in_output, counts) + np.arange(total)
+	return indices[positions]
+
+
+"""
+builds child and parent CSR arrays from an edge list where the i-th
+edge makes children[i] a child of parents[i]. Edges keep their order
+within each node's children and parents.
+returns child_offsets, child_indices, parent_offsets, parent_indices
+"""
+def csr_from_edges(num_nodes, parents, children):
+	if np is None:
+		child_lists = [[] for i in range(num_nodes)]
+		parent_lists = [[] for i in range(num_nodes)]
+		for parent, child in zip(parents, children):
+			child_lists[parent].append(child)
+			parent_lists[child].append(parent)
+		return build_csr(child_lists) + build_csr(parent_lists)
+
+	parents = np.asarray(parents, dtype=np.int64)
+	children = np.asarray(children, dtype=np.int64)
+
+	def csr(rows, columns):
+		order = np.argsort(rows, kind="stable")
+		offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+		np.cumsum(np.bincount(rows, minlength=num_nodes), out=offsets[1:])
+		return offsets, columns[order]
+
+	return csr(parents, children) + csr(children, parents)
+
+
+"""
+longest-path levels straight from an edge list, see csr_from_edges
+"""
+def levels_from_edges(num_nodes, parents, children):
+	child_offsets, child_indices, parent_offsets, parent_indices = csr_from_edges(num_nodes, parents, children)
+	return levels_from_csr(child_offsets, parent_offsets, parent_indices)
+
+
+"""
+turns per index levels into node_levels and levels_dict keyed by ids,
+keeping only the nodes selected by mask
+"""
+def bucket_levels(levels, mask, ids):
+	node_levels = {}
+	levels_dict = {}
+	if np is None:
+		for i, level in enumerate(levels):
+			if mask[i]:
+				node_levels[ids[i]] = level
+				if level in levels_dict:
+					levels_dict[level].append(ids[i])
+				else:
+					levels_dict[level] = [ids[i]]
+		return node_levels, dict(sorted(levels_dict.items()))
+
+	indices = np.flatnonzero(mask)
+	indices = indices[np.argsort(levels[indices], kind="stable")]
+	sorted_levels = levels[indices]
+	boundaries = np.flatnonzero(np.diff(sorted_levels)) + 1
+	for bucket in np.split(indices, boundaries):
+		if bucket.size:
+			level = int(levels[bucket[0]])
+			levels_dict[level] = [ids[i] for i in bucket.tolist()]
+	node_levels = dict(zip([ids[i] for i in indices.tolist()], sorted_levels.tolist()))
+	return node_levels, levels_dict
@@ -0,0 +1,184 @@
+"""
+compiles many assembly json files into instruction programs in parallel
+
+usage: python batch_compile.py INPUT [INPUT ...] -o OUTPUT_DIR [-j JOBS]
+
+Each INPUT is a directory (every *.json file in it is compiled), a
+manifest listing one assembly file per line, or a single json file.
+One program is written per input as OUTPUT_DIR/<name>.txt. A failing
+file never stops the batch; failures are listed in the summary, as are
+the violations of each file compiled with --validation deferred.
+
+exit codes:
+0 every file compiled
+1 at least one file failed
+2 bad arguments or nothing to compile
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import validation
+from grammar import write_program
+from json_to_graph import compile_graph, build_greedy_program
+
+
+EXIT_OK = 0
+EXIT_FAILURES = 1
+EXIT_USAGE = 2
+
+
+"""
+expands the command line inputs into the list of json files to compile
+manifest entries are relative to the manifest's directory,
+blank lines and lines starting with # are skipped
+"""
+def collect_inputs(inputs):
+	json_files = []
+	for path in inputs:
+		if os.path.isdir(path):
+			json_files += sorted([os.path.join(path, name) for name in os.listdir(path) if name.endswith(".json")])
+		elif path.endswith(".json"):
+			json_files += [path]
+		else:
+			manifest_dir = os.path.dirname(path)
+			with open(path, "r") as f:
+				for line in f:
+					line = line.strip()
+					if line and not line.startswith("#"):
+						json_files += [os.path.join(manifest_dir, line)]
+	return json_files
+
+
+def output_path(json_file, output_dir):
+	name = os.path.splitext(os.path.basename(json_file))[0]
+	return os.path.join(output_dir, name + ".txt")
+
+
+"""
+compiles one assembly file and writes its program
+runs in a worker process and never raises, so one bad file
+can't take down the batch
+returns (json_file, error, node count, seconds, violations), violations
+being those collected compiling the file in deferred validation mode
+stream: parse the json one record at a time, see compile_graph
+"""
+def compile_one(json_file, out_path, cache_dir=None, stream=False):
+	start = time.perf_counter()
+	try:
+		if cache_dir is None:
+			root, id2node_map, contact_lists, part_counts = compile_graph(json_file, stream=stream)
+		else:
+			from graph_cache import load_or_compile
+			root, id2node_map, contact_lists, part_counts = load_or_compile(json_file, cache_dir, stream=stream)
+		program = build_greedy_program(root, id2node_map, contact_lists, part_counts)
+		write_output(program, out_path)
+	except Exception:
+		return json_file, traceback.format_exc(), 0, time.perf_counter() - start, validation.take_deferred()
+	return json_file, None, len(id2node_map), time.perf_counter() - start, validation.take_deferred()
+
+
+"""
+writes a program to out_path, rendering it to a temporary file next
+to it first so a program that fails to render leaves no partial file
+"""
+def write_output(program, out_path):
+	tmp_path = f"{out_path}.{os.getpid()}.tmp"
+	try:
+		with open(tmp_path, "w") as f:
+			write_program(program, f)
+			f.write("\n")
+		os.replace(tmp_path, out_path)
+	except BaseException:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
+
+def compile_all(json_files, output_dir, jobs, cache_dir=None, stream=False):
+	results = []
+	if jobs == 1:
+		for json_file in json_files:
+			results += [compile_one(json_file, output_path(json_file, output_dir), cache_dir, stream)]
+		return results
+
+	# workers may not be forked, they are told the validation mode
+	with ProcessPoolExecutor(max_workers=jobs, initializer=validation.set_mode, initargs=(validation.mode,)) as executor:
+		futures = {executor.submit(compile_one, json_file, output_path(json_file, output_dir), cache_dir, stream): json_file
+					for json_file in json_files}
+		for future in as_completed(futures):
+			try:
+				results += [future.result()]
+			except Exception:
+				# the worker process itself died
+				results += [(futures[future], traceback.format_exc(), 0, 0.0, [])]
+	return results
+
+
+def summarize(results, wall_time):
+	failures = [(json_file, error) for json_file, error, nodes, seconds, violations in results if error is not None]
+	nodes = sum([nodes for json_file, error, nodes, seconds, violations in results])
+	return {
+		"files": len(results),
+		"compiled": len(results) - len(failures),
+		"failed": len(failures),
+		"nodes": nodes,
+		"wall_seconds": wall_time,
+		"files_per_second": len(results) / wall_time if wall_time > 0 else 0.0,
+		"nodes_per_second": nodes / wall_time if wall_time > 0 else 0.0,
+		"failures": [{"file": json_file, "error": error} for json_file, error in failures],
+		"violations": [{"file": json_file, "violations": violations}
+					for json_file, error, nodes, seconds, violations in results if len(violations) != 0],
+	}
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="compile directories or manifests of assembly json files")
+	parser.add_argument("inputs", nargs="+", help="directories, manifests, or json files")
+	parser.add_argument("-o", "--output-dir", required=True)
+	parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1)
+	parser.add_argument("--cache-dir", default=None, help="reuse compiled graphs cached in this directory")
+	parser.add_argument("--stream", action="store_true", help="parse the json one record at a time, for assemblies too large to load whole")
+	parser.add_argument("--summary-json", default=None, help="also write the summary to this file")
+	validation.add_mode_argument(parser)
+	args = parser.parse_args(argv)
+	validation.set_mode(args.validation)
+
+	try:
+		json_files = collect_inputs(args.inputs)
+	except OSError as e:
+		print(f"error: {e}", file=sys.stderr)
+		return EXIT_USAGE
+	if len(json_files) == 0:
+		print("error: no assembly files to compile", file=sys.stderr)
+		return EXIT_USAGE
+	outputs = [output_path(json_file, args.output_dir) for json_file in json_files]
+	if len(set(outputs)) != len(outputs):
+		print("error: several inputs share a file name and would overwrite each other's program", file=sys.stderr)
+		return EXIT_USAGE
+	os.makedirs(args.output_dir, exist_ok=True)
+
+	start = time.perf_counter()
+	results = compile_all(json_files, args.output_dir, max(1, args.jobs), args.cache_dir, args.stream)
+	summary = summarize(results, time.perf_counter() - start)
+
+	for failure in summary["failures"]:
+		print(f"FAILED {failure['file']}\n{failure['error']}", file=sys.stderr)
+	for entry in summary["violations"]:
+		print(f"VIOLATIONS {entry['file']}\n{validation.format_violations(entry['violations'])}", file=sys.stderr)
+	print(f"compiled {summary['compiled']}/{summary['files']} files ({summary['failed']} failed) "
+		f"in {summary['wall_seconds']:.2f}s, {summary['files_per_second']:.1f} files/s, "
+		f"{summary['nodes_per_second']:.0f} nodes/s", file=sys.stderr)
+	if args.summary_json is not None:
+		with open(args.summary_json, "w") as f:
+			json.dump(summary, f, indent=2)
+
+	return EXIT_OK if summary["failed"] == 0 else EXIT_FAILURES
+
+
+if __name__ == "__main__":
+	sys.exit(main())
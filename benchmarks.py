@@ -0,0 +1,336 @@
+"""
+synthetic assembly benchmarks for every stage of the compiler
+
+usage: python benchmarks.py [--sizes 10 100 1000 ...] [--output FILE] [--baseline FILE]
+	[--subassembly-cache] [--graph-cache] [--repeated-subassembly SIZE]
+
+Generates disassembly DAGs of the requested sizes and times json2graph,
+topological_sort, parallelize_where_possible, greedy_order,
+build_program and get_program_str separately on each. The results are
+saved as json. When a baseline results file is given, any stage that
+got slower than the allowed ratio is reported and the exit code is 1.
+
+With --subassembly-cache the whole compile is also timed without a
+subassembly cache, with an empty one and with a warm one, see
+time_subassembly_cache. --repeated-subassembly benchmarks assemblies
+made of copies of one subassembly instead, where the cache pays off most.
+With --graph-cache loading the compiled graph is timed through an empty
+and a warm graph cache, see time_graph_cache.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from grammar import *
+from json_to_graph import json2graph, parallelize_graph, build_greedy_program
+
+
+STAGES = ["json2graph", "topological_sort", "parallelize_where_possible",
+		"greedy_order", "build_program", "get_program_str"]
+DEFAULT_SIZES = [10, 100, 1000, 10000, 100000]
+BRACKET_SCREWS = 3
+
+
+"""
+appends the record of a new part placed on parents to records
+"""
+def add_node(records, name, is_fastener, parents):
+	record = {"id": len(records), "name": name, "parents": [], "children": [],
+			"part_type": None, "is_fastener": is_fastener, "fastened_parts": None}
+	records.append(record)
+	for parent in parents:
+		record["parents"].append(parent["id"])
+		parent["children"].append(record["id"])
+	return record
+
+
+"""
+appends the record of a new screw through parents to records
+"""
+def add_screw(records, parents):
+	screw = add_node(records, f"91290A{len(records)}_{len(records)}", True, parents)
+	# contact lists go from the closest part to the furthest
+	screw["fastened_parts"] = [p["id"] for p in parents]
+	return screw
+
+
+"""
+Generates json node records, in the format json2graph reads, for a
+synthetic disassembly DAG of about num_nodes nodes.
+
+The root part sits at level 0 and every other part is placed on one
+part of the level above it (two with probability multi_parent_fraction).
+depth: number of levels of parts below the root
+fastener_ratio: average number of screws per part
+multi_parent_fastener_fraction: share of screws that go through their
+	part into its first parent rather than just into the part
+repeat_fraction: share of parts that are an identical repeated
+	subassembly - a support bracket held on by three screws through
+	it into its parent, like the spindle block brackets
+num_part_types: how many distinct part types the other parts use
+"""
+def generate_assembly(num_nodes, depth=6, fastener_ratio=2.0, multi_parent_fraction=0.2,
+					multi_parent_fastener_fraction=0.5, repeat_fraction=0.3, num_part_types=8, seed=0):
+	rng = random.Random(seed)
+	records = []
+
+	num_parts = max(1, round(num_nodes / (1 + fastener_ratio)))
+	width = max(1, math.ceil((num_parts - 1) / depth))
+	previous_level = [add_node(records, "Base Plate_0", False, [])]
+	level = []
+	while len(records) < num_nodes:
+		if len(level) == width:
+			previous_level, level = level, []
+
+		parents = [rng.choice(previous_level)]
+		if len(previous_level) > 1 and rng.random() < multi_parent_fraction:
+			parents += [rng.choice([p for p in previous_level if p is not parents[0]])]
+
+		if rng.random() < repeat_fraction:
+			part = add_node(records, f"Support Bracket_{len(records)}", False, parents)
+			for i in range(BRACKET_SCREWS):
+				add_screw(records, [part, parents[0]])
+		else:
+			part = add_node(records, f"Part{rng.randrange(num_part_types)}_{len(records)}", False, parents)
+			for i in range(int(fastener_ratio) + (rng.random() < fastener_ratio % 1)):
+				if rng.random() < multi_parent_fastener_fraction:
+					add_screw(records, [part, parents[0]])
+				else:
+					add_screw(records, [part])
+		level += [part]
+
+	return records
+
+
+"""
+Generates json node records, in the format json2graph reads, for
+copies of one subassembly of about subassembly_size nodes placed side
+by side on the base plate, about num_nodes nodes in all.
+
+The subassembly is made once: a frame held on the base plate by three
+screws through it, then parts each placed on a part of the
+subassembly before it, with up to max_screws screws each, going into
+that part too with probability multi_parent_fastener_fraction.
+"""
+def generate_repeated_assembly(num_nodes, subassembly_size=40, max_screws=2, multi_parent_fastener_fraction=0.5,
+							num_part_types=8, seed=0):
+	rng = random.Random(seed)
+	# (part type, index of the part it is placed on, whether each screw goes into that part)
+	shape = []
+	size = 1 + BRACKET_SCREWS
+	while size < subassembly_size:
+		screws = [rng.random() < multi_parent_fastener_fraction for i in range(rng.randint(0, max_screws))]
+		shape += [(rng.randrange(num_part_types), rng.randrange(len(shape) + 1), screws)]
+		size += 1 + len(screws)
+
+	records = []
+	base = add_node(records, "Base Plate_0", False, [])
+	for copy in range(max(1, (num_nodes - 1) // size)):
+		parts = [add_node(records, f"Frame_{len(records)}", False, [base])]
+		for i in range(BRACKET_SCREWS):
+			add_screw(records, [parts[0], base])
+		for part_type, placed_on, screws in shape:
+			parent = parts[placed_on]
+			part = add_node(records, f"Part{part_type}_{len(records)}", False, [parent])
+			for into_parent in screws:
+				add_screw(records, [part, parent] if into_parent else [part])
+			parts += [part]
+	return records
+
+
+"""
+runs every stage once on the assembly in json_file and
+returns the seconds spent in each
+"""
+def time_stages(json_file):
+	times = {}
+
+	start = time.perf_counter()
+	root, id2node_map, contact_lists, part_counts = json2graph(json_file)
+	times["json2graph"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	get_levels(root)
+	times["topological_sort"] = time.perf_counter() - start
+
+	# through parallelize_graph, as compile_graph does it
+	start = time.perf_counter()
+	parallelize_graph(root, id2node_map, contact_lists, part_counts)
+	times["parallelize_where_possible"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	order = [root]
+	greedy_order(root, [root.ID], order, fasteners_first)
+	times["greedy_order"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	program = build_program(root, id2node_map, contact_lists, part_counts, order)
+	times["build_program"] = time.perf_counter() - start
+
+	start = time.perf_counter()
+	get_program_str(program)
+	times["get_program_str"] = time.perf_counter() - start
+
+	return times
+
+
+"""
+times compiling the assembly in json_file from its graph to its
+program string without a subassembly cache (compile), with an empty
+one (compile_cached_cold) and with the one left by compiling the same
+assembly before (compile_cached_warm), and returns the seconds of each
+"""
+def time_subassembly_cache(json_file):
+	from subassembly_cache import SubassemblyCache, compile_with_cache
+
+	times = {}
+	graph = json2graph(json_file)
+	start = time.perf_counter()
+	get_program_str(build_greedy_program(*parallelize_graph(*graph)))
+	times["compile"] = time.perf_counter() - start
+
+	cache = SubassemblyCache()
+	for stage in ["compile_cached_cold", "compile_cached_warm"]:
+		graph = json2graph(json_file)
+		start = time.perf_counter()
+		"".join(compile_with_cache(*graph, cache)).strip()
+		times[stage] = time.perf_counter() - start
+	return times
+
+
+"""
+times getting the compiled graph of the assembly in json_file through
+a graph cache, on a miss that compiles and stores it (graph_cache_miss)
+and on the hit that loads it back (graph_cache_hit), and returns the
+seconds of each
+"""
+def time_graph_cache(json_file):
+	from graph_cache import load_or_compile
+
+	times = {}
+	with tempfile.TemporaryDirectory() as cache_dir:
+		for stage in ["graph_cache_miss", "graph_cache_hit"]:
+			start = time.perf_counter()
+			load_or_compile(json_file, cache_dir)
+			times[stage] = time.perf_counter() - start
+	return times
+
+
+"""
+benchmarks every size, keeping the fastest of repeats runs per stage
+generate: makes the records of an assembly of about a given size
+subassembly_cache: also time the compile with a subassembly cache
+graph_cache: also time loading the compiled graph through a graph cache
+"""
+def run_benchmarks(sizes, repeats=3, seed=0, generate=generate_assembly, subassembly_cache=False, graph_cache=False, **generator_args):
+	results = []
+	for size in sizes:
+		records = generate(size, seed=seed, **generator_args)
+		fd, json_file = tempfile.mkstemp(suffix=".json")
+		try:
+			with os.fdopen(fd, "w") as f:
+				json.dump(records, f)
+			del records
+			best = {}
+			for i in range(repeats):
+				times = time_stages(json_file)
+				if subassembly_cache:
+					times.update(time_subassembly_cache(json_file))
+				if graph_cache:
+					times.update(time_graph_cache(json_file))
+				for stage, seconds in times.items():
+					best[stage] = min(seconds, best.get(stage, seconds))
+		finally:
+			os.remove(json_file)
+		results += [{"nodes": size, "seconds": best}]
+		print(f"{size:>9} nodes  " + "  ".join([f"{stage} {seconds:.4f}s" for stage, seconds in best.items()]), file=sys.stderr)
+	return results
+
+
+"""
+returns (nodes, stage, baseline seconds, seconds) for every stage that
+is more than max_ratio times slower than in the baseline results,
+ignoring stages that take less than min_seconds either way
+"""
+def find_regressions(results, baseline, max_ratio=1.25, min_seconds=1e-3):
+	baseline_seconds = {entry["nodes"]: entry["seconds"] for entry in baseline["results"]}
+	regressions = []
+	for entry in results:
+		if not entry["nodes"] in baseline_seconds:
+			continue
+		for stage, seconds in entry["seconds"].items():
+			before = baseline_seconds[entry["nodes"]].get(stage)
+			if before is None or max(before, seconds) < min_seconds:
+				continue
+			if seconds > before * max_ratio:
+				regressions += [(entry["nodes"], stage, before, seconds)]
+	return regressions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="time every compiler stage on synthetic assemblies")
+	parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+	parser.add_argument("--repeats", type=int, default=3)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--depth", type=int, default=6)
+	parser.add_argument("--fastener-ratio", type=float, default=2.0)
+	parser.add_argument("--multi-parent-fraction", type=float, default=0.2)
+	parser.add_argument("--multi-parent-fastener-fraction", type=float, default=0.5)
+	parser.add_argument("--repeat-fraction", type=float, default=0.3)
+	parser.add_argument("--subassembly-cache", action="store_true", help="also time compiling with a subassembly cache")
+	parser.add_argument("--graph-cache", action="store_true", help="also time loading compiled graphs through a graph cache")
+	parser.add_argument("--repeated-subassembly", type=int, default=None, metavar="SIZE",
+						help="benchmark assemblies of copies of one subassembly of SIZE nodes instead")
+	parser.add_argument("--output", default="bench_results.json")
+	parser.add_argument("--baseline", default=None, help="results file to check for regressions against")
+	parser.add_argument("--max-ratio", type=float, default=1.25)
+	args = parser.parse_args(argv)
+
+	if args.repeated_subassembly is None:
+		generate = generate_assembly
+		generator_args = {
+			"depth": args.depth,
+			"fastener_ratio": args.fastener_ratio,
+			"multi_parent_fraction": args.multi_parent_fraction,
+			"multi_parent_fastener_fraction": args.multi_parent_fastener_fraction,
+			"repeat_fraction": args.repeat_fraction,
+		}
+	else:
+		generate = generate_repeated_assembly
+		generator_args = {
+			"subassembly_size": args.repeated_subassembly,
+			"multi_parent_fastener_fraction": args.multi_parent_fastener_fraction,
+		}
+	results = run_benchmarks(args.sizes, args.repeats, args.seed, generate, args.subassembly_cache, args.graph_cache, **generator_args)
+	with open(args.output, "w") as f:
+		json.dump({
+			"meta": {
+				"date": datetime.datetime.now().isoformat(timespec="seconds"),
+				"python": platform.python_version(),
+				"platform": platform.platform(),
+				"repeats": args.repeats,
+				"seed": args.seed,
+				"generator": generator_args,
+			},
+			"results": results,
+		}, f, indent=2)
+
+	if args.baseline is None:
+		return 0
+	with open(args.baseline, "r") as f:
+		baseline = json.load(f)
+	regressions = find_regressions(results, baseline, args.max_ratio)
+	for nodes, stage, before, seconds in regressions:
+		print(f"REGRESSION {stage} at {nodes} nodes: {before:.4f}s -> {seconds:.4f}s", file=sys.stderr)
+	return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
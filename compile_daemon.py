@@ -0,0 +1,342 @@
+"""
+resident compile service speaking json lines over a unix socket or stdin
+
+usage: python compile_daemon.py [--socket PATH] [-j JOBS] [--max-pending N] [--timeout SECONDS]
+
+Keeps the interpreter, the compiler modules and a pool of worker
+processes warm, so a compile request costs the compile itself rather
+than a process start. Without --socket requests are read from stdin
+and responses written to stdout.
+
+Every request is one json object on one line, either the assembly
+records themselves, in the format json2graph reads, or a path to an
+assembly json file:
+	{"id": 7, "records": [{"id": 0, "name": "Base Plate_0", ...}, ...]}
+	{"id": 8, "path": "assembly_info.json"}
+and gets one response line, in the order requests finish rather than
+the order they came in, carrying the same id:
+	{"id": 7, "ok": true, "program": "position the Base Plate for assembly\n...", "seconds": 0.002}
+	{"id": 8, "ok": false, "error": "timed out after 30.0s"}
+With --validation deferred, a graph with violations is still compiled
+and its response lists them under "violations".
+
+Requests are decoded and compiled in the workers, the event loop only
+moves lines around. At most max_pending requests are in flight at once,
+past that no more requests are read, so a client sending faster than
+the workers compile is slowed down by its socket or pipe filling up.
+A connection only takes a slot once it has sent a request, idle
+connections take none.
+A request that doesn't finish within the timeout is answered with an
+error. Its worker can't be stopped and still finishes it, the result is
+dropped, and the request keeps its slot until then so slow requests
+can't pile up in the pool's queue. A worker that dies fails the requests
+in flight on its pool, and the pool is replaced by a fresh one.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import validation
+from grammar import get_program_str
+from json_to_graph import compile_graph, parallelize_graph, records2graph, build_greedy_program
+
+
+DEFAULT_TIMEOUT = 30.0
+# longest request line a socket connection accepts
+DEFAULT_MAX_REQUEST_BYTES = 256 * 1024 * 1024
+
+
+"""
+compiles one request line and returns its response line
+runs in a worker and never raises, so a bad request can't take
+down the worker
+stream: parse the files of path requests one record at a time
+"""
+def compile_request(line, cache_dir=None, stream=False):
+	start = time.perf_counter()
+	request_id = None
+	try:
+		request = json.loads(line)
+		request_id = request.get("id")
+		if "records" in request:
+			graph = parallelize_graph(*records2graph(request["records"]))
+		elif "path" in request:
+			if cache_dir is None:
+				graph = compile_graph(request["path"], stream=stream)
+			else:
+				from graph_cache import load_or_compile
+				graph = load_or_compile(request["path"], cache_dir, stream=stream)
+		else:
+			raise Exception("request has neither records nor a path")
+		program = get_program_str(build_greedy_program(*graph))
+		response = {"id": request_id, "ok": True, "program": program, "seconds": time.perf_counter() - start}
+	except Exception as e:
+		response = {"id": request_id, "ok": False, "error": f"{type(e).__name__}: {e}",
+					"traceback": traceback.format_exc()}
+	violations = validation.take_deferred()
+	if len(violations) != 0:
+		response["violations"] = violations
+	return json.dumps(response) + "\n"
+
+
+def warm_up():
+	return os.getpid()
+
+
+"""
+runs first in every worker process
+"""
+def init_worker(validation_mode):
+	# forked workers inherit the daemon's signal handling, which hands
+	# signals on to the daemon's event loop: the pool stopping a worker
+	# with SIGTERM would stop the daemon instead of the worker
+	signal.set_wakeup_fd(-1)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	# workers may not be forked, they are told the validation mode
+	validation.set_mode(validation_mode)
+
+
+"""
+returns the id of a request line for error responses the worker
+couldn't give, or None if it can't be read
+"""
+def request_id(line):
+	try:
+		return json.loads(line).get("id")
+	except Exception:
+		return None
+
+
+class CompileDaemon:
+	def __init__(self, jobs, max_pending, timeout=DEFAULT_TIMEOUT, cache_dir=None, max_request_bytes=DEFAULT_MAX_REQUEST_BYTES, stream=False):
+		self.jobs = jobs
+		self.timeout = timeout
+		self.max_request_bytes = max_request_bytes
+		self.cache_dir = cache_dir
+		self.stream = stream
+		self.pending = asyncio.Semaphore(max_pending)
+		self.executor = self.new_executor()
+
+	def new_executor(self):
+		# jobs 0 compiles in one thread of this process: no pickling
+		# between processes, but also no parallel compiles
+		if self.jobs == 0:
+			return ThreadPoolExecutor(max_workers=1)
+		return ProcessPoolExecutor(max_workers=self.jobs, initializer=init_worker, initargs=(validation.mode,))
+
+	"""
+	replaces executor, a pool broken by a worker that died, unless
+	that was already done for another request in flight on it
+	"""
+	def replace_broken_executor(self, executor):
+		if self.executor is executor:
+			self.executor = self.new_executor()
+			executor.shutdown(wait=False, cancel_futures=True)
+
+	"""
+	starts every worker ahead of the first request
+	"""
+	async def start(self):
+		loop = asyncio.get_running_loop()
+		await asyncio.gather(*[loop.run_in_executor(self.executor, warm_up) for i in range(max(1, self.jobs))])
+
+	"""
+	Stops the workers without waiting for them: nothing is left to
+	take their answers, and one may still be busy with a request that
+	timed out. Workers stopped in the middle of a request break their
+	pool, which is why it isn't waited on either.
+	"""
+	def close(self):
+		self.executor.shutdown(wait=False, cancel_futures=True)
+		if self.jobs != 0:
+			for process in multiprocessing.active_children():
+				process.terminate()
+				process.join()
+
+	"""
+	starts compiling a request line on the workers
+	returns the executor it runs on and the future of its response line
+	"""
+	def submit(self, line):
+		loop = asyncio.get_running_loop()
+		executor = self.executor
+		try:
+			return executor, loop.run_in_executor(executor, compile_request, line, self.cache_dir, self.stream)
+		except BrokenProcessPool:
+			# a worker died since the last request, the request is not to blame
+			self.replace_broken_executor(executor)
+			executor = self.executor
+			return executor, loop.run_in_executor(executor, compile_request, line, self.cache_dir, self.stream)
+
+	"""
+	returns the response line of a request submitted to executor,
+	an error response if it times out or its worker dies
+	"""
+	async def answer(self, line, executor, future):
+		try:
+			# shielded so the work isn't cancelled at the timeout, the
+			# caller can still tell when the worker is really done with it
+			return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+		except asyncio.TimeoutError:
+			error = f"timed out after {self.timeout}s"
+		except BrokenProcessPool as e:
+			self.replace_broken_executor(executor)
+			error = f"worker process died: {e}"
+		except asyncio.CancelledError:
+			if not future.cancelled():
+				raise
+			# still queued on a broken pool when it was replaced
+			error = "worker process died"
+		except Exception as e:
+			error = f"{type(e).__name__}: {e}"
+		return json.dumps({"id": request_id(line), "ok": False, "error": error}) + "\n"
+
+	"""
+	compiles a request line and returns the response line
+	"""
+	async def handle(self, line):
+		executor, future = self.submit(line)
+		return await self.answer(line, executor, future)
+
+	"""
+	reads request lines with readline until it returns an empty line,
+	answering each with write. Each request read takes a free slot,
+	waiting for one before the next request is read, and gives it
+	back once its worker is done with it. Returns once every request
+	read is answered.
+	"""
+	async def serve(self, readline, write):
+		async def respond(line, executor, future):
+			await write(await self.answer(line, executor, future))
+
+		tasks = set()
+		while True:
+			line = await readline()
+			if not line:
+				break
+			if line.strip() == b"":
+				continue
+			await self.pending.acquire()
+			try:
+				executor, future = self.submit(line)
+			except BaseException:
+				self.pending.release()
+				raise
+			future.add_done_callback(lambda future: self.pending.release())
+			task = asyncio.create_task(respond(line, executor, future))
+			tasks.add(task)
+			task.add_done_callback(tasks.discard)
+		if tasks:
+			await asyncio.gather(*tasks, return_exceptions=True)
+
+	async def serve_stdio(self):
+		loop = asyncio.get_running_loop()
+		# stdin is read by a thread of its own, one line at a time as
+		# serve asks for them so backpressure still reaches the pipe.
+		# It is a daemon thread so a blocked read never holds up exiting.
+		lines = asyncio.Queue(maxsize=1)
+
+		# reads the file descriptor directly, a daemon thread still
+		# inside sys.stdin's buffered reader would block exiting
+		def read_stdin():
+			fd = sys.stdin.fileno()
+			partial = [] # pieces of the line being read
+			try:
+				while True:
+					chunk = os.read(fd, 1 << 16)
+					if not chunk:
+						break
+					*complete, rest = chunk.split(b"\n")
+					for line in complete:
+						partial.append(line + b"\n")
+						asyncio.run_coroutine_threadsafe(lines.put(b"".join(partial)), loop).result()
+						partial = []
+					if rest:
+						partial.append(rest)
+				if partial:
+					asyncio.run_coroutine_threadsafe(lines.put(b"".join(partial)), loop).result()
+				asyncio.run_coroutine_threadsafe(lines.put(b""), loop).result()
+			except RuntimeError:
+				pass # the loop closed first
+
+		async def write(response):
+			sys.stdout.write(response)
+			sys.stdout.flush()
+
+		threading.Thread(target=read_stdin, daemon=True).start()
+		await self.serve(lines.get, write)
+
+	async def serve_socket(self, path):
+		async def connected(reader, writer):
+			async def write(response):
+				writer.write(response.encode())
+				await writer.drain()
+			try:
+				await self.serve(reader.readline, write)
+			except ValueError:
+				# a request line longer than max_request_bytes, the rest of
+				# the stream can't be split into requests anymore
+				await write(json.dumps({"id": None, "ok": False, "error": f"request longer than {self.max_request_bytes} bytes"}) + "\n")
+			except (ConnectionError, asyncio.IncompleteReadError):
+				pass
+			finally:
+				writer.close()
+
+		if os.path.exists(path):
+			os.remove(path)
+		server = await asyncio.start_unix_server(connected, path=path, limit=self.max_request_bytes)
+		print(f"listening on {path}", file=sys.stderr)
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			if os.path.exists(path):
+				os.remove(path)
+
+
+async def run(args):
+	daemon = CompileDaemon(args.jobs, args.max_pending or 4 * max(1, args.jobs), args.timeout, args.cache_dir, args.max_request_bytes, args.stream)
+	# stop on SIGTERM the same way as on ctrl-c, so the workers get shut down
+	asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+	try:
+		await daemon.start()
+		if args.socket is None:
+			await daemon.serve_stdio()
+		else:
+			await daemon.serve_socket(args.socket)
+	finally:
+		daemon.close()
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="compile assemblies sent as json lines over a unix socket or stdin")
+	parser.add_argument("--socket", default=None, help="unix socket path to listen on instead of stdin")
+	parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+						help="worker processes, 0 compiles in a thread of the daemon itself")
+	parser.add_argument("--max-pending", type=int, default=None, help="requests in flight at once, 4 per job by default")
+	parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds before a request is answered with an error")
+	parser.add_argument("--cache-dir", default=None, help="reuse compiled graphs cached in this directory for path requests")
+	parser.add_argument("--stream", action="store_true", help="parse the files of path requests one record at a time, for assemblies too large to load whole")
+	parser.add_argument("--max-request-bytes", type=int, default=DEFAULT_MAX_REQUEST_BYTES, help="longest request line accepted over the socket")
+	validation.add_mode_argument(parser)
+	args = parser.parse_args(argv)
+	validation.set_mode(args.validation)
+
+	try:
+		asyncio.run(run(args))
+	except (KeyboardInterrupt, asyncio.CancelledError):
+		pass
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
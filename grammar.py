@@ -1,3 +1,9 @@
+import collections
+import io
+import operator
+import instrumentation
+import validation
+
 """
 used to generate unique IDs for new nodes
 """
@@ -11,19 +17,47 @@ class IDGen:
 		self.n += 1
 		return result
 
+"""
+returns an IDGen for the new nodes of a graph built from records,
+starting past the largest integer ID in ID2node_map: record IDs
+needn't run from 0 to n-1, e.g. once parts are taken out of a json
+"""
+def new_ID_generator(ID2node_map):
+	return IDGen(max([ID for ID in ID2node_map if type(ID) is int], default=-1) + 1)
+
 """
 Given a traversal order through a graph, assigns
 instance counts based on the order the parts' occurrences
+The parts of a parallel placement are each named in its statement,
+so they are counted one by one, see counted_parts
+attached_part_counts: how many of each part type code were counted
+	before the traversal, for numbering part of a longer order.
+	It is a dict updated in place, codes missing from it count from 0
+	and None starts every count at 0.
 """
-def assign_instance_counts(traversal_order):
-	attached_part_counts = {}
+def assign_instance_counts(traversal_order, attached_part_counts=None):
+	if attached_part_counts is None:
+		attached_part_counts = {}
 
 	for node in traversal_order:
-		if node.part_type in attached_part_counts:
-			attached_part_counts[node.part_type] += 1
+		if node.is_fastener or not isinstance(node, ParallelNode):
+			code = node.part_type_code
+			node.instance_count = attached_part_counts[code] = attached_part_counts.get(code, 0) + 1
 		else:
-			attached_part_counts[node.part_type] = 1
-		node.instance_count = attached_part_counts[node.part_type]
+			for part in node.nodes:
+				code = part.part_type_code
+				part.instance_count = attached_part_counts[code] = attached_part_counts.get(code, 0) + 1
+
+
+"""
+returns the parts a node of a traversal order is counted as: each
+part of a parallel placement, or else the node itself. Parallel
+fasteners count once, their statement only gives how many there are.
+"""
+def counted_parts(node):
+	if node.is_fastener or not isinstance(node, ParallelNode):
+		return [node]
+	return node.nodes
 
 
 """
@@ -37,29 +71,81 @@ parts are sorted in contact order
 attachment_op := <fastener> <part 1> ... <part n>
 """
 
-def get_part_str(part):
+ONES = ["", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten",
+		"eleven", "twelve", "thirteen", "fourteen", "fifteen", "sixteen", "seventeen", "eighteen", "nineteen"]
+TENS = ["", "", "twenty", "thirty", "forty", "fifty", "sixty", "seventy", "eighty", "ninety"]
+SCALES = [(10 ** 12, "trillion"), (10 ** 9, "billion"), (10 ** 6, "million"), (1000, "thousand"), (100, "hundred")]
+IRREGULAR_ORDINALS = {"one": "first", "two": "second", "three": "third", "five": "fifth",
+					"eight": "eighth", "nine": "ninth", "twelve": "twelfth"}
+
+"""
+returns n > 0 in words, e.g. "two hundred forty-one"
+"""
+def number_words(n):
+	for scale, name in SCALES:
+		if n >= scale:
+			words = number_words(n // scale) + " " + name
+			if n % scale != 0:
+				words += " " + number_words(n % scale)
+			return words
+	if n < 20:
+		return ONES[n]
+	return TENS[n // 10] + ("-" + ONES[n % 10] if n % 10 != 0 else "")
+
+"""
+returns the ordinal of n > 0 in words, e.g. "two hundred forty-first"
+"""
+def ordinal_words(n):
+	words = number_words(n)
+	end = max(words.rfind(" "), words.rfind("-")) + 1
+	last = words[end:]
+	if last in IRREGULAR_ORDINALS:
+		last = IRREGULAR_ORDINALS[last]
+	elif last.endswith("y"):
+		last = last[:-1] + "ieth"
+	else:
+		last += "th"
+	return words[:end] + last
+
+# ordinal words by instance count, filled in as parts are counted further
+ORDINALS = {1: "first", 2: "second", 3: "third", 4: "fourth", 5: "fifth"}
+
+def ordinal(count):
+	words = ORDINALS.get(count)
+	if words is None:
+		words = ORDINALS[count] = ordinal_words(count)
+	return words
+
+"""
+returns the phrase referring to a part in a statement, e.g.
+"base plate" for a unique part or "second screw"
+"""
+def part_phrase(part):
 	if part.is_unique:
-		# part.instance_count = 1
-		# attached_part_counts[part.part_type] = 1
 		return part.part_type
-	
-	# if part.instance_count is None:
-	# 	assert attached_part_counts[part.part_type] < part_counts[part.part_type]
-	# 	attached_part_counts[part.part_type] += 1
-	# 	part.instance_count = attached_part_counts[part.part_type]
-
-	if part.instance_count == 1:
-		return "first " + part.part_type
-	elif part.instance_count == 2:
-		return "second " + part.part_type 
-	elif part.instance_count == 3:
-		return "third " + part.part_type 
-	elif part.instance_count == 4:
-		return "fourth " + part.part_type 
-	elif part.instance_count == 5:
-		return "fifth " + part.part_type 
-	else:
-		return part.part_type + " " + str(part_counts[part.part_type])
+	count = part.instance_count
+	if count is not None and count > 0:
+		return ordinal(count) + " " + part.part_type
+	return part.part_type + " " + str(count)
+
+"""
+caches the phrase of every node in nodes, to be called 
+whenever their instance counts have been (re)assigned
+"""
+def assign_phrases(nodes):
+	for node in nodes:
+		if node.is_fastener or not isinstance(node, ParallelNode):
+			node.phrase = part_phrase(node)
+		else:
+			for part in node.nodes:
+				part.phrase = part_phrase(part)
+
+def get_part_str(part):
+	phrase = part.phrase
+	if phrase is None:
+		# not numbered as part of a traversal, e.g. a parallel node member
+		return part_phrase(part)
+	return phrase
 
 
 class PlacementOp:
@@ -95,15 +181,21 @@ class ParallelPlacementOp:
 		parallelized_parts_str = f"the {', '.join([get_part_str(part) for part in self.parallelized_parts[:-1]])}"
 
 		parallelized_parts_str = parallelized_parts_str.strip()
-		parallelized_parts_str += f", and the {get_part_str(self.parallelized_parts[-1])}"
+		if len(self.parallelized_parts) == 2:
+			parallelized_parts_str += f" and the {get_part_str(self.parallelized_parts[-1])}"
+		else:
+			parallelized_parts_str += f", and the {get_part_str(self.parallelized_parts[-1])}"
 
 		if len(self.parts_in_contact) != 0:
-			parts_in_contact_str = f"the {', '.join([get_part_str(part) for part in self.parts_in_contact[:-1]])}"
-			parts_in_contact_str = parts_in_contact_str.strip()
-			if len(self.parts_in_contact) == 2:
-				parts_in_contact_str += f" and the {get_part_str(self.parts_in_contact[-1])}"
+			if len(self.parts_in_contact) == 1:
+				parts_in_contact_str = f"the {get_part_str(self.parts_in_contact[0])}"
 			else:
-				parts_in_contact_str += f", and the {get_part_str(self.parts_in_contact[-1])}"
+				parts_in_contact_str = f"the {', '.join([get_part_str(part) for part in self.parts_in_contact[:-1]])}"
+				parts_in_contact_str = parts_in_contact_str.strip()
+				if len(self.parts_in_contact) == 2:
+					parts_in_contact_str += f" and the {get_part_str(self.parts_in_contact[-1])}"
+				else:
+					parts_in_contact_str += f", and the {get_part_str(self.parts_in_contact[-1])}"
 
 			return f"align {parallelized_parts_str} with {parts_in_contact_str}\n"
 		else:
@@ -165,6 +257,38 @@ class ParallelAttachmentOp:
 			return f"attach {fasteners_str} to {first_part_str}\n"
 
 
+"""
+Interns part type strings into small integer codes. Nodes keep
+only the code, so counting, uniqueness, ordinals and grouping work
+on ints and all parts of a type share one string, which is only
+looked up again when statements are rendered.
+The table is shared by every graph in the process so codes can be
+compared across graphs, counts are kept per code actually seen
+(dicts keyed by code) so a compile never pays for the types of
+graphs compiled before it.
+"""
+class PartTypeTable:
+	def __init__(self):
+		self.codes = {}
+		self.names = []
+
+	def code(self, part_type):
+		if part_type in self.codes:
+			return self.codes[part_type]
+		code = len(self.names)
+		self.codes[part_type] = code
+		self.names.append(part_type)
+		return code
+
+	def name(self, code):
+		return self.names[code]
+
+	def __len__(self):
+		return len(self.names)
+
+part_types = PartTypeTable()
+
+
 """
 Expected input:
 A disassembly graph
@@ -176,14 +300,24 @@ as children
 """
 
 class Node:
-	def __init__(self, ID, children, parents, is_fastener, part_type, is_unqiue):
+	def __init__(self, ID, children, parents, is_fastener, part_type, is_unique):
 		self.ID = ID
 		self.children = children
 		self.parents = parents
 		self.is_fastener = is_fastener
-		self.part_type = part_type
+		self.part_type_code = part_types.code(part_type)
 		self.instance_count = None # part type occurence number assigned during traversal
-		self.is_unqiue = is_unqiue
+		self.is_unique = is_unique
+		self.phrase = None # cached get_part_str, see assign_phrases
+
+	@property
+	def part_type(self):
+		return part_types.names[self.part_type_code]
+
+	@part_type.setter
+	def part_type(self, part_type):
+		self.part_type_code = part_types.code(part_type)
+		self.phrase = None
 
 	def __str__(self):
 		return f"id {self.ID} {self.part_type}"
@@ -192,26 +326,42 @@ class ParallelNode(Node):
 	def __init__(self, ID, nodes):
 		self.nodes = nodes
 		self.ID = ID		
-		self.children = [child for node in self.nodes for child in node.children]
+		# parts placed in parallel can share children
+		self.children = list({id(child): child for node in self.nodes for child in node.children}.values())
 		# parallelized nodes must have the same set of parents and be the same part type
-		assert all([nodes[0].parents == node.parents for node in self.nodes])
-		assert all([nodes[0].part_type == node.part_type for node in self.nodes])
+		if validation.mode == validation.STRICT:
+			validation.report(validation.check_parallel_group(nodes))
 
 		self.parents = nodes[0].parents
 		self.is_fastener = nodes[0].is_fastener
-		self.part_type = nodes[0].part_type
+		self.part_type_code = nodes[0].part_type_code
+		self.instance_count = None
 		self.is_unique = None
+		self.phrase = None
 
 	def __str__(self):
 		return f"parallel node id {self.ID} {self.part_type}"
 
 
+"""
+adds every node reachable from node to ID2node_map, in depth first
+preorder. The walk keeps an explicit stack of child iterators so deep
+graphs don't hit the recursion limit. Graphs keep their id2node_map up
+to date as they are parallelized and merged, this is only needed for
+maps built from scratch.
+"""
 def get_ID2node_map(node, ID2node_map):
 	if not node.ID in ID2node_map:
 		ID2node_map[node.ID] = node
-	for child in node.children:
-		if not child.ID in ID2node_map:
-			get_ID2node_map(child, ID2node_map)
+	stack = [iter(node.children)]
+	while stack:
+		for child in stack[-1]:
+			if not child.ID in ID2node_map:
+				ID2node_map[child.ID] = child
+				stack.append(iter(child.children))
+				break
+		else:
+			stack.pop()
 
 """
 When a node has a set of children beloning to the same part type and 
@@ -221,29 +371,64 @@ This function will modify the DAG to merge all the children into one node
 ID is the ID to assign the new parallelized node
 contact lists contains for each fastener, all the parts it perforates in
 perforation order
+ID2node_map, when given, is updated in place: the new parallel node is
+added and the merged children no other parent lists anymore are removed
 """
-def parallelize_op(parent_node, children_nodes, ID, contact_lists):
-	# print(f"parallelizing {parent_node.ID} {parent_node.part_type} with children {[node.ID for node in children_nodes]}")
-	# print(contact_lists)
-	assert(all([contact_lists[children_nodes[0].ID] == contact_lists[node.ID] for node in children_nodes]))
-	assert all([children_nodes[0].parents == node.parents for node in children_nodes])
-	# for now assert that the nodes being parallelized only have one parent
-	assert all([children_nodes[0].part_type == node.part_type for node in children_nodes])
+def parallelize_op(parent_node, children_nodes, ID, contact_lists, ID2node_map=None):
+	return parallelize_ops(parent_node, [children_nodes], [ID], contact_lists, ID2node_map)[0]
 
-	contact_lists[ID] = contact_lists[children_nodes[0].ID]
 
-	new_node = ParallelNode(ID, children_nodes)
-	# remove children from parent node that have been  
-	# parallelized and encapsulated into the parallel node
-	parent_node_children = []
-	for child in parent_node.children:
-		if not child in children_nodes:
-			parent_node_children += [child]
-
-	parent_node_children += [new_node]
-	parent_node.children = parent_node_children
+"""
+Same as parallelize_op for several disjoint groups of children of
+the same parent at once, the i-th group becoming a parallel node with
+the i-th ID. The parent's children list is rebuilt a single time, 
+keeping its unmerged children in order followed by the new parallel 
+nodes in group order, exactly as applying parallelize_op group by 
+group would leave it.
+"""
+def parallelize_ops(parent_node, children_groups, IDs, contact_lists, ID2node_map=None):
+	# print(f"parallelizing {parent_node.ID} {parent_node.part_type} with children {[[node.ID for node in group] for group in children_groups]}")
+	merged = set()
+	new_nodes = []
+	for children_nodes, ID in zip(children_groups, IDs):
+		# parallelized fasteners must go through the same parts, every
+		# group is checked once as it is made, the rest of the graph was
+		# checked on ingest
+		if validation.mode != validation.OFF:
+			validation.report(validation.check_parallel_group(children_nodes, contact_lists))
+
+		if children_nodes[0].ID in contact_lists:
+			contact_lists[ID] = contact_lists[children_nodes[0].ID]
+		new_nodes += [ParallelNode(ID, children_nodes)]
+		merged.update([id(node) for node in children_nodes])
 
-	return new_node
+	# remove children from parent node that have been  
+	# parallelized and encapsulated into the parallel nodes
+	parent_node.children = [child for child in parent_node.children if not id(child) in merged] + new_nodes
+
+	# parts placed in parallel are replaced in all their parents, fasteners
+	# only at their immediate parent, where their contact list starts.
+	# Every other parent's children list is rebuilt once for all groups
+	other_parents = {} # id(parent) -> (parent, its new parallel nodes)
+	for new_node in new_nodes:
+		if not new_node.is_fastener:
+			for parent in new_node.parents:
+				if not parent is parent_node:
+					other_parents.setdefault(id(parent), (parent, []))[1].append(new_node)
+	for parent, parent_new_nodes in other_parents.values():
+		parent.children = [child for child in parent.children if not id(child) in merged] + parent_new_nodes
+
+	if ID2node_map is not None:
+		for children_nodes in children_groups:
+			for node in children_nodes:
+				# a fastener through several parts is only merged at its
+				# immediate parent, the others still list it as a child
+				if not node.is_fastener or all([parent is parent_node for parent in node.parents]):
+					del ID2node_map[node.ID]
+		for node in new_nodes:
+			ID2node_map[node.ID] = node
+
+	return new_nodes
 
 
 """
@@ -251,18 +436,19 @@ Given a list of nodes, group ones that perform the same
 operation together. Two nodes perform the same operation 
 if they have the same part type and they share the same
 parent parts.
+Groups are keyed by (is_fastener, part type code, tuple of parent IDs)
+and come out in the order their first node appears in nodes.
 """
 def group_by_operation(nodes):
-	op_types = set()
-	for node in nodes:
-		op_type = (node.is_fastener, node.part_type, '-'.join([str(p.ID) for p in node.parents]))
-		op_types.add(op_type)
 	groups = {}
-	for op_type in op_types:
-		groups[op_type] = []
 	for node in nodes:
-		op_type = (node.is_fastener, node.part_type, '-'.join([str(p.ID) for p in node.parents]))
-		groups[op_type] += [node]
+		op_type = (node.is_fastener, node.part_type_code, tuple([p.ID for p in node.parents]))
+		if op_type in groups:
+			groups[op_type].append(node)
+		else:
+			groups[op_type] = [node]
+	if instrumentation.enabled:
+		instrumentation.count("group_by_operation.groups_formed", len(groups))
 	return groups
 
 
@@ -279,33 +465,86 @@ def is_immediate_parent(node, children, contact_lists):
 	return True
 
 
+"""
+Returns the groups of children of node that can be parallelized
+into one parallel node each, in the order group_by_operation
+gives them
+parallelize_placements: also group identical parts placed on the same
+	parents, e.g. four feet under a base plate, otherwise only fasteners
+"""
+def find_parallel_groups(node, children, contact_lists, parallelize_placements=False):
+	parallel_groups = []
+	for op_type, op_group in group_by_operation(children).items():
+		if len(op_group) < 2:
+			continue
+		# for fasteners that go through multiple parts (i.e. multiple parents), 
+		# the parallelization should happen at their immediate parent 
+		if op_type[0]:
+			if is_immediate_parent(node, op_group, contact_lists):
+				parallel_groups += [op_group]
+		elif parallelize_placements:
+			parallel_groups += [op_group]
+	return parallel_groups
+
+
 """
 Finds where parallelization of operations over parts
 can occur in a graph and mutates it to be parallelized 
 root: root node of DAG
 contact_lists: dict mapping each fastener to the parts it perforates in perforation order
 id_generator: generator to yield new unique IDs to assign to new nodes
+levels_dict: optional precomputed level buckets, e.g. from AssemblyGraph.get_levels
+parallelize_placements: also parallelize identical placements, see 
+	find_parallel_groups
+ID2node_map is kept up to date as nodes are merged, see parallelize_op
+
+Runs a worklist to a fixed point. It starts with every node, bottom up
+so parts have their own children merged before they can be placed in
+parallel, and a merge puts back the nodes whose children it changed:
+the other parents of parts placed in parallel, and the new parallel
+placements, whose children are those of all their parts together. The
+node itself isn't, all its groups were merged at once, and neither are
+parallel fasteners, which have no children. Every merge takes at least
+one child off each parent it puts back, so nodes come back at most as
+often as they lose children and the whole run stays O(V+E) apart from
+the grouping itself.
 """
-def parallelize_where_possible(root, contact_lists, ID2node_map, id_generator):
-	node_levels = {}
-	levels_dict = {}
-	topological_sort(root, node_levels, levels_dict)
+@instrumentation.timed("parallelize_where_possible")
+def parallelize_where_possible(root, contact_lists, ID2node_map, id_generator, levels_dict=None, parallelize_placements=False):
+	if levels_dict is None:
+		node_levels, levels_dict = get_levels(root)
 
 	max_level = max(levels_dict.keys())
-	for level in range(max_level,-1,-1):		
-		level_nodes = levels_dict[level]
-		for nodeID in level_nodes:
-			node = ID2node_map[nodeID]
-			if len(node.children) > 1:
-				op_groups = group_by_operation(node.children)
-				for op_type, op_group in op_groups.items():
-					# for now only parallelize over fasteners 
-					# for fasteners that go through multiple parts (i.e. multiple parents), 
-					# the parallelization should happen at their immediate parent 
-					if len(op_group) > 1 and op_type[0] and is_immediate_parent(node, op_group, contact_lists):
-						parallel_node_ID = next(id_generator)
-						# print(f"parallelizing {op_type} for parent node {node.ID}")
-						parallelize_op(node, op_group, parallel_node_ID, contact_lists)
+	worklist = collections.deque([nodeID for level in range(max_level + 1) for nodeID in levels_dict[level]])
+	queued = set(worklist)
+	requeued = 0
+	while worklist:
+		nodeID = worklist.popleft()
+		queued.discard(nodeID)
+		if not nodeID in ID2node_map:
+			# merged into a parallel node
+			continue
+		node = ID2node_map[nodeID]
+		if len(node.children) < 2:
+			continue
+		parallel_groups = find_parallel_groups(node, node.children, contact_lists, parallelize_placements)
+		if len(parallel_groups) == 0:
+			continue
+
+		parallel_node_IDs = [next(id_generator) for group in parallel_groups]
+		new_nodes = parallelize_ops(node, parallel_groups, parallel_node_IDs, contact_lists, ID2node_map)
+		changed = []
+		for new_node in new_nodes:
+			if not new_node.is_fastener:
+				changed += [parent for parent in new_node.parents if not parent is node] + [new_node]
+		for changed_node in changed:
+			if not changed_node.ID in queued:
+				queued.add(changed_node.ID)
+				worklist.append(changed_node.ID)
+				requeued += 1
+
+	if instrumentation.enabled:
+		instrumentation.count("parallelize_where_possible.requeued", requeued)
 
 
 """
@@ -318,41 +557,69 @@ def count_nodes(root):
 		return 1 + sum([count_nodes(child) for child in self.children])
 
 
+"""
+Assigns each node reachable from root its longest-path level,
+i.e. its height above the leaves, in node_levels, and buckets the 
+node IDs by level in levels_dict.
+Children are walked with an explicit stack and every node is 
+expanded only once, so shared subassemblies reached through many 
+paths cost nothing extra and the sort runs in O(V+E). IDs are 
+appended to their bucket in the same order the recursive walk 
+first finished them.
+"""
+@instrumentation.timed("topological_sort")
 def topological_sort(node, node_levels, levels_dict):
-	if len(node.children) == 0:
-		level = 0
-		node_levels[node.ID] = level
-		if level in levels_dict:
-			if not (node.ID in levels_dict[level]):
-				levels_dict[level] += [node.ID]
+	if node.ID in node_levels:
+		return
+
+	nodes_visited = 0
+	edges_scanned = 0
+	on_stack = {node.ID}
+	stack = [(node, iter(node.children))]
+	while stack:
+		current, children = stack[-1]
+		for child in children:
+			if not child.ID in node_levels:
+				if child.ID in on_stack:
+					raise Exception(f"cycle detected through node {child.ID}")
+				on_stack.add(child.ID)
+				stack.append((child, iter(child.children)))
+				break
 		else:
-			levels_dict[level] = [node.ID]
-	else:
-		for child in node.children:
-			topological_sort(child, node_levels, levels_dict) 
-
-		level = max([node_levels[child.ID] for child in node.children]) + 1
-		node_levels[node.ID] = level
-		if level in levels_dict:
-			if not (node.ID in levels_dict[level]):
-				levels_dict[level] += [node.ID]
-		else:
-			levels_dict[level] = [node.ID]
+			stack.pop()
+			on_stack.discard(current.ID)
+			nodes_visited += 1
+			edges_scanned += len(current.children)
+			if len(current.children) == 0:
+				level = 0
+			else:
+				level = max([node_levels[child.ID] for child in current.children]) + 1
+			node_levels[current.ID] = level
+			if level in levels_dict:
+				levels_dict[level].append(current.ID)
+			else:
+				levels_dict[level] = [current.ID]
 
+	if instrumentation.enabled:
+		instrumentation.count("topological_sort.nodes_visited", nodes_visited)
+		instrumentation.count("topological_sort.edges_scanned", edges_scanned)
+
+
+"""
+returns the node_levels and levels_dict of the DAG rooted at root
+"""
+def get_levels(root):
+	node_levels = {}
+	levels_dict = {}
+	topological_sort(root, node_levels, levels_dict)
+	return node_levels, levels_dict
 
 
 """
 returns the node list with fasteners placed first
 """
 def fasteners_first(nodes):
-	fasteners = []
-	non_fasteners = []
-	for n in nodes:
-		if n.is_fastener:
-			fasteners += [n]
-		else:
-			non_fasteners += [n]
-	return fasteners + non_fasteners
+	return [n for n in nodes if n.is_fastener] + [n for n in nodes if not n.is_fastener]
 
 """
 given the topologically sorted node levels and levels dict,
@@ -362,35 +629,115 @@ levels as possible to be able to assemble more parts, and
 continuing greedily back down the levels from there
 
 Also takes a priority rule for sorting children
+
+Appends the nodes visited to order and their IDs to visited,
+see iter_greedy_order for how the walk works.
 """
+@instrumentation.timed("greedy_order")
 def greedy_order(last_visited_node, visited, order, priority_rule=None):
-	if priority_rule is None:
-		sorted_children = last_visited_node.children
-	else:
-		sorted_children = priority_rule(last_visited_node.children)
-	for child in sorted_children:
-		if can_visit(child, visited) and not child.ID in visited:
-			visited += [child.ID]
-			order += [child]
-			greedy_order(child, visited, order, priority_rule)
+	for node in iter_greedy_order(last_visited_node, visited, priority_rule):
+		visited += [node.ID]
+		order += [node]
+
+
+"""
+Yields the nodes greedy_order visits after last_visited_node one at 
+a time, as the walk reaches them, without keeping the order.
+visited: IDs of the nodes already visited, it is not modified
+
+The walk keeps an explicit stack of child iterators instead of 
+recursing, so deep assemblies don't hit the recursion limit. Each 
+node's parents not yet visited are tracked in a set that shrinks 
+as its parents are visited, so checking whether it can be visited 
+is O(1) instead of a rescan of its parents.
+"""
+def iter_greedy_order(last_visited_node, visited, priority_rule=None):
+	visited_IDs = set(visited)
+	unvisited_parents = {}
+	nodes_visited = 0
+	edges_scanned = len(last_visited_node.children)
+	can_visit_calls = 0
+
+	def sorted_children(node):
+		if priority_rule is None:
+			return iter(node.children)
+		return iter(priority_rule(node.children))
+
+	stack = [sorted_children(last_visited_node)]
+	while stack:
+		for child in stack[-1]:
+			if child.ID in visited_IDs:
+				continue
+			can_visit_calls += 1
+			if child.ID in unvisited_parents:
+				waiting_on = unvisited_parents[child.ID]
+			else:
+				waiting_on = {parent.ID for parent in child.parents if not parent.ID in visited_IDs}
+				unvisited_parents[child.ID] = waiting_on
+			if len(waiting_on) == 0:
+				visited_IDs.add(child.ID)
+				del unvisited_parents[child.ID]
+				for grandchild in child.children:
+					if grandchild.ID in unvisited_parents:
+						unvisited_parents[grandchild.ID].discard(child.ID)
+				if isinstance(child, ParallelNode):
+					# its members are assembled with it: other parents may
+					# still list them, and their children list them as parents
+					for member in child.nodes:
+						visited_IDs.add(member.ID)
+						for grandchild in member.children:
+							if grandchild.ID in unvisited_parents:
+								unvisited_parents[grandchild.ID].discard(member.ID)
+				nodes_visited += 1
+				edges_scanned += len(child.children)
+				yield child
+				stack.append(sorted_children(child))
+				break
+		else:
+			stack.pop()
+
+	if instrumentation.enabled:
+		instrumentation.count("greedy_order.nodes_visited", nodes_visited)
+		instrumentation.count("greedy_order.edges_scanned", edges_scanned)
+		instrumentation.count("greedy_order.can_visit_calls", can_visit_calls)
+
+
+instance_count_key = operator.attrgetter("instance_count")
 
 
 def can_visit(node, visited):
 	return len(node.parents) == 0 or all([parent.ID in visited for parent in node.parents])
 
 
+"""
+Groups parts by type, in the order the types first appear, and
+orders each type's parts by instance count. The counts are fixed by
+assign_instance_counts before any statement is made, so they are
+read straight off the parts: most placements have one part or one
+part per type to align with and need no sorting at all, larger
+groups are sorted on the count read by attrgetter, without calling
+back into python for every comparison.
+"""
 def sort_parts_by_ordinal_number(parts):
+	if len(parts) < 2:
+		return list(parts)
+
 	part_dict = {}
 	for p in parts:
-		if p.part_type in part_dict:
-			part_dict[p.part_type] += [p]
+		code = p.part_type_code
+		if code in part_dict:
+			part_dict[code].append(p)
 		else:
-			part_dict[p.part_type] = [p]
+			part_dict[code] = [p]
+	if len(part_dict) == 1:
+		return sorted(parts, key=instance_count_key)
 
 	sorted_parts = []
-	for p,v in part_dict.items():
-		sorted_parts += sorted(v, key=lambda x: x.instance_count)
-
+	for v in part_dict.values():
+		if len(v) == 1:
+			sorted_parts += v
+		else:
+			sorted_parts += sorted(v, key=instance_count_key)
 	return sorted_parts
 
 
@@ -399,19 +746,17 @@ Program is just an ordered list of statements
 since it doesn't seem to need more complicated 
 structure like an AST for now
 """
+@instrumentation.timed("build_program")
 def build_program(DA_dag, ID2node_map, contact_lists, part_counts, traversal_order=None):
 	program = []
-	node_levels = {}
-	levels_dict = {}
 
 	if traversal_order is None:
-		node_levels = {}
-		levels_dict = {}
-		topological_sort(DA_dag, node_levels, levels_dict)
+		node_levels, levels_dict = get_levels(DA_dag)
 		max_level = max(levels_dict.keys())
 		traversal_order = [ID2node_map[nodeID] for level in range(max_level, -1, -1) for nodeID in levels_dict[level]]
 
 	assign_instance_counts(traversal_order)
+	assign_phrases(traversal_order)
 
 	top_node = traversal_order[0]
 	assert len(top_node.parents) == 0
@@ -419,31 +764,195 @@ def build_program(DA_dag, ID2node_map, contact_lists, part_counts, traversal_ord
 	program += [statement]
 
 	for i, node in enumerate(traversal_order[1:]):
-		if node.is_fastener:
-			parts_touching = contact_lists[node.ID]
-			if isinstance(node, ParallelNode):
-				statement = ParallelAttachmentOp(node.nodes, parts_touching)
-			else:
-				statement = AttachmentOp(node, parts_touching)
-			program += [statement]
-		else:
-			non_fastener_parents = list(filter(lambda x: not x.is_fastener, node.parents))
-			# sort the parts that need to be aligned with this part by their assigned ordinal number
-			non_fastener_parents = sort_parts_by_ordinal_number(non_fastener_parents) 
-			if isinstance(node, ParallelNode):
-				statement = ParallelPlacementOp(node.nodes, non_fastener_parents)
-			else:
-				statement = PlacementOp(node, non_fastener_parents)
-			program += [statement]
+		program += [make_statement(node, contact_lists)]
 
+	if instrumentation.enabled:
+		instrumentation.count("build_program.statements_emitted", len(program))
 	return program
 
 
+"""
+returns the statement that assembles node, assuming instance
+counts have been assigned to the parts it refers to
+"""
+def make_statement(node, contact_lists):
+	if node.is_fastener:
+		parts_touching = contact_lists[node.ID]
+		if isinstance(node, ParallelNode):
+			return ParallelAttachmentOp(node.nodes, parts_touching)
+		else:
+			return AttachmentOp(node, parts_touching)
+	else:
+		non_fastener_parents = list(filter(lambda x: not x.is_fastener, node.parents))
+		# sort the parts that need to be aligned with this part by their assigned ordinal number
+		non_fastener_parents = sort_parts_by_ordinal_number(non_fastener_parents) 
+		if isinstance(node, ParallelNode):
+			return ParallelPlacementOp(node.nodes, non_fastener_parents)
+		else:
+			return PlacementOp(node, non_fastener_parents)
+
+
+"""
+Lazy build_program: yields the same statements one at a time as
+traversal_order, which can be any iterable of nodes such as an
+iter_greedy_order walk, advances. Instance counts and phrases are
+assigned to each node as it comes, so the program is never built
+as a whole:
+
+	order = itertools.chain([root], iter_greedy_order(root, [root.ID], fasteners_first))
+	write_program(iter_program(root, id2node_map, contact_lists, part_counts, order), sys.stdout)
+
+A statement can only be made once every part it refers to has been
+numbered. That is always so for a topological order, which visits
+parents first, for any other order statements wait in a queue until
+their parts come along, so the output is still that of build_program.
+Parts are only remembered as numbered until the statements of all
+their children have been made, so besides the traversal's own
+visited set, memory is bounded by the frontier of the traversal
+rather than by the size of the program.
+"""
+def iter_program(DA_dag, ID2node_map, contact_lists, part_counts, traversal_order=None):
+	if traversal_order is None:
+		node_levels, levels_dict = get_levels(DA_dag)
+		max_level = max(levels_dict.keys())
+		traversal_order = (ID2node_map[nodeID] for level in range(max_level, -1, -1) for nodeID in levels_dict[level])
+
+	attached_part_counts = {}
+	numbered = {} # ID of a counted node -> children it still has to be referred to by
+	waiting = collections.deque()
+	statements_emitted = 0
+
+	def make_next_statement():
+		node = waiting.popleft()
+		for parent in node.parents:
+			if parent.ID in numbered:
+				numbered[parent.ID] -= 1
+				if numbered[parent.ID] <= 0:
+					del numbered[parent.ID]
+		return make_statement(node, contact_lists)
+
+	for node in traversal_order:
+		for part in counted_parts(node):
+			code = part.part_type_code
+			part.instance_count = attached_part_counts[code] = attached_part_counts.get(code, 0) + 1
+			part.phrase = part_phrase(part)
+			if len(part.children) != 0:
+				numbered[part.ID] = len(part.children)
+
+		if statements_emitted == 0:
+			assert len(node.parents) == 0
+			statements_emitted += 1
+			yield PlacementOp(node, [])
+			continue
+
+		waiting.append(node)
+		while len(waiting) != 0 and all([part.ID in numbered for part in referenced_parts(waiting[0], contact_lists)]):
+			statements_emitted += 1
+			yield make_next_statement()
+
+	# parts never numbered keep the counts they had, as in build_program
+	while len(waiting) != 0:
+		statements_emitted += 1
+		yield make_next_statement()
+
+	if instrumentation.enabled:
+		instrumentation.count("build_program.statements_emitted", statements_emitted)
+
+
+"""
+returns the parts the statement assembling node refers to besides node
+"""
+def referenced_parts(node, contact_lists):
+	if node.is_fastener:
+		return contact_lists[node.ID]
+	return [parent for parent in node.parents if not parent.is_fastener]
+
+
+"""
+returns the parts a statement refers to as two lists: the parts
+being placed or fastened, and the parts they are placed against
+or fastened to
+"""
+def statement_parts(statement):
+	if isinstance(statement, PlacementOp):
+		return [statement.part], statement.parts_in_contact
+	elif isinstance(statement, ParallelPlacementOp):
+		return statement.parallelized_parts, statement.parts_in_contact
+	elif isinstance(statement, AttachmentOp):
+		return [statement.fastener], statement.parts
+	else:
+		return statement.parallelized_fasteners, statement.parts
+
+
+@instrumentation.timed("get_program_str")
 def get_program_str(program):
-	program_str = ""
+	return "".join(iter_program_lines(program))
+
+
+"""
+Yields the rendered program piece by piece, normally one statement 
+per piece. The pieces concatenate to exactly what the old 
+program_str += statement.print() loop followed by .strip() gave:
+leading whitespace of the program is dropped, and the trailing
+whitespace of the last statement is held back and dropped at the end.
+program can be any iterable of statements, including a generator.
+"""
+def iter_program_lines(program):
+	pending = ""
 	for statement in program:
-		program_str += statement.print()
-	return program_str.strip()
+		text = statement.print()
+		if pending == "":
+			text = text.lstrip()
+		elif not (text == "" or text.isspace()):
+			yield pending
+			pending = ""
+		pending += text
+	if pending != "":
+		yield pending.rstrip()
+
+
+"""
+returns whether fileobj takes bytes rather than str: binary io
+classes, or wrappers such as tempfile's whose mode says so
+"""
+def is_binary_sink(fileobj):
+	if isinstance(fileobj, io.TextIOBase):
+		return False
+	if isinstance(fileobj, (io.RawIOBase, io.BufferedIOBase)):
+		return True
+	mode = getattr(fileobj, "mode", None)
+	return isinstance(mode, str) and "b" in mode
+
+
+"""
+Streams the rendered program to fileobj, which can be a text sink
+(file opened with "w", sys.stdout, io.StringIO) or a binary one
+(file opened with "wb", socket.makefile("wb")). Writes are batched
+into chunks of about buffer_size characters.
+binary: whether fileobj takes bytes, found by is_binary_sink if None
+Returns the number of characters written.
+"""
+@instrumentation.timed("write_program")
+def write_program(program, fileobj, encoding="utf-8", buffer_size=1 << 16, binary=None):
+	if binary is None:
+		binary = is_binary_sink(fileobj)
+	written = 0
+	chunk = []
+	chunk_size = 0
+	for line in iter_program_lines(program):
+		chunk.append(line)
+		chunk_size += len(line)
+		if chunk_size >= buffer_size:
+			text = "".join(chunk)
+			fileobj.write(text.encode(encoding) if binary else text)
+			written += chunk_size
+			chunk = []
+			chunk_size = 0
+	if chunk_size != 0:
+		text = "".join(chunk)
+		fileobj.write(text.encode(encoding) if binary else text)
+		written += chunk_size
+	return written
 
 """
 For now, to differentiate between sets of identical parts that have 
@@ -459,12 +968,11 @@ def init_attached_part_counts(part_counts):
 
 """
 Applies the func to every node in the graph in 
-topological order
+topological order, optionally using precomputed level buckets
 """
-def graph_walker(DA_dag, ID2node_map, func):
-	node_levels = {}
-	levels_dict = {}
-	topological_sort(DA_dag, node_levels, levels_dict)
+def graph_walker(DA_dag, ID2node_map, func, levels_dict=None):
+	if levels_dict is None:
+		node_levels, levels_dict = get_levels(DA_dag)
 	max_level = max(levels_dict.keys())
 	for level in range(max_level,-1,-1):
 		levelIDs = levels_dict[level]
@@ -476,27 +984,69 @@ def graph_walker(DA_dag, ID2node_map, func):
 Make graph2 the child of the given parent node from graph1
 """
 def merge_graphs(graph1info, graph2info, parent_node):
-	
 	graph1nodes, graph1root, graph1contact_lists = graph1info
 	graph2nodes, graph2root, graph2contact_lists = graph2info
 
-	parent_node.children += [graph2root]
-	assert len(graph2root.parents) == 0
-	graph2root.parents = [parent_node]
-
-	graph2_starting_id = max(graph1nodes.keys()) + 1
+	merged = merge_many_graphs((graph1nodes, graph1root, graph1contact_lists, None),
+								[((graph2nodes, graph2root, graph2contact_lists, None), parent_node)])
+	return merged[:3]
 
-	def increment_id(node):
-		node.ID += graph2_starting_id
 
-	graph_walker(graph2root, graph2nodes, increment_id)
-
-	for key, value in graph2contact_lists.items():
-		print(f"node id {key} touches {[str(p) for p in value]}")
-		graph1contact_lists[key+graph2_starting_id] = value
+"""
+Makes each of many subgraphs the child of its attach point in one go.
+graph1info: (ID2node_map, root, contact_lists, part_counts) of the graph merged into
+attachments: list of (graph2info, parent_node) where graph2info has the same
+	form as graph1info and parent_node is a node of graph1 or of a subgraph
+	earlier in the list
+
+Each subgraph's IDs are shifted by an offset computed up front from the 
+largest ID of everything before it, giving the same IDs as merging the 
+subgraphs one at a time, and the nodes, contact lists and part counts are
+added into graph1's dicts. When the part counts are known (not None) 
+is_unique is updated for the part types the merge made repeated.
+Runs in time linear in the total size of the subgraphs.
+returns graph1info with the subgraphs merged in
+"""
+def merge_many_graphs(graph1info, attachments):
+	graph1nodes, graph1root, graph1contact_lists, graph1part_counts = graph1info
+
+	starting_ids = []
+	next_id = max(graph1nodes.keys()) + 1
+	for (graph2nodes, graph2root, graph2contact_lists, graph2part_counts), parent_node in attachments:
+		starting_ids += [next_id]
+		next_id += max(graph2nodes.keys()) + 1
+
+	repeated_types = set()
+	for ((graph2nodes, graph2root, graph2contact_lists, graph2part_counts), parent_node), graph2_starting_id in zip(attachments, starting_ids):
+		assert len(graph2root.parents) == 0
+		parent_node.children += [graph2root]
+		graph2root.parents = [parent_node]
+
+		# the keys are read before any node ID changes
+		shifted = set()
+		for key, node in list(graph2nodes.items()):
+			graph1nodes[key + graph2_starting_id] = node
+			for shifted_node in [node] + (node.nodes if isinstance(node, ParallelNode) else []):
+				if not id(shifted_node) in shifted:
+					shifted.add(id(shifted_node))
+					shifted_node.ID += graph2_starting_id
+
+		for key, value in graph2contact_lists.items():
+			graph1contact_lists[key + graph2_starting_id] = value
+
+		if graph1part_counts is not None and graph2part_counts is not None:
+			for part_type, count in graph2part_counts.items():
+				if part_type in graph1part_counts:
+					repeated_types.add(part_type)
+					graph1part_counts[part_type] += count
+				else:
+					graph1part_counts[part_type] = count
 
-	for key, value in graph2nodes.items():
-		graph1nodes[key+graph2_starting_id] = value
+	if len(repeated_types) != 0:
+		for node in graph1nodes.values():
+			if node.is_unique and node.part_type in repeated_types:
+				node.is_unique = False
+				node.phrase = None
 
-	return graph1nodes, graph1root, graph1contact_lists
+	return graph1nodes, graph1root, graph1contact_lists, graph1part_counts
 
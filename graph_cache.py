@@ -0,0 +1,304 @@
+"""
+on-disk cache of compiled (parsed and parallelized) disassembly graphs
+
+Entries are keyed by a hash of the source json, so an edited assembly
+simply misses and stale entries age out. Each entry is one binary file:
+a small json header followed by 8-byte aligned int64 arrays that are
+read straight out of a memory map when the entry is loaded.
+
+A hit skips validation, so only graphs that were checked, strictly or
+deferred, and found without violations are stored. A graph compiled
+with --validation off is never cached, it could otherwise be served
+to a later strict compile.
+"""
+import gc
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+
+import validation
+from grammar import Node, ParallelNode, part_types
+from json_to_graph import compile_graph
+
+
+# bump whenever the compiled graph or the file layout changes so old entries miss
+CACHE_FORMAT_VERSION = 1
+MAGIC = b"WIGC"
+HEADER = struct.Struct("<4sIQ") # magic, format version, metadata length
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+ENTRY_SUFFIX = ".wigc"
+
+IS_FASTENER = 1
+IS_UNIQUE = 2
+IS_UNIQUE_UNKNOWN = 4
+IS_PARALLEL = 8
+
+
+"""
+returns the cache key of a json file: a hash of its contents
+and the cache format version
+"""
+def source_hash(json_file):
+	h = hashlib.sha256(f"wigc-{CACHE_FORMAT_VERSION}\n".encode())
+	with open(json_file, "rb") as f:
+		for chunk in iter(lambda: f.read(1 << 20), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+"""
+serializes a compiled graph to bytes
+every node reachable through id2node_map, children, parents, parallel
+node members and contact lists is written, so ParallelNode groupings
+and the nodes they merged survive the round trip
+"""
+def encode_graph(root, id2node_map, contact_lists, part_counts):
+	nodes = []
+	index_of = {}
+
+	def add(node):
+		if not id(node) in index_of:
+			index_of[id(node)] = len(nodes)
+			nodes.append(node)
+
+	for node in id2node_map.values():
+		add(node)
+	for contact_list in contact_lists.values():
+		for part in contact_list:
+			add(part)
+	i = 0
+	while i < len(nodes):
+		node = nodes[i]
+		for other in node.children:
+			add(other)
+		for other in node.parents:
+			add(other)
+		if isinstance(node, ParallelNode):
+			for other in node.nodes:
+				add(other)
+		i += 1
+
+	type_names = []
+	type_codes = {}
+	ids = array("q")
+	flags = array("q")
+	codes = array("q")
+	for node in nodes:
+		if not isinstance(node.ID, int):
+			raise Exception(f"graph cache requires integer node IDs, got {node.ID!r}")
+		if not node.part_type in type_codes:
+			type_codes[node.part_type] = len(type_names)
+			type_names.append(node.part_type)
+		flag = 0
+		if node.is_fastener:
+			flag |= IS_FASTENER
+		if node.is_unique is None:
+			flag |= IS_UNIQUE_UNKNOWN
+		elif node.is_unique:
+			flag |= IS_UNIQUE
+		if isinstance(node, ParallelNode):
+			flag |= IS_PARALLEL
+		ids.append(node.ID)
+		flags.append(flag)
+		codes.append(type_codes[node.part_type])
+
+	def csr(lists):
+		offsets = array("q", [0])
+		indices = array("q")
+		for nodes_list in lists:
+			indices.extend([index_of[id(other)] for other in nodes_list])
+			offsets.append(len(indices))
+		return offsets, indices
+
+	child_offsets, child_indices = csr([node.children for node in nodes])
+	parent_offsets, parent_indices = csr([node.parents for node in nodes])
+	member_offsets, member_indices = csr([node.nodes if isinstance(node, ParallelNode) else [] for node in nodes])
+	contact_offsets, contact_indices = csr(contact_lists.values())
+	contact_ids = array("q", contact_lists.keys())
+	map_indices = array("q", [index_of[id(node)] for node in id2node_map.values()])
+
+	sections = [("ids", ids), ("flags", flags), ("codes", codes),
+				("child_offsets", child_offsets), ("child_indices", child_indices),
+				("parent_offsets", parent_offsets), ("parent_indices", parent_indices),
+				("member_offsets", member_offsets), ("member_indices", member_indices),
+				("contact_ids", contact_ids), ("contact_offsets", contact_offsets), ("contact_indices", contact_indices),
+				("map_indices", map_indices)]
+
+	offset = 0
+	layout = {}
+	for name, values in sections:
+		layout[name] = [offset, len(values)]
+		offset += len(values) * 8
+
+	meta = json.dumps({
+		"part_types": type_names,
+		"part_counts": list(part_counts.items()),
+		"root": index_of[id(root)],
+		"sections": layout,
+	}).encode()
+	meta += b" " * (-(HEADER.size + len(meta)) % 8)
+
+	body = b"".join([values.tobytes() for name, values in sections])
+	return HEADER.pack(MAGIC, CACHE_FORMAT_VERSION, len(meta)) + meta + body
+
+
+"""
+rebuilds the Node graph from an encoded buffer (bytes or an mmap)
+returns root, id2node_map, contact_lists, part_counts
+Nodes are made without their constructors, the entry already holds
+everything they compute, and with the garbage collector paused since
+none of the many objects made can be garbage yet.
+"""
+def decode_graph(buf):
+	view = memoryview(buf)
+	magic, version, meta_len = HEADER.unpack_from(view, 0)
+	if magic != MAGIC or version != CACHE_FORMAT_VERSION:
+		raise Exception("not a compiled graph of the current cache format")
+	meta = json.loads(bytes(view[HEADER.size:HEADER.size + meta_len]))
+	body_start = HEADER.size + meta_len
+
+	arrays = {}
+	try:
+		for name, (offset, length) in meta["sections"].items():
+			start = body_start + offset
+			with view[start:start + length * 8] as section, section.cast("q") as values:
+				arrays[name] = values.tolist()
+	finally:
+		view.release()
+
+	gc_was_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		# the entry's own type codes, interned once per type rather than per node
+		type_codes = [part_types.code(name) for name in meta["part_types"]]
+		new_node = Node.__new__
+		nodes = []
+		for ID, flag, code in zip(arrays["ids"], arrays["flags"], arrays["codes"]):
+			node = new_node(ParallelNode if flag & IS_PARALLEL else Node)
+			node.__dict__.update(ID=ID, children=None, parents=None, is_fastener=bool(flag & IS_FASTENER),
+								part_type_code=type_codes[code], instance_count=None,
+								is_unique=None if flag & IS_UNIQUE_UNKNOWN else bool(flag & IS_UNIQUE), phrase=None)
+			nodes.append(node)
+
+		def lists(offsets_name, indices_name):
+			offsets = arrays[offsets_name]
+			indices = list(map(nodes.__getitem__, arrays[indices_name]))
+			return [indices[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+		for node, children, parents in zip(nodes, lists("child_offsets", "child_indices"), lists("parent_offsets", "parent_indices")):
+			node.children = children
+			node.parents = parents
+		for node, members in zip(nodes, lists("member_offsets", "member_indices")):
+			if type(node) is ParallelNode:
+				node.nodes = members
+
+		contact_lists = dict(zip(arrays["contact_ids"], lists("contact_offsets", "contact_indices")))
+		id2node_map = {}
+		for i in arrays["map_indices"]:
+			id2node_map[nodes[i].ID] = nodes[i]
+		root = nodes[meta["root"]]
+		part_counts = dict(meta["part_counts"])
+	finally:
+		if gc_was_enabled:
+			gc.enable()
+
+	return root, id2node_map, contact_lists, part_counts
+
+
+"""
+returns the compiled graph for json_file from the cache in cache_dir,
+compiling and storing it on a miss. Entries are evicted least recently
+used first whenever the cache grows past max_bytes.
+Graphs compiled with parallelize_placements are cached separately.
+Graphs are only stored when validation found no violations in them.
+stream: compile misses with the streaming json parser, see compile_graph
+"""
+def load_or_compile(json_file, cache_dir, max_bytes=DEFAULT_MAX_BYTES, parallelize_placements=False, stream=False):
+	os.makedirs(cache_dir, exist_ok=True)
+	key = source_hash(json_file) + ("-placements" if parallelize_placements else "")
+	path = os.path.join(cache_dir, key + ENTRY_SUFFIX)
+
+	graph = load_entry(path)
+	if graph is not None:
+		return graph
+
+	deferred = len(validation.deferred_violations)
+	graph = compile_graph(json_file, parallelize_placements, stream)
+	# strict mode raised on any violation already
+	if validation.mode != validation.OFF and len(validation.deferred_violations) == deferred:
+		store_entry(path, encode_graph(*graph))
+		evict(cache_dir, max_bytes, keep=path)
+	return graph
+
+
+"""
+returns the cached graph stored at path, or None if there is no
+usable entry. Hits are touched so eviction sees them as recently used.
+"""
+def load_entry(path):
+	try:
+		with open(path, "rb") as f:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+				graph = decode_graph(buf)
+	except FileNotFoundError:
+		return None
+	except Exception:
+		# truncated or from an older format - drop it and recompile
+		remove_entry(path)
+		return None
+	try:
+		os.utime(path)
+	except FileNotFoundError:
+		# evicted by another process sharing the cache, the graph is still good
+		pass
+	return graph
+
+
+def store_entry(path, data):
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.replace(tmp_path, path)
+	except BaseException:
+		remove_entry(tmp_path)
+		raise
+
+
+def remove_entry(path):
+	try:
+		os.remove(path)
+	except FileNotFoundError:
+		pass
+
+
+"""
+deletes the least recently used entries until the cache
+fits in max_bytes, never deleting keep
+"""
+def evict(cache_dir, max_bytes, keep=None):
+	entries = []
+	total = 0
+	with os.scandir(cache_dir) as it:
+		for entry in it:
+			if entry.name.endswith(ENTRY_SUFFIX):
+				try:
+					stat = entry.stat()
+				except FileNotFoundError:
+					# just evicted by another process sharing the cache
+					continue
+				entries.append((stat.st_mtime, entry.path, stat.st_size))
+				total += stat.st_size
+
+	entries.sort()
+	for mtime, path, size in entries:
+		if total <= max_bytes:
+			break
+		if path == keep:
+			continue
+		remove_entry(path)
+		total -= size
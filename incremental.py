@@ -0,0 +1,502 @@
+"""
+incremental recompilation of assembly instructions
+
+IncrementalCompiler keeps the previous compile of an assembly: the
+node records, the graph, the traversal order and the rendered program.
+When the json changes it diffs the new records against the old ones
+and only redoes the work the edit actually touches.
+
+Edits that only change the part type of non-fastener parts (the common
+"engineering renamed a part" case) keep the graph and traversal order.
+Only the ordinals of the affected part types are renumbered, and only
+the statements that refer to a part whose phrase changed are rebuilt
+and re-rendered.
+
+Edits that add, remove or rewire parts are applied in place when they
+stay inside one region of the graph, as partition.py has them: a base
+part with everything below it, when nothing below it depends on parts
+outside of it. Taking a screw out, adding one or replacing a bracket
+with its screws are such edits. The greedy traversal visits a region
+right after its base and in the same order whatever came before, so
+only the region is built again from its records, parallelized and
+traversed from its base, and its block of statements is replaced. The
+ordinals of the part types it counts are renumbered from the region on,
+or from the start for a type whose uniqueness changed, and statements
+outside the region are rebuilt only when a part they refer to changed
+phrase. The base is the first part, walking up first parents from an
+edited part, whose region holds the edit both before and after it.
+
+Any other edit, one changing the parts a region hangs from, moving
+parts in or out of a region or adding fasteners through parts outside
+of it, rebuilds the graph, as does an edit no region within
+MAX_BASE_SEARCH parts up holds. So do records the region checks find
+malformed, for the whole graph to be validated. Even then, statements whose rendering
+inputs are unchanged reuse their previous text.
+
+Whatever the edit, diffing the records is a pass over all of them, and
+an edit that changes how many statements a region has shifts the
+positions of the statements after it, a pass over plain ints. Past
+that an update costs time in proportion to the region and to the parts
+of its types after it, not to the whole assembly.
+"""
+import itertools
+import json
+from bisect import bisect_left
+
+from grammar import *
+from json_to_graph import infer_part_type_from_name, records2graph
+from partition import outside_parts, region_nodes
+
+
+# how many parts up from an edited part to look for a region base
+MAX_BASE_SEARCH = 8
+
+
+"""
+the parts of a node record that the compiled program depends on
+"""
+def record_signature(node_info):
+	fastened_parts = node_info.get("fastened_parts")
+	return (infer_part_type_from_name(node_info["name"]),
+			bool(node_info["is_fastener"]),
+			tuple(node_info["children"]),
+			tuple(node_info["parents"]),
+			tuple(fastened_parts) if node_info["is_fastener"] else None)
+
+
+"""
+everything about a statement that its rendered text depends on
+"""
+def render_key(statement):
+	primary, others = statement_parts(statement)
+	return (type(statement).__name__,
+			tuple([(p.ID, p.part_type, p.is_unique, p.instance_count) for p in primary]),
+			tuple([(p.ID, p.part_type, p.is_unique, p.instance_count) for p in others]))
+
+
+"""
+returns the IDs of the parts below base in the region the records
+described by signatures give it, in breadth first order, or None if
+there is no such region or its records are malformed: edges only one
+side lists, cycles, or fasteners through parts outside the region or
+out of contact order
+"""
+def new_region_IDs(base, signatures):
+	outside = set([part.ID for part in outside_parts(base)])
+	inside = set()
+	queue = [base.ID]
+	for ID in queue:
+		for child in signatures[ID][2]:
+			if child in outside or not child in signatures or not ID in signatures[child][3]:
+				return None
+			if not child in inside:
+				inside.add(child)
+				queue.append(child)
+	IDs = queue[1:]
+
+	waiting = {} # ID -> parents in the region not yet reached, to find cycles
+	for ID in IDs:
+		part_type, is_fastener, children, parents, fastened_parts = signatures[ID]
+		for parent in parents:
+			if not (parent in inside or parent in outside) or not ID in signatures[parent][2]:
+				return None
+		waiting[ID] = len([parent for parent in parents if parent in inside])
+		if is_fastener:
+			# parallelized at their immediate parent, which has to be in the region
+			if len(fastened_parts) == 0 or not (fastened_parts[0] in inside or fastened_parts[0] == base.ID):
+				return None
+			listed = set()
+			for part in fastened_parts:
+				if not (part in inside or part in outside) or not listed.isdisjoint(signatures[part][3]):
+					return None
+				listed.add(part)
+	reached = [ID for ID in IDs if waiting[ID] == 0]
+	for ID in reached:
+		for child in signatures[ID][2]:
+			waiting[child] -= 1
+			if waiting[child] == 0:
+				reached.append(child)
+	if len(reached) != len(IDs):
+		return None
+	return IDs
+
+
+class IncrementalCompiler:
+	def __init__(self):
+		self.signatures = {} # node ID -> record_signature of its last compiled record
+		self.graph = None # root, id2node_map, contact_lists, part_counts
+		self.nodes = {} # node ID -> node of its record, parallelized or not
+		self.contacted_by = {} # node ID -> IDs of the fasteners that go through it
+		self.id_generator = None # for the IDs of new parallel nodes
+		self.order = []
+		self.program = []
+		self.lines = [] # rendered text of each statement in program
+		self.position = {} # node ID -> index of its statement in program / order
+		self.referenced_by = {} # node ID -> IDs of the nodes whose statements mention it
+		self.type_positions = {} # part type -> sorted order positions of nodes of that type
+		self.rebuilds = 0 # updates that compiled the whole graph
+
+	def program_str(self):
+		return "".join(self.lines).strip()
+
+	"""
+	compiles the json file, reusing as much of the previous compile
+	as the edit allows. returns the indices of the statements that
+	were (re)emitted
+	"""
+	def update(self, json_file):
+		with open(json_file, "r") as f:
+			records = json.load(f)
+		return self.update_records(records)
+
+	def update_records(self, records):
+		signatures = {node_info["id"]: record_signature(node_info) for node_info in records}
+
+		try:
+			if self.graph is not None:
+				emitted = self.update_in_place(signatures)
+				if emitted is not None:
+					self.signatures = signatures
+					return emitted
+			self.signatures = signatures
+			return self.rebuild(records)
+		except Exception:
+			# a compile that failed half way leaves nothing to reuse
+			self.graph = None
+			raise
+
+	"""
+	applies the edit from the last compiled records to signatures to
+	the compile, returns the indices of the statements (re)emitted or
+	None if the edit needs a full compile
+	"""
+	def update_in_place(self, signatures):
+		added = set([ID for ID in signatures if not ID in self.signatures])
+		removed = set([ID for ID in self.signatures if not ID in signatures])
+		changed = [ID for ID, signature in signatures.items() if ID in self.signatures and signature != self.signatures[ID]]
+		if len(added) == 0 and len(removed) == 0:
+			if len(changed) == 0:
+				return []
+			if self.only_part_types_changed(changed, signatures):
+				return self.retype(changed, signatures)
+
+		edited = list(removed) + changed
+		if len(edited) == 0:
+			return None
+		node = self.nodes[edited[0]]
+		for i in range(MAX_BASE_SEARCH):
+			if len(node.parents) == 0:
+				return None
+			if not node.is_fastener:
+				region = self.find_region_edit(node, signatures, added, removed, changed)
+				if region is not None:
+					return self.replace_region(node, region, signatures)
+			node = node.parents[0]
+		return None
+
+	def only_part_types_changed(self, changed, signatures):
+		id2node_map = self.graph[1]
+		for ID in changed:
+			old, new = self.signatures[ID], signatures[ID]
+			if old[1:] != new[1:] or old[1] or not ID in id2node_map:
+				return False
+		return True
+
+	"""
+	full compile of the records; statements whose render key
+	is unchanged reuse their previous text
+	"""
+	def rebuild(self, records):
+		self.rebuilds += 1
+		old_text = {}
+		for statement, line in zip(self.program, self.lines):
+			old_text[render_key(statement)] = line
+		old_lines = self.lines
+
+		root, id2node_map, contact_lists, part_counts = records2graph(records)
+		self.nodes = dict(id2node_map)
+		self.contacted_by = {}
+		for fastener_ID, contact_list in contact_lists.items():
+			for part in contact_list:
+				self.contacted_by.setdefault(part.ID, set()).add(fastener_ID)
+		# as parallelize_graph, but parallel nodes count down from -1, out
+		# of the way of the IDs that records added later are given
+		self.id_generator = itertools.count(-1, -1)
+		parallelize_where_possible(root, contact_lists, id2node_map, self.id_generator)
+		self.graph = root, id2node_map, contact_lists, part_counts
+		self.order = [root]
+		greedy_order(root, [root.ID], self.order, fasteners_first)
+		self.program = build_program(root, id2node_map, contact_lists, part_counts, self.order)
+
+		self.lines = []
+		emitted = []
+		for i, statement in enumerate(self.program):
+			key = render_key(statement)
+			if key in old_text:
+				line = old_text[key]
+			else:
+				line = statement.print()
+			if i >= len(old_lines) or old_lines[i] != line:
+				emitted += [i]
+			self.lines += [line]
+
+		self.index_program()
+		return emitted
+
+	def index_program(self):
+		self.position = {node.ID: i for i, node in enumerate(self.order)}
+		self.referenced_by = {}
+		for node, statement in zip(self.order, self.program):
+			self.add_references(node, statement)
+		self.type_positions = {}
+		for i, node in enumerate(self.order):
+			if node.part_type in self.type_positions:
+				self.type_positions[node.part_type] += [i]
+			else:
+				self.type_positions[node.part_type] = [i]
+
+	def add_references(self, node, statement):
+		primary, others = statement_parts(statement)
+		for part in primary + others:
+			if part.ID in self.referenced_by:
+				self.referenced_by[part.ID].add(node.ID)
+			else:
+				self.referenced_by[part.ID] = set([node.ID])
+
+	"""
+	renumbers the nodes of part_type in the order from its first_count-th
+	on, adding the IDs of those whose phrase changed to changed
+	"""
+	def renumber(self, part_type, first_count, changed):
+		part_counts = self.graph[3]
+		is_unique = part_counts.get(part_type, 0) == 1
+		positions = self.type_positions.get(part_type, [])
+		for count in range(first_count, len(positions) + 1):
+			node = self.order[positions[count - 1]]
+			if isinstance(node, ParallelNode):
+				node_is_unique = node.is_unique
+			else:
+				node_is_unique = is_unique
+			if node.instance_count != count or node.is_unique != node_is_unique:
+				node.instance_count = count
+				node.is_unique = node_is_unique
+				changed.add(node.ID)
+			node.phrase = part_phrase(node)
+
+	"""
+	rebuilds and re-renders the statements at the given indices,
+	returns them sorted
+	"""
+	def remake_statements(self, indices):
+		contact_lists = self.graph[2]
+		indices = sorted(indices)
+		for i in indices:
+			if i == 0:
+				statement = PlacementOp(self.order[0], [])
+			else:
+				statement = make_statement(self.order[i], contact_lists)
+			self.program[i] = statement
+			self.lines[i] = statement.print()
+		return indices
+
+	def referencing_positions(self, changed):
+		return set([self.position[node_ID] for ID in changed for node_ID in self.referenced_by.get(ID, [])])
+
+	"""
+	applies part type changes of non-fastener parts in place:
+	renumbers the ordinals of the affected types and rebuilds the
+	statements mentioning a part whose phrase changed
+	"""
+	def retype(self, changed, signatures):
+		root, id2node_map, contact_lists, part_counts = self.graph
+		affected_types = set()
+		for ID in changed:
+			node = id2node_map[ID]
+			old_type, new_type = node.part_type, signatures[ID][0]
+			affected_types.update([old_type, new_type])
+
+			part_counts[old_type] -= 1
+			if part_counts[old_type] == 0:
+				del part_counts[old_type]
+			part_counts[new_type] = part_counts.get(new_type, 0) + 1
+
+			i = self.position[ID]
+			positions = self.type_positions[old_type]
+			del positions[bisect_left(positions, i)]
+			if len(positions) == 0:
+				del self.type_positions[old_type]
+			positions = self.type_positions.setdefault(new_type, [])
+			positions.insert(bisect_left(positions, i), i)
+			node.part_type = new_type
+
+		changed = set(changed)
+		for part_type in affected_types:
+			self.renumber(part_type, 1, changed)
+		return self.remake_statements(self.referencing_positions(changed))
+
+	"""
+	returns the region based at base the edit stays inside as its
+	parts in the graph, the IDs of their records and the IDs of the
+	records below base after the edit, or None if the edit doesn't
+	stay inside a region based there
+	"""
+	def find_region_edit(self, base, signatures, added, removed, changed):
+		if base.ID in removed:
+			return None
+		old, new = self.signatures[base.ID], signatures[base.ID]
+		if old[:2] != new[:2] or old[3:] != new[3:]:
+			return None
+		found = region_nodes(base, self.graph[2])
+		if found is None:
+			return None
+		nodes, parallel_nodes = found
+		if any([not node.is_fastener for node in parallel_nodes]):
+			return None
+		old_IDs = set([node.ID for node in nodes[1:] if not isinstance(node, ParallelNode)])
+		for node in parallel_nodes:
+			old_IDs.update([member.ID for member in node.nodes])
+		if not removed <= old_IDs or any([ID != base.ID and not ID in old_IDs for ID in changed]):
+			return None
+		for ID in old_IDs:
+			# fasteners are parallelized at their immediate parent and their
+			# statements refer to the parts they go through, which all have
+			# to be inside
+			fastened_parts = self.signatures[ID][4]
+			if fastened_parts is not None and (len(fastened_parts) == 0 or not (fastened_parts[0] in old_IDs or fastened_parts[0] == base.ID)):
+				return None
+			if not self.contacted_by.get(ID, set()) <= old_IDs:
+				return None
+
+		new_IDs = new_region_IDs(base, signatures)
+		if new_IDs is None:
+			return None
+		# new parts take the place of removed ones or of new parallel nodes
+		id2node_map = self.graph[1]
+		if any([ID in id2node_map and not ID in self.nodes for ID in added]):
+			return None
+		new_set = set(new_IDs)
+		if not added <= new_set or not new_set - old_IDs <= added or not old_IDs - new_set <= removed:
+			return None
+		return nodes, old_IDs, new_IDs
+
+	def new_ID(self):
+		ID = next(self.id_generator)
+		while ID in self.nodes:
+			ID = next(self.id_generator)
+		return ID
+
+	"""
+	replaces the region based at base, as find_region_edit found it,
+	by the one the records described by signatures give it, returns the
+	indices of the statements (re)emitted
+	"""
+	def replace_region(self, base, region, signatures):
+		root, id2node_map, contact_lists, part_counts = self.graph
+		nodes, old_IDs, new_IDs = region
+		old_objects = set([id(node) for node in nodes[1:]])
+		for node in nodes[1:]:
+			if isinstance(node, ParallelNode):
+				old_objects.update([id(member) for member in node.nodes])
+
+		# the region's statements follow the base's
+		start = self.position[base.ID] + 1
+		end = start
+		while end < len(self.order) and id(self.order[end]) in old_objects:
+			end += 1
+		old_block = self.order[start:end]
+		for node, statement in zip(old_block, self.program[start:end]):
+			primary, others = statement_parts(statement)
+			for part in primary + others:
+				self.referenced_by[part.ID].discard(node.ID)
+			del self.position[node.ID]
+
+		old_counts = {}
+		for node in nodes[1:]:
+			if id2node_map.get(node.ID) is node:
+				del id2node_map[node.ID]
+			if isinstance(node, ParallelNode) and node.is_fastener:
+				del contact_lists[node.ID]
+		for ID in old_IDs:
+			part_type = self.nodes[ID].part_type
+			old_counts.setdefault(part_type, part_counts[part_type])
+			part_counts[part_type] -= 1
+			if part_counts[part_type] == 0:
+				del part_counts[part_type]
+			fastened_parts = self.signatures[ID][4]
+			if fastened_parts is not None:
+				del contact_lists[ID]
+				for part in fastened_parts:
+					self.contacted_by[part].discard(ID)
+			self.referenced_by.pop(ID, None)
+			id2node_map.pop(ID, None)
+			del self.nodes[ID]
+		for ID in old_IDs:
+			if ID in self.contacted_by and len(self.contacted_by[ID]) == 0:
+				del self.contacted_by[ID]
+
+		new_nodes = {}
+		for ID in new_IDs:
+			part_type, is_fastener, children, parents, fastened_parts = signatures[ID]
+			new_nodes[ID] = Node(ID, [], [], is_fastener, part_type, None)
+		self.nodes.update(new_nodes)
+		id2node_map.update(new_nodes)
+		for ID, node in new_nodes.items():
+			part_type, is_fastener, children, parents, fastened_parts = signatures[ID]
+			node.children = [self.nodes[child] for child in children]
+			node.parents = [self.nodes[parent] for parent in parents]
+			if is_fastener:
+				contact_lists[ID] = [self.nodes[part] for part in fastened_parts]
+				for part in fastened_parts:
+					self.contacted_by.setdefault(part, set()).add(ID)
+			old_counts.setdefault(part_type, part_counts.get(part_type, 0))
+			part_counts[part_type] = part_counts.get(part_type, 0) + 1
+		for node in new_nodes.values():
+			node.is_unique = part_counts[node.part_type] == 1
+		base.children = [self.nodes[child] for child in signatures[base.ID][2]]
+		for part in base.parents:
+			part.children = [self.nodes[child.ID] if id(child) in old_objects else child for child in part.children]
+
+		# as parallelize_where_possible, which only groups fasteners at
+		# their immediate parent, here always inside the region
+		for node in [base] + list(new_nodes.values()):
+			if len(node.children) > 1:
+				groups = find_parallel_groups(node, node.children, contact_lists)
+				if len(groups) != 0:
+					parallelize_ops(node, groups, [self.new_ID() for group in groups], contact_lists, id2node_map)
+
+		block = list(iter_greedy_order(base, [part.ID for part in outside_parts(base)], fasteners_first))
+		shift = len(block) - len(old_block)
+		self.order[start:end] = block
+		self.program[start:end] = [None] * len(block)
+		self.lines[start:end] = [None] * len(block)
+		for i in range(start, len(self.order) if shift != 0 else start + len(block)):
+			self.position[self.order[i].ID] = i
+
+		block_positions = {}
+		for i, node in enumerate(block, start):
+			block_positions.setdefault(node.part_type, []).append(i)
+		for part_type in set(block_positions.keys()) - set(self.type_positions.keys()):
+			self.type_positions[part_type] = []
+		for part_type, positions in list(self.type_positions.items()):
+			first = bisect_left(positions, start)
+			last = bisect_left(positions, end)
+			if last == len(positions) and first == last and not part_type in block_positions:
+				continue
+			positions[first:] = block_positions.get(part_type, []) + [i + shift for i in positions[last:]]
+			if len(positions) == 0:
+				del self.type_positions[part_type]
+
+		changed = set()
+		for part_type in set(old_counts.keys()):
+			# a type whose uniqueness changed has all its phrases changed
+			if (old_counts[part_type] == 1) != (part_counts.get(part_type, 0) == 1):
+				first_count = 1
+			else:
+				first_count = bisect_left(self.type_positions.get(part_type, []), start) + 1
+			self.renumber(part_type, first_count, changed)
+
+		indices = set(range(start, start + len(block))) | self.referencing_positions(changed)
+		emitted = self.remake_statements(indices)
+		for i in range(start, start + len(block)):
+			self.add_references(self.order[i], self.program[i])
+		return emitted
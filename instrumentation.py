@@ -0,0 +1,93 @@
+"""
+optional per-stage timing and hot path counters for the compiler
+
+Disabled by default. While disabled, a timed stage costs one flag check
+per call, and counters are only flushed by code that has already checked
+the flag. Hot loops keep local tallies and flush them once per call,
+never once per node.
+
+	import instrumentation
+	instrumentation.enable()
+	... compile ...
+	instrumentation.report()          # {"stages": {...}, "counters": {...}}
+	instrumentation.dump_json("timings.json")
+
+Nested stages are each timed in full, e.g. parallelize_where_possible
+includes the topological_sort it runs.
+"""
+import functools
+import json
+import time
+
+
+enabled = False
+stages = {} # stage name -> {"calls", "wall_seconds", "cpu_seconds"}
+counters = {} # counter name -> count
+
+
+def enable():
+	global enabled
+	enabled = True
+
+
+def disable():
+	global enabled
+	enabled = False
+
+
+def reset():
+	stages.clear()
+	counters.clear()
+
+
+def count(name, n=1):
+	if enabled:
+		counters[name] = counters.get(name, 0) + n
+
+
+def record_stage(name, wall_seconds, cpu_seconds):
+	if name in stages:
+		totals = stages[name]
+	else:
+		totals = stages[name] = {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+	totals["calls"] += 1
+	totals["wall_seconds"] += wall_seconds
+	totals["cpu_seconds"] += cpu_seconds
+
+
+"""
+decorator that records the wall and cpu time of every call
+to the decorated function under the given stage name
+"""
+def timed(name):
+	def decorate(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return func(*args, **kwargs)
+			wall_start = time.perf_counter()
+			cpu_start = time.process_time()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				record_stage(name, time.perf_counter() - wall_start, time.process_time() - cpu_start)
+		return wrapper
+	return decorate
+
+
+def report():
+	return {
+		"stages": {name: dict(totals) for name, totals in stages.items()},
+		"counters": dict(counters),
+	}
+
+
+"""
+writes report() as json to a path or an open text file
+"""
+def dump_json(destination, indent=2):
+	if isinstance(destination, str):
+		with open(destination, "w") as f:
+			json.dump(report(), f, indent=indent)
+	else:
+		json.dump(report(), destination, indent=indent)
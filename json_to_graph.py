@@ -1,8 +1,14 @@
 """
 injests json dissassembly info and converts to graph
 """
+import itertools
 import json
+from array import array
+from collections import Counter
+import instrumentation
+import validation
 from grammar import *
+from assembly_graph import AssemblyGraph
 
 
 def infer_part_type_from_name(name):
@@ -15,67 +21,271 @@ def infer_part_type_from_name(name):
 	else:
 		return name
 
-def json2graph(json_file):
-	with open(json_file, "r") as f:
-		data = json.load(f)
+"""
+Builds a disassembly graph one json node record at a time.
+References to nodes whose records have not been seen yet are kept
+in a pending edge table and patched in place once the referenced
+node arrives, so each record can be dropped as soon as it has been
+turned into a node.
+"""
+class GraphBuilder:
+	def __init__(self):
+		self.id2node_map = {}
+		self.pending_edges = {} # node ID -> [(node list, position)] waiting for that node
+		self.contact_lists = {}
+		self.part_type_codes = array("l") # interned part type of every record, in record order
+		self.root = None
 
-	id2node_map = {}
-	for node_info in data:
+	def add_record(self, node_info):
 		nodeID = node_info["id"]
 		# most often for now, the part type will be missing because
 		# we don't have classifiers yet - instead try to infer the 
 		# part type from the part name
 		part_type = infer_part_type_from_name(node_info["name"])
 		is_fastener = node_info["is_fastener"]
-		new_node = Node(nodeID, [], [], is_fastener, part_type, None)
-		id2node_map[nodeID] = new_node
-
-	root = None
-	contact_lists = {}
-	part_counts = {}
+		node = Node(nodeID, [], [], is_fastener, part_type, None)
+		self.id2node_map[nodeID] = node
 
-	for node_info in data:
-		nodeID = node_info["id"]
-		node = id2node_map[nodeID]
-		node.children = [id2node_map[c] for c in node_info["children"]]
-		node.parents = [id2node_map[p] for p in node_info["parents"]]
+		node.children = self.resolve(node_info["children"])
+		node.parents = self.resolve(node_info["parents"])
 
 		if len(node.parents) == 0:
-			root = node
+			self.root = node
 
 		if node.is_fastener:
-			contact_lists[nodeID] = [id2node_map[part] for part in node_info["fastened_parts"]]
-			for i, part in enumerate(contact_lists[nodeID][:-1]):
-				assert all([other_part not in part.children for other_part in contact_lists[nodeID][i+1:]])
+			self.contact_lists[nodeID] = self.resolve(node_info["fastened_parts"])
 
-		if node.part_type in part_counts:
-			part_counts[node.part_type] += 1
-		else:
-			part_counts[node.part_type] = 1
+		self.part_type_codes.append(node.part_type_code)
 
-	for nodeID, node in id2node_map.items():
-		node.is_unique = (part_counts[node.part_type] == 1)
+		for node_list, position in self.pending_edges.pop(nodeID, []):
+			node_list[position] = node
 
-	return root, id2node_map, contact_lists, part_counts
+	"""
+	returns the nodes for the given IDs, leaving a placeholder
+	to be patched for every ID not seen yet
+	"""
+	def resolve(self, IDs):
+		nodes = [None] * len(IDs)
+		for position, ID in enumerate(IDs):
+			if ID in self.id2node_map:
+				nodes[position] = self.id2node_map[ID]
+			elif ID in self.pending_edges:
+				self.pending_edges[ID].append((nodes, position))
+			else:
+				self.pending_edges[ID] = [(nodes, position)]
+		return nodes
 
+	def finish(self):
+		if len(self.pending_edges) != 0:
+			raise Exception(f"references to missing nodes {list(self.pending_edges.keys())}")
+
+		validation.check_graph(self.root, self.id2node_map, self.contact_lists)
+
+		# count every part type in one pass over the interned codes
+		type_counts = Counter(self.part_type_codes)
+		part_counts = {part_types.name(code): type_counts[code] for code in dict.fromkeys(self.part_type_codes)}
+		for nodeID, node in self.id2node_map.items():
+			node.is_unique = (type_counts[node.part_type_code] == 1)
+
+		if instrumentation.enabled:
+			instrumentation.count("json2graph.nodes_ingested", len(self.id2node_map))
+
+		return self.root, self.id2node_map, self.contact_lists, part_counts
+
+
+@instrumentation.timed("json2graph")
+def json2graph(json_file):
+	with open(json_file, "r") as f:
+		data = json.load(f)
+	return records2graph(data)
+
+
+"""
+builds the disassembly graph from already parsed json node records
+"""
+def records2graph(records):
+	builder = GraphBuilder()
+	for node_info in records:
+		builder.add_record(node_info)
+	return builder.finish()
+
+
+"""
+Yields the elements of a top level json array one at a time,
+reading the file incrementally in chunks so that only the record
+currently being parsed is held in memory
+"""
+def iter_json_records(f, chunk_size=1 << 16):
+	decoder = json.JSONDecoder()
+	buf = ""
+	pos = 0
+	eof = False
+
+	# returns the index of the next non whitespace character,
+	# reading more of the file as needed, or None at end of file
+	def next_token():
+		nonlocal buf, pos, eof
+		while True:
+			while pos < len(buf) and buf[pos].isspace():
+				pos += 1
+			if pos < len(buf) or eof:
+				return pos if pos < len(buf) else None
+			buf = f.read(chunk_size)
+			pos = 0
+			eof = len(buf) == 0
+
+	if next_token() is None or buf[pos] != "[":
+		raise Exception("expected a json array of node records")
+	pos += 1
+
+	if next_token() is not None and buf[pos] == "]":
+		return
+
+	while True:
+		if next_token() is None:
+			raise Exception("unexpected end of file in json array")
+		# decode the next element, reading more whenever it is cut
+		# off by the end of the buffer
+		while True:
+			try:
+				record, end = decoder.raw_decode(buf, pos)
+				if end < len(buf) or eof:
+					break
+			except json.JSONDecodeError:
+				if eof:
+					raise
+			more = f.read(max(chunk_size, len(buf) - pos))
+			eof = len(more) == 0
+			buf = buf[pos:] + more
+			pos = 0
+		pos = end
+		yield record
+
+		if next_token() is None:
+			raise Exception("unexpected end of file in json array")
+		if buf[pos] == "]":
+			return
+		if buf[pos] != ",":
+			raise Exception(f"expected ',' or ']' in json array, found {buf[pos]!r}")
+		pos += 1
 
-if __name__ == "__main__":
-	root, id2node_map, contact_lists, part_counts = json2graph("assembly_info.json")
-	id_generator = IDGen(len(id2node_map))
 
-	parallelize_where_possible(root, contact_lists, id2node_map, id_generator)
-	# make a new id2node map after parallelization to remove nodes merged 
-	# via parallelization and add new parallel node
-	id2node_map = {} 
-	get_ID2node_map(root, id2node_map)
+"""
+Same as json2graph but never holds the whole json document:
+node records are parsed one at a time and discarded once they
+have been turned into nodes, bounding peak memory by the graph 
+itself rather than by the graph plus the raw json
+"""
+@instrumentation.timed("json2graph_streaming")
+def json2graph_streaming(json_file, chunk_size=1 << 16):
+	builder = GraphBuilder()
+	with open(json_file, "r") as f:
+		for node_info in iter_json_records(f, chunk_size):
+			builder.add_record(node_info)
+	return builder.finish()
+
+
+"""
+same as json2graph but returns a compact AssemblyGraph
+instead of Node objects
+"""
+def json2assembly_graph(json_file):
+	with open(json_file, "r") as f:
+		data = json.load(f)
+	return AssemblyGraph.from_records(data, infer_part_type_from_name)
+
+
+"""
+ingests the json disassembly info and parallelizes operations where possible
+returns root, id2node_map, contact_lists, part_counts for build_program
+stream: ingest with json2graph_streaming, which holds less in memory
+"""
+def compile_graph(json_file, parallelize_placements=False, stream=False):
+	graph = json2graph_streaming(json_file) if stream else json2graph(json_file)
+	return parallelize_graph(*graph, parallelize_placements=parallelize_placements)
+
+
+"""
+parallelizes operations in a freshly ingested graph and returns it,
+id2node_map is updated in place to reflect the merged nodes
+parallelize_placements: also place identical parts together, see find_parallel_groups
+"""
+def parallelize_graph(root, id2node_map, contact_lists, part_counts, parallelize_placements=False):
+	id_generator = new_ID_generator(id2node_map)
+
+	# the graph was checked on ingest and every parallel group is checked
+	# as it is made, so a violation is only ever reported once
+	parallelize_where_possible(root, contact_lists, id2node_map, id_generator, parallelize_placements=parallelize_placements)
+
+	return root, id2node_map, contact_lists, part_counts
 
 
+"""
+builds the program for a compiled graph using the greedy
+fasteners first traversal order
+"""
+def build_greedy_program(root, id2node_map, contact_lists, part_counts):
 	visited = [root.ID]
 	order = [root]
 	greedy_order(root, visited, order, fasteners_first)
+	return build_program(root, id2node_map, contact_lists, part_counts, order)
+
+
+"""
+lazy build_greedy_program, yields the statements as the greedy
+traversal reaches them so the first ones can be shown right away
+"""
+def iter_greedy_program(root, id2node_map, contact_lists, part_counts):
+	order = itertools.chain([root], iter_greedy_order(root, [root.ID], fasteners_first))
+	return iter_program(root, id2node_map, contact_lists, part_counts, order)
+
+
+if __name__ == "__main__":
+	import argparse
+	import sys
+	parser = argparse.ArgumentParser(description="compile assembly instructions from json disassembly info")
+	parser.add_argument("json_file", nargs="?", default="assembly_info.json")
+	parser.add_argument("--cache-dir", default=None, help="reuse compiled graphs cached in this directory")
+	parser.add_argument("--timings", default=None, help="write per stage timings and counters as json to this file")
+	parser.add_argument("--parallelize-placements", action="store_true", help="also place identical parts on the same parts together")
+	parser.add_argument("--stream", action="store_true", help="parse the json one record at a time, for assemblies too large to load whole")
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="worker processes compiling independent subassemblies, see partition.py")
+	parser.add_argument("--format", choices=["text", "jsonl", "binary"], default="text", help="write the program in english, as json lines or packed binary, see program_encoding.py")
+	validation.add_mode_argument(parser)
+	args = parser.parse_args()
+	if args.jobs != 1 and args.format != "text":
+		parser.error("--jobs only compiles to text")
+
+	validation.set_mode(args.validation)
+	if args.timings is not None:
+		instrumentation.enable()
 
-	program = build_program(root, id2node_map, contact_lists, part_counts, order)
-	program_str = get_program_str(program)
-	print(program_str)
+	try:
+		if args.cache_dir is None:
+			root, id2node_map, contact_lists, part_counts = compile_graph(args.json_file, args.parallelize_placements, args.stream)
+		else:
+			from graph_cache import load_or_compile
+			root, id2node_map, contact_lists, part_counts = load_or_compile(args.json_file, args.cache_dir, parallelize_placements=args.parallelize_placements, stream=args.stream)
+	finally:
+		violations = validation.take_deferred()
+		if len(violations) != 0:
+			print(validation.format_violations(violations), file=sys.stderr)
 
+	if args.format == "jsonl":
+		from program_encoding import write_program_json
+		write_program_json(iter_greedy_program(root, id2node_map, contact_lists, part_counts), sys.stdout)
+	elif args.format == "binary":
+		from program_encoding import encode_program
+		sys.stdout.flush()
+		sys.stdout.buffer.write(encode_program(iter_greedy_program(root, id2node_map, contact_lists, part_counts)))
+	elif args.jobs == 1:
+		program = iter_greedy_program(root, id2node_map, contact_lists, part_counts)
+		write_program(program, sys.stdout)
+		print()
+	else:
+		from partition import compile_partitioned
+		sys.stdout.write("".join(compile_partitioned(root, id2node_map, contact_lists, part_counts, args.jobs)).strip())
+		print()
 
+	if args.timings is not None:
+		instrumentation.dump_json(args.timings)
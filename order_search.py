@@ -0,0 +1,352 @@
+"""
+search over traversal orders for the cheapest one under a cost model
+
+greedy_order with fasteners_first gives one fixed order. search_order
+starts from that order and keeps improving it until a wall clock budget
+runs out, then returns the best order found, which can be handed
+straight to build_program as its traversal_order:
+
+	order, cost = search_order(root, contact_lists, ToolChanges(), time_budget=5.0)
+	program = build_program(root, id2node_map, contact_lists, part_counts, order)
+
+The search is a beam search over windows of consecutive steps of the
+current order. Inside a window the steps can be reordered in any way the
+parents allow. States that have visited the same steps of the window and
+left the cost model in the same state are equivalent, so only the
+cheapest of them is kept. Several strategies (window size and beam
+width) run in a process pool at the same time and the best order any of
+them reached is kept. Every strategy stops at the deadline with what it
+has, and the order it started from is always a candidate, so the search
+can be stopped at any time. Strategies post every better order they
+reach as they go, so an interrupted search still returns the best of
+them so far, and the workers are told to stop.
+
+Cost models are classes with three methods, see ToolChanges:
+key(node, contact_lists) what about a node the cost depends on, worked
+	out once per node before searching
+start() the state before the first step
+step(state, key) -> (cost of the step, next state)
+Keys and states must be hashable, and cost models picklable so they can
+be sent to the worker processes.
+"""
+import multiprocessing
+import os
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from grammar import ParallelNode, greedy_order, fasteners_first
+
+
+# (window size, beam width) of each strategy
+DEFAULT_STRATEGIES = [(8, 256), (12, 64), (16, 32), (24, 16)]
+
+# where strategies post the better orders they reach, as (cost, order),
+# and the event that stops them, set in the workers by init_worker
+improvements = None
+stop = None
+# seconds between the orders a pass posts before it is done
+POST_INTERVAL = 0.25
+
+
+def init_worker(improvements_queue, stop_event):
+	global improvements, stop
+	improvements = improvements_queue
+	stop = stop_event
+	if stop_event is not None:
+		# orders still unsent once the search stopped are not needed,
+		# don't keep the worker from exiting for them
+		improvements_queue.cancel_join_thread()
+
+
+"""
+returns whether a strategy has to stop: the deadline passed or
+the search was stopped
+"""
+def out_of_time(deadline):
+	return time.time() > deadline or (stop is not None and stop.is_set())
+
+
+"""
+keeps the cheapest order posted, for strategies run in this process
+"""
+class CheapestPosted:
+	def __init__(self):
+		self.cost = None
+		self.order = None
+
+	def put(self, posted):
+		cost, order = posted
+		if self.cost is None or cost < self.cost:
+			self.cost, self.order = cost, order
+
+
+"""
+returns the cheapest of best_order and the orders posted to
+improvements_queue, with its cost
+wait: how long to wait for orders still being sent
+"""
+def best_posted(improvements_queue, best_order, best_cost, wait=0.0):
+	while True:
+		try:
+			cost, order = improvements_queue.get(timeout=wait) if wait > 0 else improvements_queue.get_nowait()
+		except queue.Empty:
+			return best_order, best_cost
+		if cost < best_cost:
+			best_order, best_cost = order, cost
+
+
+"""
+one unit of cost every time the fastener being driven changes type,
+e.g. switching screwdriver bits. Placing parts needs no tool.
+"""
+class ToolChanges:
+	def key(self, node, contact_lists):
+		return node.part_type_code if node.is_fastener else None
+
+	def start(self):
+		return None
+
+	def step(self, state, key):
+		if key is None:
+			return 0, state
+		return (0 if state is None or state == key else 1), key
+
+
+"""
+one unit of cost every time a step works against parts none of which
+the previous step worked against, as a stand-in for having to
+reorient the assembly
+"""
+class WorkpieceChanges:
+	def key(self, node, contact_lists):
+		if node.is_fastener:
+			return frozenset([contact_lists[node.ID][0].ID])
+		return frozenset([parent.ID for parent in node.parents if not parent.is_fastener])
+
+	def start(self):
+		return frozenset()
+
+	def step(self, state, key):
+		if len(state) == 0 or len(key) == 0:
+			return 0, key or state
+		return (0 if state & key else 1), key
+
+
+"""
+weighted sum of several cost models
+"""
+class CombinedCost:
+	def __init__(self, weighted_models):
+		self.weighted_models = weighted_models # list of (weight, cost model)
+
+	def key(self, node, contact_lists):
+		return tuple([model.key(node, contact_lists) for weight, model in self.weighted_models])
+
+	def start(self):
+		return tuple([model.start() for weight, model in self.weighted_models])
+
+	def step(self, state, key):
+		cost = 0
+		next_state = []
+		for (weight, model), model_state, model_key in zip(self.weighted_models, state, key):
+			model_cost, model_state = model.step(model_state, model_key)
+			cost += weight * model_cost
+			next_state.append(model_state)
+		return cost, tuple(next_state)
+
+
+"""
+The nodes of a traversal order renumbered by their position in it,
+with only what the search needs, so it is cheap to send to workers.
+parents[i] are the positions of the parents of the i-th node
+"""
+class OrderProblem:
+	def __init__(self, order, contact_lists, cost_model):
+		position = {}
+		for i, node in enumerate(order):
+			position[id(node)] = i
+			if isinstance(node, ParallelNode):
+				# children of its members list them as parents
+				for member in node.nodes:
+					position[id(member)] = i
+		self.parents = [[position[id(parent)] for parent in node.parents if id(parent) in position] for node in order]
+		self.keys = [cost_model.key(node, contact_lists) for node in order]
+		self.cost_model = cost_model
+
+	"""
+	returns the cost of steps of an order (positions) starting from
+	the cost model state, and the state after them
+	"""
+	def cost(self, steps, state):
+		total = 0
+		for i in steps:
+			step_cost, state = self.cost_model.step(state, self.keys[i])
+			total += step_cost
+		return total, state
+
+
+"""
+returns the cheapest reordering of the window of steps found by a beam
+search from the cost model state before the window, with its cost and
+the state after it. Ties keep the steps closest to the order given.
+"""
+def search_window(problem, window, state, beam_width):
+	local = {step: i for i, step in enumerate(window)}
+	parent_masks = []
+	for step in window:
+		mask = 0
+		for parent in problem.parents[step]:
+			if parent in local:
+				mask |= 1 << local[parent]
+		parent_masks.append(mask)
+
+	beam = [(0, 0, state, ())] # cost, steps taken mask, cost model state, steps taken
+	for n in range(len(window)):
+		memo = {} # (steps taken mask, cost model state) -> cheapest state reaching it
+		for cost, mask, model_state, sequence in beam:
+			for i in range(len(window)):
+				bit = 1 << i
+				if mask & bit or parent_masks[i] & ~mask:
+					continue
+				step_cost, next_state = problem.cost_model.step(model_state, problem.keys[window[i]])
+				key = (mask | bit, next_state)
+				if key in memo and memo[key][0] <= cost + step_cost:
+					continue
+				memo[key] = (cost + step_cost, mask | bit, next_state, sequence + (i,))
+		beam = sorted(memo.values(), key=lambda s: (s[0], s[3]))[:beam_width]
+
+	cost, mask, state, sequence = beam[0]
+	return [window[i] for i in sequence], cost, state
+
+
+"""
+one pass over the order, replacing each window of steps starting at
+offset by its best reordering when that is cheaper. Long passes post
+the order as it is so far every POST_INTERVAL seconds.
+returns the new order and whether it changed, stops at the deadline
+"""
+def improve_order(problem, order, window_size, offset, beam_width, deadline):
+	order = list(order)
+	improved = False
+	cost, state = problem.cost(order[:offset], problem.cost_model.start())
+	posted = time.time()
+	for start in range(offset, len(order), window_size):
+		if improved and improvements is not None and time.time() - posted > POST_INTERVAL:
+			improvements.put((problem.cost(order, problem.cost_model.start())[0], list(order)))
+			posted = time.time()
+		if out_of_time(deadline):
+			break
+		window = order[start:start + window_size]
+		window_cost, window_state = problem.cost(window, state)
+		new_window, new_cost, new_state = search_window(problem, window, state, beam_width)
+		if new_cost < window_cost:
+			order[start:start + window_size] = new_window
+			state = new_state
+			improved = True
+		else:
+			state = window_state
+	return order, improved
+
+
+"""
+runs improvement passes, alternating the window offset so steps
+on either side of a window boundary get reordered too, until a pass
+no longer helps or the deadline passes
+returns the best order reached and its cost
+"""
+def run_strategy(problem, order, window_size, beam_width, deadline):
+	best_cost = problem.cost(order, problem.cost_model.start())[0]
+	best_order = order
+	offsets = [0, window_size // 2]
+	unimproved = 0
+	i = 0
+	while unimproved < len(offsets) and not out_of_time(deadline):
+		order, improved = improve_order(problem, best_order, window_size, offsets[i % len(offsets)], beam_width, deadline)
+		cost = problem.cost(order, problem.cost_model.start())[0]
+		if cost < best_cost:
+			best_order, best_cost = order, cost
+			if improvements is not None:
+				improvements.put((best_cost, best_order))
+			unimproved = 0
+		else:
+			unimproved += 1
+		i += 1
+	return best_order, best_cost
+
+
+"""
+returns the cost of a traversal order of nodes under a cost model
+"""
+def order_cost(order, contact_lists, cost_model):
+	problem = OrderProblem(order, contact_lists, cost_model)
+	return problem.cost(range(len(order)), cost_model.start())[0]
+
+
+"""
+Searches for a cheaper traversal order than the greedy fasteners first
+one for time_budget seconds and returns (order, cost), the order being
+a list of nodes valid as build_program's traversal_order.
+jobs: worker processes, one strategy per process, 1 runs the strategies
+	one after another in this process splitting the budget between them
+Interrupting the search (KeyboardInterrupt) returns the best order
+any strategy reached so far.
+"""
+def search_order(root, contact_lists, cost_model=None, time_budget=1.0, jobs=None, strategies=DEFAULT_STRATEGIES):
+	if cost_model is None:
+		cost_model = ToolChanges()
+	seed = [root]
+	greedy_order(root, [root.ID], seed, fasteners_first)
+
+	problem = OrderProblem(seed, contact_lists, cost_model)
+	best_order = list(range(len(seed)))
+	best_cost = problem.cost(best_order, cost_model.start())[0]
+	start = time.time()
+	deadline = start + time_budget
+	if jobs is None:
+		jobs = min(len(strategies), os.cpu_count() or 1)
+
+	if jobs == 1:
+		posted = CheapestPosted()
+		init_worker(posted, None)
+		try:
+			for n, (window_size, beam_width) in enumerate(strategies):
+				strategy_deadline = start + time_budget * (n + 1) / len(strategies)
+				order, cost = run_strategy(problem, best_order, window_size, beam_width, min(strategy_deadline, deadline))
+				if cost < best_cost:
+					best_order, best_cost = order, cost
+		except KeyboardInterrupt:
+			if posted.cost is not None and posted.cost < best_cost:
+				best_order, best_cost = posted.order, posted.cost
+		finally:
+			init_worker(None, None)
+		return [seed[i] for i in best_order], best_cost
+
+	improvements_queue = multiprocessing.Queue()
+	stop_event = multiprocessing.Event()
+	executor = ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(improvements_queue, stop_event))
+	pending = []
+	try:
+		pending = [executor.submit(run_strategy, problem, best_order, window_size, beam_width, deadline)
+					for window_size, beam_width in strategies]
+		# workers stop themselves at the deadline, the grace
+		# period covers sending their orders back
+		while len(pending) != 0 and time.time() < deadline + 1.0:
+			done, pending = wait(pending, timeout=POST_INTERVAL, return_when=FIRST_COMPLETED)
+			for future in done:
+				order, cost = future.result()
+				if cost < best_cost:
+					best_order, best_cost = order, cost
+			# read the orders posted so far so they don't pile up
+			best_order, best_cost = best_posted(improvements_queue, best_order, best_cost)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		stop_event.set()
+		executor.shutdown(wait=False, cancel_futures=True)
+	if len(pending) != 0:
+		# the strategies still running posted the best they had reached
+		best_order, best_cost = best_posted(improvements_queue, best_order, best_cost, wait=0.1)
+	improvements_queue.close()
+
+	return [seed[i] for i in best_order], best_cost
@@ -0,0 +1,302 @@
+"""
+compiles the independent subassemblies of a product in parallel
+
+A region is a part together with everything below it, when nothing
+below it depends on parts outside of it: every part below the region's
+base has all of its parents inside the region, on the base, or on the
+parts the base is attached to (its attach points), and fasteners only
+go through those parts. The greedy traversal, once it reaches the base
+of a region, visits the whole region before going anywhere else, and
+visits it in the same order whatever came before. Its statements only
+refer to parts numbered by then. So the rest of the product, the
+skeleton, is traversed first with the regions left out, which gives
+every region its place in the order and, from the parts counted before
+it, the ordinals its own parts start from. Each region is then
+traversed and rendered in a worker process, and its rendered statements
+are put back in after the statement of its base. The program is the one
+build_greedy_program gives.
+
+	pieces = compile_partitioned(*compile_graph("assembly_info.json"), jobs=8)
+	print("".join(pieces).strip())
+
+Workers are forked so they inherit the graph instead of having it
+pickled to them. Where processes can't be forked, with jobs=1 or when
+there aren't at least two regions, the program is compiled in this
+process as usual. Parts inside regions are left without instance
+counts in this process, they are only counted in the workers.
+"""
+import collections
+import multiprocessing
+import operator
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import instrumentation
+from grammar import *
+
+
+# regions smaller than this are not worth sending to a worker
+DEFAULT_MIN_REGION_SIZE = 256
+# how many levels below the root to look for the bases of regions
+SEARCH_DEPTH = 4
+
+# id2node_map and contact lists of the graph being compiled, set
+# before the workers are forked so they inherit them
+shared_id2node_map = None
+shared_contact_lists = None
+
+
+"""
+returns the parts the statements of the region based at base can
+refer to besides its own: the base and its attach points, along
+with their members when they are parallel nodes
+"""
+def outside_parts(base):
+	parts = []
+	for node in [base] + base.parents:
+		parts += [node] + (node.nodes if isinstance(node, ParallelNode) else [])
+	return parts
+
+
+"""
+returns the parts of the region based at base, base first in breadth
+first order, and the parallel nodes among them, or None if base is not
+the base of a region
+max_size: also None if the region has more parts
+covered: IDs of parts the region may not contain, also None if it does
+"""
+def region_nodes(base, contact_lists, max_size=None, covered=()):
+	inside = set(outside_parts(base)) # the parts in the region and its attach points
+	nodes = [base]
+	parallel_nodes = []
+	fasteners = []
+	left_out = [] # parts seen with a parent outside the region so far
+	for node in nodes:
+		for child in node.children:
+			if child in inside:
+				continue
+			for parent in child.parents:
+				if not parent in inside:
+					left_out.append(child)
+					break
+			else:
+				if len(nodes) == max_size or child.ID in covered:
+					return None
+				inside.add(child)
+				nodes.append(child)
+				if child.is_fastener:
+					fasteners.append(child)
+				if isinstance(child, ParallelNode):
+					inside.update(child.nodes)
+					parallel_nodes.append(child)
+
+	# a part below the region that is not in it depends on another part
+	for child in left_out:
+		if not child in inside:
+			return None
+	for fastener in fasteners:
+		for part in contact_lists.get(fastener.ID, []):
+			if not part in inside:
+				return None
+	return nodes, parallel_nodes
+
+
+"""
+looks at the part with ID base_ID in a worker, returns None if it is
+not the base of a region, else the region's size, how many parts of
+each type code it counts (the base excluded) and the IDs of its parts
+below the base, members of parallel nodes included
+"""
+def survey_region(base_ID):
+	found = region_nodes(shared_id2node_map[base_ID], shared_contact_lists)
+	if found is None:
+		return None
+	nodes, parallel_nodes = found
+	type_counts = collections.Counter(map(operator.attrgetter("part_type_code"), nodes[1:]))
+	inner_IDs = [node.ID for node in nodes[1:]]
+	for node in parallel_nodes:
+		inner_IDs += [member.ID for member in node.nodes]
+		# parallel placements count as their members
+		if not node.is_fastener:
+			type_counts[node.part_type_code] -= 1
+			for member in node.nodes:
+				type_counts[member.part_type_code] += 1
+	return len(nodes), dict(type_counts), inner_IDs
+
+
+"""
+one region of a graph, as survey_region found it
+"""
+class Region:
+	def __init__(self, base, size, type_counts, inner_IDs):
+		self.base = base
+		self.size = size
+		self.type_counts = type_counts
+		self.inner_IDs = inner_IDs
+
+
+"""
+Searches the graph for regions from the root's children down, SEARCH_DEPTH
+levels at most, surveying the candidates of each level on the jobs
+workers of executor. A candidate that isn't a base has its children tried next.
+Regions found are never split, and a region that would contain or lie
+inside one found earlier is left out.
+returns the regions and the set of the IDs of the parts below their bases
+"""
+def find_regions(executor, jobs, root, id2node_map, contact_lists, min_size=DEFAULT_MIN_REGION_SIZE):
+	regions = []
+	inner = set()
+	base_IDs = set()
+	tried = set()
+	candidates = root.children
+	for depth in range(SEARCH_DEPTH):
+		candidates = [node for node in candidates if not node.is_fastener and not node.ID in tried and not node.ID in inner]
+		if len(candidates) == 0:
+			break
+		tried.update([node.ID for node in candidates])
+		next_candidates = []
+		surveys = executor.map(survey_region, [node.ID for node in candidates], chunksize=max(1, len(candidates) // (4 * jobs)))
+		for base, survey in zip(candidates, surveys):
+			if survey is None:
+				next_candidates += base.children
+				continue
+			size, type_counts, inner_IDs = survey
+			if size < min_size or base.ID in inner or base.ID in base_IDs:
+				continue
+			if not inner.isdisjoint(inner_IDs) or not base_IDs.isdisjoint(inner_IDs):
+				continue
+			inner.update(inner_IDs)
+			base_IDs.add(base.ID)
+			regions.append(Region(base, size, type_counts, inner_IDs))
+		candidates = next_candidates
+
+	region_of = {} # ID of a part below a base -> its region
+	for region in regions:
+		for ID in region.inner_IDs:
+			region_of[ID] = region
+	dropped = reached_by_fasteners(region_of, contact_lists)
+	regions = [region for region in regions if not region in dropped]
+	for region in dropped:
+		inner.difference_update(region.inner_IDs)
+	return regions, inner
+
+
+"""
+A fastener outside the regions can still go through one of their parts,
+which would then be numbered too late for its statement.
+returns the set of such regions, a region in it leaving its own
+fasteners outside the others
+region_of: the region of the ID of every part below a base
+"""
+def reached_by_fasteners(region_of, contact_lists):
+	fasteners_in = {} # region -> IDs of its fasteners
+	for ID, region in region_of.items():
+		if ID in contact_lists:
+			fasteners_in.setdefault(region, []).append(ID)
+	dropped = set()
+	fastener_IDs = [ID for ID in contact_lists if not ID in region_of]
+	while len(fastener_IDs) != 0:
+		for part in contact_lists[fastener_IDs.pop()]:
+			region = region_of.get(part.ID)
+			if region is not None and not region in dropped:
+				dropped.add(region)
+				fastener_IDs += fasteners_in.get(region, [])
+	return dropped
+
+
+"""
+traverses and renders one region in a worker
+start_counts: the attached part counts the region's ordinals start from
+outside_counts: instance counts of the region's outside parts
+returns the region's statements rendered into one string
+"""
+def compile_region(base_ID, start_counts, outside_counts):
+	base = shared_id2node_map[base_ID]
+	visited = []
+	for part, count in zip(outside_parts(base), outside_counts):
+		part.instance_count = count
+		part.phrase = None if count is None else part_phrase(part)
+		visited += [part.ID]
+
+	order = list(iter_greedy_order(base, visited, fasteners_first))
+	assign_instance_counts(order, dict(start_counts))
+	assign_phrases(order)
+	return "".join([make_statement(node, shared_contact_lists).print() for node in order])
+
+
+"""
+returns whether workers can be forked to inherit the graph
+"""
+def can_fork():
+	return "fork" in multiprocessing.get_all_start_methods()
+
+
+"""
+returns the pieces of the program of a graph compiled in this process
+"""
+def compile_sequential(root, id2node_map, contact_lists, part_counts):
+	order = [root]
+	greedy_order(root, [root.ID], order, fasteners_first)
+	return [statement.print() for statement in build_program(root, id2node_map, contact_lists, part_counts, order)]
+
+
+"""
+Compiles a graph as compile_graph returns it into its greedy
+fasteners first program, compiling its regions on jobs worker
+processes (all cores by default). The program is returned in pieces,
+a rendered statement each outside the regions and a string of
+statements for each region, that joined and stripped are the
+get_program_str of build_greedy_program.
+"""
+@instrumentation.timed("compile_partitioned")
+def compile_partitioned(root, id2node_map, contact_lists, part_counts, jobs=None, min_region_size=DEFAULT_MIN_REGION_SIZE):
+	global shared_id2node_map, shared_contact_lists
+	if jobs is None:
+		jobs = os.cpu_count() or 1
+	if jobs <= 1 or not can_fork():
+		return compile_sequential(root, id2node_map, contact_lists, part_counts)
+
+	shared_id2node_map = id2node_map
+	shared_contact_lists = contact_lists
+	try:
+		with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+			regions, inner = find_regions(executor, jobs, root, id2node_map, contact_lists, min_region_size)
+			if instrumentation.enabled:
+				instrumentation.count("partition.regions", len(regions))
+				instrumentation.count("partition.region_parts", len(inner))
+			if len(regions) < 2:
+				return compile_sequential(root, id2node_map, contact_lists, part_counts)
+
+			# the skeleton: the order with the parts below every base left out
+			order = [root] + list(iter_greedy_order(root, [root.ID] + list(inner), fasteners_first))
+
+			region_at = {region.base.ID: region for region in regions}
+			attached_part_counts = {}
+			start_counts = {}
+			for node in order:
+				assign_instance_counts([node], attached_part_counts)
+				if node.ID in region_at:
+					start_counts[node.ID] = dict(attached_part_counts)
+					for code, count in region_at[node.ID].type_counts.items():
+						attached_part_counts[code] = attached_part_counts.get(code, 0) + count
+			assign_phrases(order)
+
+			# largest first, so a large region doesn't start last
+			futures = {}
+			for region in sorted(regions, key=lambda region: -region.size):
+				outside_counts = [part.instance_count for part in outside_parts(region.base)]
+				futures[region.base.ID] = executor.submit(compile_region, region.base.ID, start_counts[region.base.ID], outside_counts)
+
+			pieces = [PlacementOp(root, []).print()]
+			slots = [] # (position in pieces, base ID)
+			for node in order[1:]:
+				pieces += [make_statement(node, contact_lists).print()]
+				if node.ID in region_at:
+					slots += [(len(pieces), node.ID)]
+					pieces += [None]
+			for position, base_ID in slots:
+				pieces[position] = futures[base_ID].result()
+			return pieces
+	finally:
+		shared_id2node_map = None
+		shared_contact_lists = None
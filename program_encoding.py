@@ -0,0 +1,352 @@
+"""
+machine readable encodings of a compiled program
+
+Besides the english rendering, a program (build_program's list of
+statements, or any iterable of them such as iter_program) can be
+written as json lines or as a packed binary stream. Both carry for
+every statement the kind of op and the parts it places or fastens and
+the parts it aligns them with or fastens them to, in the order the
+statement names them. Every part is given by its node ID, part type
+code, ordinal (instance count) and whether it is a fastener and unique,
+which is all its rendering depends on. Part type codes are local to
+the encoding: the types the program uses are numbered 0..k-1 in order
+of first use and only their k names are stored, so an encoding neither
+depends on nor grows with the process wide part_types table. Decoding
+gives back PlacementOp, AttachmentOp, ParallelPlacementOp and
+ParallelAttachmentOp statements over stand-in Nodes that print exactly
+what the encoded statements printed.
+
+json lines: a header line, then one line per statement, every part
+given as [id, type, ordinal, flags]. A statement using part types no
+earlier one did lists their names, in code order, under "types", so
+the lines can be written as the statements are made
+	{"format":"wiprogram","version":2,"part_fields":["id","type","ordinal","flags"]}
+	{"op":"place","parts":[[0,0,1,2]],"contacts":[],"types":["base plate"]}
+	{"op":"attach_parallel","parts":[...],"contacts":[...],"types":["screw"]}
+
+binary: a header, a small json block with the part type names and the
+section layout, then little endian arrays, each padded to 8 bytes and
+of the narrowest integer type that holds its values:
+	ids       node ID of every part, in order of first appearance. Graphs
+			  with string IDs have them listed in the json block instead
+	codes     part type code of every part
+	ordinals  instance count of every part, -1 if it has none
+	flags     FASTENER | UNIQUE | UNIQUE_UNKNOWN of every part
+	ops       op code of every statement, | EXPLICIT_PARTS when the
+			  parts it places or fastens are given by index
+	counts    per statement: number of parts placed or fastened (only
+			  for parallel ops), number of parts aligned with or fastened to
+	indices   per statement: part indices of the parts placed or fastened
+			  if EXPLICIT_PARTS, then of the parts aligned with or fastened to
+Each part is stored once however many statements refer to it. Parts
+placed or fastened for the first time are the next parts of the table
+and need no indices, which is the case for nearly every statement.
+"""
+import json
+import struct
+import sys
+from array import array
+
+from grammar import *
+
+
+FORMAT_VERSION = 2
+JSON_FORMAT = "wiprogram"
+MAGIC = b"WIPR"
+HEADER = struct.Struct("<4sIQ") # magic, format version, metadata length
+
+# op codes
+PLACE = 0
+PLACE_PARALLEL = 1
+ATTACH = 2
+ATTACH_PARALLEL = 3
+OP_NAMES = ["place", "place_parallel", "attach", "attach_parallel"]
+
+# set on the op code of a statement whose parts placed or fastened
+# are not the next parts of the part table, but given by index
+EXPLICIT_PARTS = 0x80
+
+FASTENER = 1
+UNIQUE = 2
+UNIQUE_UNKNOWN = 4
+
+PART_FIELDS = ["id", "type", "ordinal", "flags"]
+
+
+"""
+returns the op code of a statement
+"""
+def op_code(statement):
+	if isinstance(statement, PlacementOp):
+		return PLACE
+	elif isinstance(statement, ParallelPlacementOp):
+		return PLACE_PARALLEL
+	elif isinstance(statement, AttachmentOp):
+		return ATTACH
+	elif isinstance(statement, ParallelAttachmentOp):
+		return ATTACH_PARALLEL
+	raise Exception(f"unknown statement {type(statement).__name__}")
+
+
+"""
+returns the statement of an op code over its parts, the inverse
+of op_code and statement_parts
+"""
+def make_op(code, primary, others):
+	if code == PLACE:
+		return PlacementOp(primary[0], others)
+	elif code == PLACE_PARALLEL:
+		return ParallelPlacementOp(primary, others)
+	elif code == ATTACH:
+		return AttachmentOp(primary[0], others)
+	elif code == ATTACH_PARALLEL:
+		return ParallelAttachmentOp(primary, others)
+	raise Exception(f"unknown op code {code}")
+
+
+def part_flags(part):
+	flags = FASTENER if part.is_fastener else 0
+	if part.is_unique is None:
+		flags |= UNIQUE_UNKNOWN
+	elif part.is_unique:
+		flags |= UNIQUE
+	return flags
+
+
+"""
+returns the stand-in Node for an encoded part
+"""
+def decoded_part(ID, part_type, ordinal, flags):
+	is_unique = None if flags & UNIQUE_UNKNOWN else bool(flags & UNIQUE)
+	part = Node(ID, [], [], bool(flags & FASTENER), part_type, is_unique)
+	part.instance_count = ordinal
+	return part
+
+
+"""
+numbers the part types of one encoding 0..k-1 in order of first use
+names: the part type name of every local code
+"""
+class LocalTypeCodes:
+	def __init__(self):
+		self.codes = {} # part_types code -> local code
+		self.names = []
+
+	def code(self, part):
+		code = self.codes.get(part.part_type_code)
+		if code is None:
+			code = self.codes[part.part_type_code] = len(self.names)
+			self.names.append(part.part_type)
+		return code
+
+
+"""
+Yields the json lines of a program, the header first, each ending
+in a newline. program can be any iterable of statements, including
+a generator, it is encoded as it is iterated.
+"""
+def iter_program_json(program):
+	type_codes = LocalTypeCodes()
+
+	def part_json(part):
+		return [part.ID, type_codes.code(part), part.instance_count, part_flags(part)]
+
+	yield json.dumps({"format": JSON_FORMAT, "version": FORMAT_VERSION, "part_fields": PART_FIELDS}, separators=(",", ":")) + "\n"
+	for statement in program:
+		primary, others = statement_parts(statement)
+		known = len(type_codes.names)
+		line = {"op": OP_NAMES[op_code(statement)],
+				"parts": [part_json(part) for part in primary],
+				"contacts": [part_json(part) for part in others]}
+		if len(type_codes.names) != known:
+			line["types"] = type_codes.names[known:]
+		yield json.dumps(line, separators=(",", ":")) + "\n"
+
+
+"""
+writes a program as json lines to a text file object
+returns the number of statements written
+"""
+def write_program_json(program, fileobj):
+	lines = 0
+	for line in iter_program_json(program):
+		fileobj.write(line)
+		lines += 1
+	return lines - 1
+
+
+"""
+returns the statements of a program from its json lines, any
+iterable of str or bytes lines such as an open file
+"""
+def read_program_json(lines):
+	lines = iter(lines)
+	header = json.loads(next(lines))
+	if header.get("format") != JSON_FORMAT or header.get("version") != FORMAT_VERSION:
+		raise Exception("not a program of the current json format")
+	names = []
+	parts = {} # node ID -> stand-in Node
+
+	def part_from_json(info):
+		ID, code, ordinal, flags = info
+		part = parts.get(ID)
+		if part is None:
+			part = parts[ID] = decoded_part(ID, names[code], ordinal, flags)
+		return part
+
+	program = []
+	for line in lines:
+		if not line.strip():
+			continue
+		statement = json.loads(line)
+		names += statement.get("types", [])
+		program.append(make_op(OP_NAMES.index(statement["op"]),
+								[part_from_json(info) for info in statement["parts"]],
+								[part_from_json(info) for info in statement["contacts"]]))
+	return program
+
+
+"""
+returns values as an array of the narrowest type holding them all
+"""
+def packed(values):
+	lowest = min(values, default=0)
+	highest = max(values, default=0)
+	for typecode in (["B", "H", "I", "Q"] if lowest >= 0 else ["b", "h", "i", "q"]):
+		bits = 8 * array(typecode).itemsize
+		if lowest >= 0 and highest < 1 << bits:
+			return array(typecode, values)
+		if lowest < 0 and -(1 << (bits - 1)) <= lowest and highest < 1 << (bits - 1):
+			return array(typecode, values)
+	raise Exception(f"values from {lowest} to {highest} don't fit in 64 bits")
+
+
+"""
+returns a program as bytes of the packed binary encoding
+program can be any iterable of statements, including a generator
+"""
+def encode_program(program):
+	type_codes = LocalTypeCodes()
+	index_of = {} # id(part) -> index in the part table
+	ids = []
+	codes = []
+	ordinals = []
+	flags = []
+	ops = []
+	counts = []
+	indices = []
+
+	def part_index(part):
+		index = index_of.get(id(part))
+		if index is None:
+			index = index_of[id(part)] = len(ids)
+			ids.append(part.ID)
+			codes.append(type_codes.code(part))
+			ordinals.append(-1 if part.instance_count is None else part.instance_count)
+			flags.append(part_flags(part))
+		return index
+
+	for statement in program:
+		code = op_code(statement)
+		primary, others = statement_parts(statement)
+		if code == PLACE_PARALLEL or code == ATTACH_PARALLEL:
+			counts.append(len(primary))
+		counts.append(len(others))
+		# the parts a statement places or fastens are nearly always
+		# seen for the first time, and then they are the next parts
+		# of the table and their indices are left out
+		new = len(set([id(part) for part in primary])) == len(primary) and not any([id(part) in index_of for part in primary])
+		ops.append(code if new else code | EXPLICIT_PARTS)
+		primary_indices = [part_index(part) for part in primary]
+		if not new:
+			indices += primary_indices
+		indices += [part_index(part) for part in others]
+
+	meta = {"part_types": type_codes.names}
+	sections = [("codes", packed(codes)), ("ordinals", packed(ordinals)), ("flags", packed(flags)),
+				("ops", packed(ops)), ("counts", packed(counts)), ("indices", packed(indices))]
+	if all([type(ID) is int for ID in ids]):
+		sections = [("ids", packed(ids))] + sections
+	else:
+		# other IDs, e.g. the names of hand made graphs, go in the
+		# metadata as a table in part order instead of an array
+		for ID in ids:
+			if type(ID) is not int and type(ID) is not str:
+				raise Exception(f"program encoding requires integer or string node IDs, got {ID!r}")
+		meta["ids"] = ids
+	offset = 0
+	layout = {}
+	body = []
+	for name, values in sections:
+		if sys.byteorder != "little":
+			values.byteswap()
+		data = values.tobytes()
+		data += b"\0" * (-len(data) % 8)
+		layout[name] = [offset, len(values), values.typecode]
+		offset += len(data)
+		body.append(data)
+
+	meta["sections"] = layout
+	meta = json.dumps(meta).encode()
+	meta += b" " * (-(HEADER.size + len(meta)) % 8)
+	return HEADER.pack(MAGIC, FORMAT_VERSION, len(meta)) + meta + b"".join(body)
+
+
+"""
+returns the statements of a program from its packed binary
+encoding (bytes, or any buffer such as an mmap)
+"""
+def decode_program(buf):
+	view = memoryview(buf)
+	try:
+		magic, version, meta_len = HEADER.unpack_from(view, 0)
+		if magic != MAGIC or version != FORMAT_VERSION:
+			raise Exception("not a program of the current binary format")
+		meta = json.loads(bytes(view[HEADER.size:HEADER.size + meta_len]))
+		body_start = HEADER.size + meta_len
+
+		arrays = {}
+		for name, (offset, length, typecode) in meta["sections"].items():
+			values = array(typecode)
+			start = body_start + offset
+			values.frombytes(view[start:start + length * values.itemsize])
+			if sys.byteorder != "little":
+				values.byteswap()
+			arrays[name] = values.tolist()
+	finally:
+		view.release()
+
+	names = meta["part_types"]
+	ids = meta["ids"] if "ids" in meta else arrays["ids"]
+	parts = [decoded_part(ID, names[code], None if ordinal == -1 else ordinal, flags)
+			for ID, code, ordinal, flags in zip(ids, arrays["codes"], arrays["ordinals"], arrays["flags"])]
+
+	counts = arrays["counts"]
+	indices = arrays["indices"]
+	program = []
+	next_new = 0 # index of the next part seen for the first time
+	c = 0
+	i = 0
+	for op in arrays["ops"]:
+		code = op & ~EXPLICIT_PARTS
+		if code == PLACE_PARALLEL or code == ATTACH_PARALLEL:
+			primary_count = counts[c]
+			c += 1
+		else:
+			primary_count = 1
+		others_count = counts[c]
+		c += 1
+		if op & EXPLICIT_PARTS:
+			primary_indices = indices[i:i + primary_count]
+			i += primary_count
+		else:
+			primary_indices = list(range(next_new, next_new + primary_count))
+		others_indices = indices[i:i + others_count]
+		i += others_count
+		for index in primary_indices + others_indices:
+			if index >= next_new:
+				next_new = index + 1
+		program.append(make_op(code, [parts[j] for j in primary_indices], [parts[j] for j in others_indices]))
+	if c != len(counts) or i != len(indices):
+		raise Exception("program encoding ends in the middle of a statement")
+	return program
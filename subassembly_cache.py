@@ -0,0 +1,340 @@
+"""
+reuse of compile work across repeated subassemblies
+
+Products repeat identical subassemblies, like the left and right
+support brackets with their three screws each. The subassemblies
+cached are the regions of partition.py: a part, the base, with
+everything below it, when nothing below it depends on parts outside
+of it. The greedy traversal visits a region right after its base and
+in the same order whatever came before, and the region's statements
+only refer to its own parts, its base and the parts the base is
+attached to (its attach points). Only regions whose fasteners are
+all parallelized inside them and whose statements never have to sort
+two attach points of one type are cached, the statements of others
+could depend on more than the region.
+
+A region's canonical form lists, in the breadth first order fixed by
+the children order, each part's type, fastener flag, uniqueness,
+children, parents and contact list, with parts referred to by their
+position in that order, and the types of the attach points. Two
+regions with the same form are identical up to renaming, and the form
+itself is the key of the cache, so distinct regions never collide.
+
+For every distinct region the cache keeps how many parts of each type
+it counts and its rendered statements as a template, with a slot for
+every part phrase. A region seen before, in this graph or an earlier
+one, is neither parallelized nor traversed: only the rest of the
+graph, the skeleton, is, which gives each region its place in the
+order and the ordinals its parts start from, and the region's
+statements are its template filled with its own phrases. Finding the
+regions and their forms still looks at every part once, so a compile
+costs a pass over the graph plus compiling the skeleton and each
+distinct region. The program is identical to the one compile_graph
+and build_greedy_program give. The cache keeps the entries of the
+max_entries regions used most recently.
+
+	cache = SubassemblyCache()
+	pieces = compile_with_cache(*json2graph("assembly_info.json"), cache)
+	print("".join(pieces).strip())
+
+The graph is left parallelized everywhere but in the regions whose
+statements came from the cache.
+"""
+import collections
+
+from grammar import *
+from partition import compile_sequential, outside_parts, reached_by_fasteners, region_nodes
+
+
+DEFAULT_MAX_SIZE = 64
+DEFAULT_MAX_ENTRIES = 4096
+SLOT = "\x00"
+
+
+"""
+the entries of distinct regions seen so far, at most max_entries of
+them, the least recently used evicted first
+"""
+class SubassemblyCache:
+	def __init__(self, max_size=DEFAULT_MAX_SIZE, max_entries=DEFAULT_MAX_ENTRIES):
+		self.max_size = max_size # largest region, in parts, that is cached
+		self.max_entries = max_entries
+		self.entries = collections.OrderedDict() # canonical form -> SubassemblyEntry, least recently used first
+		self.hits = 0
+		self.misses = 0
+
+	"""
+	returns the entry of a canonical form, or None on a miss
+	"""
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+			self.entries.move_to_end(key)
+		return entry
+
+	def put(self, key, entry):
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
+
+"""
+What is cached for one distinct region.
+template: its statements as a format string taking part phrases
+slots: for every field of the template, the index in parts of the
+	part it takes the phrase of, or -1-k for the k-th of the region's
+	outside parts (see partition.outside_parts)
+parts: (part type code, instance count within the region, is_unique)
+	of every part of the region a statement refers to
+type_counts: (part type code, count) of the parts the region counts
+"""
+class SubassemblyEntry:
+	def __init__(self, template, slots, parts, type_counts):
+		self.template = template
+		self.slots = slots
+		self.parts = parts
+		self.type_counts = type_counts
+
+	"""
+	returns the statements of the region based at base, its parts
+	numbered on from start_counts
+	"""
+	def render(self, base, start_counts):
+		names = part_types.names
+		phrases = [names[code] if is_unique else ordinal(start_counts.get(code, 0) + count) + " " + names[code]
+					for code, count, is_unique in self.parts]
+		outside = [get_part_str(part) for part in outside_parts(base)]
+		return self.template.format(*[phrases[slot] if slot >= 0 else outside[-1 - slot] for slot in self.slots])
+
+
+"""
+one region of a graph
+nodes: its parts in canonical order, the base first
+"""
+class Region:
+	def __init__(self, nodes, key):
+		self.base = nodes[0]
+		self.nodes = nodes
+		self.key = key
+		self.entry = None
+
+
+"""
+returns how many parts the region based at node has, at least
+roughly, if node is closed, else None. A part is closed when its
+children are, and their parents are the part, its parents or its other
+children, so the parents of every part below a closed part are below
+it, on it or on its parents: a closed part is the base of a region.
+sizes: the sizes of the closed parts below node
+"""
+def closed_size(node, sizes):
+	size = 1
+	siblings = None
+	for child in node.children:
+		if len(child.children) == 0:
+			child_size = 1
+		elif child.ID in sizes:
+			child_size = sizes[child.ID]
+		else:
+			return None
+		for parent in child.parents:
+			if not (parent is node or parent in node.parents):
+				if siblings is None:
+					siblings = set(node.children)
+				if not parent in siblings:
+					return None
+		# parts below several parts are counted below their first
+		first = child.parents[0]
+		if first is node or first in node.parents:
+			size += child_size
+	return size
+
+
+"""
+returns the region based at base, or None if it has more than
+max_size parts, parts in covered, or isn't one the cache can take
+"""
+def cacheable_region(base, contact_lists, max_size, covered):
+	found = region_nodes(base, contact_lists, max_size, covered)
+	if found is None:
+		return None
+	nodes = found[0]
+
+	attach_points = base.parents
+	refs = {node: i for i, node in enumerate(nodes)}
+	for k, part in enumerate(attach_points):
+		refs[part] = -1 - k
+	form = [tuple([(part.part_type_code, part.is_fastener) for part in attach_points])]
+	ref = refs.__getitem__
+	for node in nodes:
+		parents = tuple(map(ref, node.parents))
+		if node.is_fastener:
+			contacts = tuple(map(refs.get, contact_lists[node.ID]))
+			# fasteners are parallelized at their immediate parent,
+			# which has to be in the region
+			if None in contacts or contacts[0] < 0:
+				return None
+		else:
+			contacts = None
+			if node is not base and len(parents) > 1:
+				# attach points of one type are in the order of their
+				# instance counts, which depends on more than the region
+				attached_types = [parent.part_type_code for parent in node.parents if refs[parent] < 0 and not parent.is_fastener]
+				if len(set(attached_types)) != len(attached_types):
+					return None
+		form.append((node.part_type_code, node.is_fastener, node.is_unique, tuple(map(ref, node.children)), parents, contacts))
+	return Region(nodes, tuple(form))
+
+
+"""
+finds the regions of 2 to max_size parts based at closed parts, going
+from the root down so the largest regions are found first. Regions
+are disjoint and never contain the root. Checking the parts below
+each part is closed keeps the search linear, at the price of regions
+where a part hangs from two branches below the base, which are only
+found below the branches.
+returns the list of Region
+"""
+def find_regions(root, id2node_map, contact_lists, levels_dict, max_size):
+	sizes = {} # ID of a closed part -> size of its region
+	max_level = max(levels_dict.keys())
+	for level in range(1, max_level + 1):
+		for nodeID in levels_dict[level]:
+			size = closed_size(id2node_map[nodeID], sizes)
+			if size is not None and size <= max_size:
+				sizes[nodeID] = size
+
+	regions = []
+	covered = set()
+	for level in range(max_level - 1, 0, -1):
+		for nodeID in levels_dict[level]:
+			if not nodeID in sizes or nodeID in covered:
+				continue
+			base = id2node_map[nodeID]
+			if base.is_fastener:
+				continue
+			region = cacheable_region(base, contact_lists, max_size, covered)
+			if region is None:
+				continue
+			covered.update([node.ID for node in region.nodes])
+			regions.append(region)
+
+	region_of = {}
+	for region in regions:
+		for node in region.nodes[1:]:
+			region_of[node.ID] = region
+	dropped = reached_by_fasteners(region_of, contact_lists)
+	return [region for region in regions if not region in dropped]
+
+
+"""
+Compiles a region the cache hasn't seen: parallelizes it as
+parallelize_where_possible would, traverses it from its base and
+renders its statements into a template. Parts are only parallelized
+at their immediate parent, always inside the region.
+returns the entry and the region's traversal order
+"""
+def compile_region(base, nodes, contact_lists, id2node_map, id_generator):
+	for node in nodes:
+		if len(node.children) > 1:
+			groups = find_parallel_groups(node, node.children, contact_lists)
+			if len(groups) != 0:
+				parallelize_ops(node, groups, [next(id_generator) for group in groups], contact_lists, id2node_map)
+
+	outside = outside_parts(base)
+	order = list(iter_greedy_order(base, [part.ID for part in outside], fasteners_first))
+
+	# the parts are sorted against each other by instance count: attach
+	# points are counted before the base and the base before the region
+	saved = [(part.instance_count, part.phrase) for part in outside]
+	for part in outside:
+		part.instance_count = -1
+	base.instance_count = 0
+	counts = {}
+	assign_instance_counts(order, counts)
+	counted = [part for node in order for part in counted_parts(node)]
+	for i, part in enumerate(counted):
+		part.phrase = SLOT + str(i) + SLOT
+	for k, part in enumerate(outside):
+		part.phrase = SLOT + str(-1 - k) + SLOT
+	text = "".join([make_statement(node, contact_lists).print() for node in order])
+	for part, (count, phrase) in zip(outside, saved):
+		part.instance_count = count
+		part.phrase = phrase
+
+	pieces = text.replace("{", "{{").replace("}", "}}").split(SLOT)
+	slots = []
+	parts = []
+	part_slot = {} # index in counted -> index in parts
+	for i in range(1, len(pieces), 2):
+		slot = int(pieces[i])
+		if slot >= 0:
+			if not slot in part_slot:
+				part = counted[slot]
+				part_slot[slot] = len(parts)
+				parts.append((part.part_type_code, part.instance_count, part.is_unique))
+			slot = part_slot[slot]
+		slots.append(slot)
+		pieces[i] = "{}"
+	type_counts = list(counts.items())
+	return SubassemblyEntry("".join(pieces), slots, parts, type_counts), order
+
+
+"""
+compiles a graph as json2graph returns it, taking the statements of
+every region seen before from the cache, and returns the program in
+pieces: a rendered statement each outside the regions and a string of
+statements for each region, that joined and stripped are the
+get_program_str of build_greedy_program
+"""
+def compile_with_cache(root, id2node_map, contact_lists, part_counts, cache):
+	# slots are joined without the stripping some statements do of the
+	# joined phrases, which only matters for blank part types or ones with
+	# surrounding spaces
+	names = [part_types.name(code) for code in {node.part_type_code for node in id2node_map.values()}]
+	if not all([name != "" and name == name.strip() and not SLOT in name for name in names]):
+		parallelize_where_possible(root, contact_lists, id2node_map, new_ID_generator(id2node_map))
+		return compile_sequential(root, id2node_map, contact_lists, part_counts)
+
+	node_levels, levels_dict = get_levels(root)
+	regions = find_regions(root, id2node_map, contact_lists, levels_dict, cache.max_size)
+
+	id_generator = new_ID_generator(id2node_map)
+	inner = set() # IDs of the parts below the bases
+	region_at = {}
+	for region in regions:
+		region_at[region.base.ID] = region
+		inner.update([node.ID for node in region.nodes[1:]])
+		region.entry = cache.get(region.key)
+		if region.entry is None:
+			region.entry, order = compile_region(region.base, region.nodes, contact_lists, id2node_map, id_generator)
+			cache.put(region.key, region.entry)
+			# the parallel nodes made in the region
+			inner.update([node.ID for node in order])
+
+	# the skeleton: the graph with the parts below every base left out
+	skeleton_levels = {level: [nodeID for nodeID in nodeIDs if not nodeID in inner and not nodeID in region_at]
+						for level, nodeIDs in levels_dict.items()}
+	parallelize_where_possible(root, contact_lists, id2node_map, id_generator, skeleton_levels)
+	order = [root] + list(iter_greedy_order(root, [root.ID] + list(inner), fasteners_first))
+
+	attached_part_counts = {}
+	start_counts = {}
+	for node in order:
+		assign_instance_counts([node], attached_part_counts)
+		if node.ID in region_at:
+			start_counts[node.ID] = dict(attached_part_counts)
+			for code, count in region_at[node.ID].entry.type_counts:
+				attached_part_counts[code] = attached_part_counts.get(code, 0) + count
+	assign_phrases(order)
+
+	pieces = [PlacementOp(root, []).print()]
+	for node in order[1:]:
+		pieces += [make_statement(node, contact_lists).print()]
+		if node.ID in region_at:
+			pieces += [region_at[node.ID].entry.render(node, start_counts[node.ID])]
+	return pieces
@@ -0,0 +1,172 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import compile_daemon
+from compile_daemon import CompileDaemon
+
+
+REQUEST = json.dumps({"id": 1, "path": "assembly_info.json"}).encode() + b"\n"
+
+
+async def send(path, line):
+	reader, writer = await asyncio.open_unix_connection(path)
+	writer.write(line)
+	await writer.drain()
+	response = json.loads(await reader.readline())
+	writer.close()
+	return response
+
+
+async def idle_connections(path):
+	daemon = CompileDaemon(0, 1)
+	server = asyncio.create_task(daemon.serve_socket(path))
+	try:
+		while not os.path.exists(path):
+			await asyncio.sleep(0.01)
+		idle = [await asyncio.open_unix_connection(path) for i in range(2)]
+		response = await asyncio.wait_for(send(path, REQUEST), 10)
+		for reader, writer in idle:
+			writer.close()
+		return response
+	finally:
+		server.cancel()
+		await asyncio.gather(server, return_exceptions=True)
+		daemon.close()
+
+
+def test_idle_connections_take_no_slots():
+	with tempfile.TemporaryDirectory() as tmp:
+		response = asyncio.run(idle_connections(os.path.join(tmp, "daemon.sock")))
+	assert response["ok"], response
+
+
+async def timed_out_request():
+	daemon = CompileDaemon(0, 1, timeout=0.1)
+	responses = []
+	try:
+		lines = [REQUEST, b""]
+
+		async def readline():
+			return lines.pop(0)
+
+		async def write(response):
+			responses.append(json.loads(response))
+		await daemon.serve(readline, write)
+		locked = daemon.pending.locked()
+		await asyncio.sleep(1)
+		return responses, locked, daemon.pending.locked()
+	finally:
+		daemon.close()
+
+
+def test_timed_out_request_keeps_its_slot():
+	compile_request = compile_daemon.compile_request
+
+	def slow_compile_request(line, cache_dir=None, stream=False):
+		time.sleep(0.5)
+		return compile_request(line, cache_dir, stream)
+	compile_daemon.compile_request = slow_compile_request
+	try:
+		responses, locked, locked_after = asyncio.run(timed_out_request())
+	finally:
+		compile_daemon.compile_request = compile_request
+	# answered at the timeout, but the slot is held until the worker is done
+	[response] = responses
+	assert "timed out" in response["error"], response
+	assert locked
+	assert not locked_after
+
+
+async def killed_worker():
+	daemon = CompileDaemon(2, 4)
+	try:
+		await daemon.start()
+		os.kill(multiprocessing.active_children()[0].pid, signal.SIGKILL)
+		responses = [json.loads(await daemon.handle(REQUEST))]
+		if not responses[0]["ok"]:
+			# the pool had not noticed yet, the request was lost with it
+			assert "worker process died" in responses[0]["error"], responses[0]
+			responses.append(json.loads(await daemon.handle(REQUEST)))
+		return responses
+	finally:
+		start = time.perf_counter()
+		daemon.close()
+		assert time.perf_counter() - start < 5
+
+
+def test_killed_worker_replaces_the_pool():
+	responses = asyncio.run(killed_worker())
+	assert responses[-1]["ok"], responses[-1]
+
+
+def children(pid):
+	pids = []
+	for entry in os.listdir("/proc"):
+		if entry.isdigit():
+			try:
+				with open(f"/proc/{entry}/stat") as f:
+					stat = f.read()
+			except OSError:
+				continue
+			if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+				pids.append(int(entry))
+	return pids
+
+
+def request(path, line):
+	with socket.socket(socket.AF_UNIX) as s:
+		s.settimeout(10)
+		s.connect(path)
+		s.sendall(line)
+		return json.loads(s.makefile("rb").readline())
+
+
+def test_daemon_survives_killed_worker():
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, "daemon.sock")
+		daemon = subprocess.Popen([sys.executable, "compile_daemon.py", "--socket", path, "-j", "2"], stderr=subprocess.DEVNULL)
+		try:
+			# the socket only shows up once the workers are warm
+			while not os.path.exists(path):
+				assert daemon.poll() is None
+				time.sleep(0.05)
+			workers = children(daemon.pid)
+			os.kill(workers[0], signal.SIGKILL)
+			time.sleep(0.5)
+			assert os.path.exists(path)
+			response = request(path, REQUEST)
+			if not response["ok"]:
+				response = request(path, REQUEST)
+			assert response["ok"], response
+			daemon.send_signal(signal.SIGTERM)
+			assert daemon.wait(5) == 0
+			assert not os.path.exists(path)
+		finally:
+			if daemon.poll() is None:
+				daemon.kill()
+				daemon.wait()
+			for pid in children(daemon.pid):
+				os.kill(pid, signal.SIGKILL)
+
+
+def test_streamed_path_requests():
+	loaded, streamed = [json.loads(compile_daemon.compile_request(REQUEST, stream=stream)) for stream in [False, True]]
+	assert loaded["ok"] and streamed["ok"], (loaded, streamed)
+	assert streamed["program"] == loaded["program"]
+
+
+if __name__ == "__main__":
+	test_idle_connections_take_no_slots()
+	test_timed_out_request_keeps_its_slot()
+	test_killed_worker_replaces_the_pool()
+	test_daemon_survives_killed_worker()
+	test_streamed_path_requests()
+	print("compile daemon ok")
@@ -0,0 +1,60 @@
+import json
+import os
+import tempfile
+
+import validation
+from graph_cache import load_or_compile
+from grammar import *
+from json_to_graph import build_greedy_program, compile_graph
+
+
+"""
+writes assembly_info.json with the contact list of one fastener
+reversed, so it lists a part after its parent
+"""
+def write_bad_assembly(path):
+	with open("assembly_info.json", "r") as f:
+		records = json.load(f)
+	for record in records:
+		if record["is_fastener"] and len(record["fastened_parts"]) >= 2:
+			record["fastened_parts"].reverse()
+			break
+	with open(path, "w") as f:
+		json.dump(records, f)
+
+
+def test_invalid_graphs_are_not_cached():
+	with tempfile.TemporaryDirectory() as tmp:
+		json_file = os.path.join(tmp, "bad.json")
+		cache_dir = os.path.join(tmp, "cache")
+		write_bad_assembly(json_file)
+		try:
+			for mode in [validation.OFF, validation.DEFERRED]:
+				validation.set_mode(mode)
+				load_or_compile(json_file, cache_dir)
+				validation.take_deferred()
+			validation.set_mode(validation.STRICT)
+			try:
+				load_or_compile(json_file, cache_dir)
+			except validation.ValidationError:
+				pass
+			else:
+				assert False, "a cached graph skipped strict validation"
+		finally:
+			validation.set_mode(validation.STRICT)
+			validation.take_deferred()
+		assert os.listdir(cache_dir) == []
+
+
+def test_hits_compile_the_same_program():
+	program = get_program_str(build_greedy_program(*compile_graph("assembly_info.json")))
+	with tempfile.TemporaryDirectory() as tmp:
+		for i in range(2):
+			assert get_program_str(build_greedy_program(*load_or_compile("assembly_info.json", tmp))) == program
+		assert len(os.listdir(tmp)) == 1
+
+
+if __name__ == "__main__":
+	test_invalid_graphs_are_not_cached()
+	test_hits_compile_the_same_program()
+	print("graph cache ok")
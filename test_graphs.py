@@ -1,4 +1,5 @@
 from grammar import *
+import validation
 
 
 def test_graph0():
@@ -96,10 +97,7 @@ def test_graph1(id_generator, parallelize=False):
 		# parallelize the screwing
 		screws = [nodes[i] for i in range(1,4)]
 		parallel_screws_id = next(id_generator)
-		parallelized_screws_node = parallelize_op(root, screws, parallel_screws_id, contact_lists)
-		for screw in screws:
-			del nodes[screw.ID]
-		nodes[parallel_screws_id] = parallelized_screws_node
+		parallelize_op(root, screws, parallel_screws_id, contact_lists, nodes)
 
 	return nodes, root, contact_lists, part_counts
 
@@ -134,10 +132,7 @@ def test_graph2(id_generator, parallelize=False):
 		# parallelize the screwing 
 		screws = [nodes[i] for i in range(2,5)]
 		parallel_screws_id = next(id_generator)
-		parallelized_screws_node = parallelize_op(nodes[support_bracket_id], screws, parallel_screws_id, contact_lists)
-		for screw in screws:
-			del nodes[screw.ID]
-		nodes[parallel_screws_id] = parallelized_screws_node
+		parallelize_op(nodes[support_bracket_id], screws, parallel_screws_id, contact_lists, nodes)
 
 	return nodes, root, contact_lists, part_counts
 
@@ -171,10 +166,7 @@ def test_graph1and2(id_generator, parallelize=False):
 		# parallelize the screwing
 		screws = [nodes[i] for i in range(1,4)]
 		parallel_screws_id = next(id_generator)
-		parallelized_screws_node = parallelize_op(root, screws, parallel_screws_id, contact_lists)
-		for screw in screws:
-			del nodes[screw.ID]
-		nodes[parallel_screws_id] = parallelized_screws_node
+		parallelize_op(root, screws, parallel_screws_id, contact_lists, nodes)
 
 	support_bracket_id = part_names[4]
 	nodes[support_bracket_id] = Node(support_bracket_id, [], [], False, "support bracket", True)
@@ -194,10 +186,7 @@ def test_graph1and2(id_generator, parallelize=False):
 		# parallelize the screwing 
 		screws = [nodes[i] for i in range(5,8)]
 		parallel_screws_id = next(id_generator)
-		parallelized_screws_node = parallelize_op(nodes[support_bracket_id], screws, parallel_screws_id, contact_lists)
-		for screw in screws:
-			del nodes[screw.ID]
-		nodes[parallel_screws_id] = parallelized_screws_node
+		parallelize_op(nodes[support_bracket_id], screws, parallel_screws_id, contact_lists, nodes)
 
 	return nodes, root, contact_lists, part_counts
 
@@ -236,10 +225,7 @@ def test_graph123(id_generator, parallelize=False):
 		# parallelize the screwing
 		screws = [nodes[i] for i in range(1,4)]
 		parallel_screws_id = next(id_generator)
-		parallelized_screws_node = parallelize_op(root, screws, parallel_screws_id, contact_lists)
-		for screw in screws:
-			del nodes[screw.ID]
-		nodes[parallel_screws_id] = parallelized_screws_node
+		parallelize_op(root, screws, parallel_screws_id, contact_lists, nodes)
 
 	# graph 2 - screws through support backet and spindle block
 	support_bracket_id1 = part_names[4]
@@ -259,10 +245,7 @@ def test_graph123(id_generator, parallelize=False):
 		# parallelize the screwing 
 		screws = [nodes[i] for i in range(5,8)]
 		parallel_screws_id = next(id_generator)
-		parallelized_screws_node = parallelize_op(nodes[support_bracket_id1], screws, parallel_screws_id, contact_lists)
-		for screw in screws:
-			del nodes[screw.ID]
-		nodes[parallel_screws_id] = parallelized_screws_node
+		parallelize_op(nodes[support_bracket_id1], screws, parallel_screws_id, contact_lists, nodes)
 
 	# graph 3 - other support bracket
 	support_bracket_id2 = part_names[8]
@@ -282,10 +265,7 @@ def test_graph123(id_generator, parallelize=False):
 		# parallelize the screwing 
 		screws = [nodes[i] for i in range(9,12)]
 		parallel_screws_id = next(id_generator)
-		parallelized_screws_node = parallelize_op(nodes[support_bracket_id2], screws, parallel_screws_id, contact_lists)
-		for screw in screws:
-			del nodes[screw.ID]
-		nodes[parallel_screws_id] = parallelized_screws_node
+		parallelize_op(nodes[support_bracket_id2], screws, parallel_screws_id, contact_lists, nodes)
 
 	return nodes, root, contact_lists, part_counts
 
@@ -328,10 +308,7 @@ def test_graph1234(id_generator, parallelize=False):
 		# parallelize the screwing
 		screws = [nodes[i] for i in range(1,4)]
 		parallel_screws_id = next(id_generator)
-		parallelized_screws_node = parallelize_op(root, screws, parallel_screws_id, contact_lists)
-		for screw in screws:
-			del nodes[screw.ID]
-		nodes[parallel_screws_id] = parallelized_screws_node
+		parallelize_op(root, screws, parallel_screws_id, contact_lists, nodes)
 
 	# graph 2 - screws through support backet and spindle block
 	support_bracket_id1 = part_names[4]
@@ -351,10 +328,7 @@ def test_graph1234(id_generator, parallelize=False):
 		# parallelize the screwing 
 		screws = [nodes[i] for i in range(5,8)]
 		parallel_screws_id = next(id_generator)
-		parallelized_screws_node = parallelize_op(nodes[support_bracket_id1], screws, parallel_screws_id, contact_lists)
-		for screw in screws:
-			del nodes[screw.ID]
-		nodes[parallel_screws_id] = parallelized_screws_node
+		parallelize_op(nodes[support_bracket_id1], screws, parallel_screws_id, contact_lists, nodes)
 
 	# graph 3 - other support bracket
 	support_bracket_id2 = part_names[8]
@@ -374,10 +348,7 @@ def test_graph1234(id_generator, parallelize=False):
 		# parallelize the screwing 
 		screws = [nodes[i] for i in range(9,12)]
 		parallel_screws_id = next(id_generator)
-		parallelized_screws_node = parallelize_op(nodes[support_bracket_id2], screws, parallel_screws_id, contact_lists)
-		for screw in screws:
-			del nodes[screw.ID]
-		nodes[parallel_screws_id] = parallelized_screws_node
+		parallelize_op(nodes[support_bracket_id2], screws, parallel_screws_id, contact_lists, nodes)
 
 
 	# graph 4 - backing plate
@@ -412,13 +383,9 @@ if __name__ == "__main__":
 	nodes, root, contact_lists, part_counts = test_graph0()
 	attached_part_counts = init_attached_part_counts(part_counts)
 
-	# check graph was built correctly 
-	for node_name, node in nodes.items():
-		for parent in node.parents:
-			assert node in parent.children, f"node {node_name} has parent {parent.ID} but {parent.ID} does not have {node_name} as child"
-	
-		for child in node.children:
-			assert node in child.parents, f"node {node_name} has child {child.ID} but {child.ID} does not have {node_name} as parent"
+	# check graph was built correctly, the contact lists of these hand
+	# made graphs go from the furthest part in so only the structure is checked
+	validation.check_graph(root, nodes)
 
 	program = build_program(root, nodes, contact_lists, part_counts)
 	program_str = get_program_str(program)
@@ -430,12 +397,7 @@ if __name__ == "__main__":
 	nodes, root, contact_lists, part_counts = test_graph1(id_generator, parallelize=False)
 	attached_part_counts = init_attached_part_counts(part_counts)
 
-	for node_name, node in nodes.items():
-		for parent in node.parents:
-			assert node in parent.children, f"node {node_name} has parent {parent.ID} but {parent.ID} does not have {node_name} as child"
-	
-		for child in node.children:
-			assert node in child.parents, f"node {node_name} has child {child.ID} but {child.ID} does not have {node_name} as parent"
+	validation.check_graph(root, nodes)
 
 	program = build_program(root, nodes, contact_lists, part_counts)
 	program_str = get_program_str(program)
@@ -455,12 +417,7 @@ if __name__ == "__main__":
 	nodes, root, contact_lists, part_counts = test_graph2(id_generator, parallelize=False)
 	attached_part_counts = init_attached_part_counts(part_counts)
 
-	for node_name, node in nodes.items():
-		for parent in node.parents:
-			assert node in parent.children, f"node {node_name} has parent {parent.ID} but {parent.ID} does not have {node_name} as child"
-	
-		for child in node.children:
-			assert node in child.parents, f"node {node_name} has child {child.ID} but {child.ID} does not have {node_name} as parent"
+	validation.check_graph(root, nodes)
 
 	program = build_program(root, nodes, contact_lists, part_counts)
 	program_str = get_program_str(program)
@@ -522,8 +479,6 @@ if __name__ == "__main__":
 
 	nodes, root, contact_lists, part_counts = test_graph1234(id_generator, parallelize=False)
 	parallelize_where_possible(root, contact_lists, nodes, id_generator)
-	id2node_map = {}
-	get_ID2node_map(root, id2node_map)
 
 	attached_part_counts = init_attached_part_counts(part_counts)
 
@@ -531,7 +486,7 @@ if __name__ == "__main__":
 	order = [root]
 	greedy_order(root, visited, order, fasteners_first)
 
-	program = build_program(root, id2node_map, contact_lists, part_counts, order)
+	program = build_program(root, nodes, contact_lists, part_counts, order)
 	program_str = get_program_str(program)
 	print(program_str)
 
@@ -0,0 +1,140 @@
+import copy
+import json
+import random
+
+from benchmarks import generate_assembly
+from grammar import *
+from incremental import IncrementalCompiler
+from json_to_graph import records2graph, parallelize_graph, build_greedy_program
+
+
+def compiled(records):
+	return get_program_str(build_greedy_program(*parallelize_graph(*records2graph(copy.deepcopy(records)))))
+
+
+def by_ID(records):
+	return {record["id"]: record for record in records}
+
+
+"""
+takes the parts with the given IDs out of records, along with every
+part below them
+"""
+def remove_parts(records, IDs):
+	record_of = by_ID(records)
+	removed = set()
+	stack = list(IDs)
+	while stack:
+		ID = stack.pop()
+		if not ID in removed:
+			removed.add(ID)
+			stack += record_of[ID]["children"]
+	for ID in removed:
+		for parent in record_of[ID]["parents"]:
+			if not parent in removed:
+				record_of[parent]["children"].remove(ID)
+	records[:] = [record for record in records if not record["id"] in removed]
+
+
+def add_part(records, name, is_fastener, parents):
+	ID = max([record["id"] for record in records]) + 1
+	record = {"id": ID, "name": f"{name}_{ID}", "parents": [parent["id"] for parent in parents], "children": [],
+			"part_type": None, "is_fastener": is_fastener, "fastened_parts": [parent["id"] for parent in parents] if is_fastener else None}
+	for parent in parents:
+		parent["children"].append(ID)
+	records.append(record)
+	return record
+
+
+"""
+makes a random edit to records: takes a screw or a part out, adds a
+screw or a bracket held by three screws, renames a part or reorders
+the children of a part
+"""
+def edit(records, rng):
+	record_of = by_ID(records)
+	parts = [record for record in records if not record["is_fastener"] and len(record["parents"]) != 0]
+	screws = [record for record in records if record["is_fastener"] and len(record["children"]) == 0]
+	kind = rng.choice(["remove screw", "remove part", "add screw", "add bracket", "rename", "reorder"])
+	if kind == "remove screw" and len(screws) != 0:
+		remove_parts(records, [rng.choice(screws)["id"]])
+	elif kind == "remove part":
+		remove_parts(records, [rng.choice(parts)["id"]])
+	elif kind == "add screw":
+		part = rng.choice(parts)
+		add_part(records, "91290A", True, [part] + [record_of[part["parents"][0]]] * rng.randint(0, 1))
+	elif kind == "add bracket":
+		part = rng.choice(parts)
+		bracket = add_part(records, "Bracket", False, [part])
+		for i in range(3):
+			add_part(records, "91290A", True, [bracket, part])
+	elif kind == "rename":
+		rng.choice(parts)["name"] = rng.choice(["Side Support", "Backing Plate", "Bracket"]) + "_0"
+	else:
+		rng.choice(parts)["children"].reverse()
+
+
+def test_renames():
+	with open("assembly_info.json", "r") as f:
+		records = json.load(f)
+	compiler = IncrementalCompiler()
+	compiler.update_records(copy.deepcopy(records))
+	assert compiler.update_records(copy.deepcopy(records)) == []
+	rng = random.Random(0)
+	for i in range(10):
+		rng.choice([record for record in records if not record["is_fastener"]])["name"] = rng.choice(["Side Support", "Foo"]) + "_9"
+		compiler.update_records(copy.deepcopy(records))
+		assert compiler.program_str() == compiled(records)
+	assert compiler.rebuilds == 1
+
+
+def test_structural_edits():
+	for seed in range(3):
+		for generator_args in [{}, {"multi_parent_fraction": 0.0}, {"multi_parent_fastener_fraction": 1.0},
+							{"repeat_fraction": 0.9, "num_part_types": 2}]:
+			rng = random.Random(seed)
+			records = generate_assembly(400, seed=seed, **generator_args)
+			compiler = IncrementalCompiler()
+			compiler.update_records(copy.deepcopy(records))
+			for i in range(20):
+				edit(records, rng)
+				compiler.update_records(copy.deepcopy(records))
+				assert compiler.program_str() == compiled(records), (seed, generator_args, i)
+			# edits inside regions don't compile the whole graph again
+			assert compiler.rebuilds < 15, (seed, generator_args, compiler.rebuilds)
+
+
+def test_removing_a_screw():
+	records = generate_assembly(2000, multi_parent_fraction=0.0, seed=1)
+	compiler = IncrementalCompiler()
+	compiler.update_records(copy.deepcopy(records))
+	screw = [record for record in records if record["is_fastener"] and len(record["parents"]) == 1][-1]
+	remove_parts(records, [screw["id"]])
+	emitted = compiler.update_records(copy.deepcopy(records))
+	assert compiler.rebuilds == 1
+	assert compiler.program_str() == compiled(records)
+	assert len(emitted) < len(compiler.program) // 2
+
+
+def test_failed_update():
+	records = generate_assembly(200, seed=2)
+	compiler = IncrementalCompiler()
+	compiler.update_records(copy.deepcopy(records))
+	broken = copy.deepcopy(records)
+	broken[5]["children"].append(max([record["id"] for record in records]) + 1)
+	try:
+		compiler.update_records(copy.deepcopy(broken))
+	except Exception:
+		pass
+	else:
+		assert False, "a reference to a missing part was compiled"
+	compiler.update_records(copy.deepcopy(records))
+	assert compiler.program_str() == compiled(records)
+
+
+if __name__ == "__main__":
+	test_renames()
+	test_structural_edits()
+	test_removing_a_screw()
+	test_failed_update()
+	print("incremental compiles ok")
@@ -0,0 +1,82 @@
+import os
+import signal
+import threading
+import time
+
+from benchmarks import generate_assembly
+from grammar import *
+from json_to_graph import records2graph, parallelize_graph
+from order_search import *
+
+
+COST_MODELS = [ToolChanges(), WorkpieceChanges(), CombinedCost([(1, ToolChanges()), (2, WorkpieceChanges())])]
+
+
+def generated_graph(size=1000):
+	return parallelize_graph(*records2graph(generate_assembly(size, seed=0, num_part_types=3)))
+
+
+def greedy(root):
+	order = [root]
+	greedy_order(root, [root.ID], order, fasteners_first)
+	return order
+
+
+"""
+asserts order is a valid traversal order of every node of greedy,
+each visited after all its parents
+"""
+def check_valid_order(order, greedy):
+	assert sorted([id(node) for node in order]) == sorted([id(node) for node in greedy])
+	visited = set()
+	for node in order:
+		for parent in node.parents:
+			assert id(parent) in visited
+		visited.add(id(node))
+		if isinstance(node, ParallelNode):
+			visited.update([id(member) for member in node.nodes])
+
+
+def test_never_worse_than_greedy():
+	root, id2node_map, contact_lists, part_counts = generated_graph()
+	seed = greedy(root)
+	for cost_model in COST_MODELS:
+		greedy_cost = order_cost(seed, contact_lists, cost_model)
+		for jobs in [1, 2]:
+			order, cost = search_order(root, contact_lists, cost_model, time_budget=0.5, jobs=jobs)
+			assert cost <= greedy_cost, (type(cost_model).__name__, jobs)
+			assert order_cost(order, contact_lists, cost_model) == cost
+			check_valid_order(order, seed)
+
+
+def test_returns_at_the_deadline():
+	root, id2node_map, contact_lists, part_counts = generated_graph()
+	for jobs in [1, 2]:
+		start = time.time()
+		order, cost = search_order(root, contact_lists, WorkpieceChanges(), time_budget=0.2, jobs=jobs)
+		# workers get a grace period of a second to send their orders back
+		assert time.time() - start < 1.5, jobs
+
+
+def test_interrupted_search_keeps_progress():
+	# large enough for the first pass of every strategy to be cut short
+	root, id2node_map, contact_lists, part_counts = generated_graph(10000)
+	cost_model = WorkpieceChanges()
+	greedy_cost = order_cost(greedy(root), contact_lists, cost_model)
+	for jobs in [1, 2]:
+		timer = threading.Timer(1.0, os.kill, [os.getpid(), signal.SIGINT])
+		start = time.time()
+		timer.start()
+		order, cost = search_order(root, contact_lists, cost_model, time_budget=60.0, jobs=jobs)
+		timer.join()
+		assert time.time() - start < 5.0, jobs
+		# the strategies had improved on the greedy order by then
+		assert cost < greedy_cost, jobs
+		assert order_cost(order, contact_lists, cost_model) == cost
+
+
+if __name__ == "__main__":
+	test_never_worse_than_greedy()
+	test_returns_at_the_deadline()
+	test_interrupted_search_keeps_progress()
+	print("order search ok")
@@ -0,0 +1,37 @@
+import instrumentation
+from benchmarks import generate_assembly, generate_repeated_assembly
+from grammar import *
+from json_to_graph import records2graph, parallelize_graph, build_greedy_program
+from partition import compile_partitioned
+
+
+def compiled(records):
+	return get_program_str(build_greedy_program(*parallelize_graph(*records2graph(records))))
+
+
+def compiled_partitioned(records, min_region_size):
+	return "".join(compile_partitioned(*parallelize_graph(*records2graph(records)), jobs=2, min_region_size=min_region_size)).strip()
+
+
+def test_generated_assemblies():
+	instrumentation.reset()
+	instrumentation.enable()
+	try:
+		for seed in range(3):
+			for generator_args in [{}, {"multi_parent_fraction": 0.0}, {"multi_parent_fastener_fraction": 1.0},
+								{"repeat_fraction": 0.9, "num_part_types": 2}]:
+				records = generate_assembly(2000, seed=seed, **generator_args)
+				for min_region_size in [2, 5]:
+					assert compiled_partitioned(records, min_region_size) == compiled(records), (seed, generator_args, min_region_size)
+			records = generate_repeated_assembly(2000, subassembly_size=30, seed=seed)
+			assert compiled_partitioned(records, 5) == compiled(records), seed
+		# the graphs were split, not just compiled sequentially
+		assert instrumentation.counters["partition.regions"] > 0
+	finally:
+		instrumentation.disable()
+		instrumentation.reset()
+
+
+if __name__ == "__main__":
+	test_generated_assemblies()
+	print("partition ok")
@@ -0,0 +1,75 @@
+import io
+import json
+
+import test_graphs
+from grammar import *
+from program_encoding import *
+
+
+"""
+the programs of the hand made graphs of test_graphs.py, with and
+without parallelization
+"""
+def fixture_programs():
+	programs = []
+	nodes, root, contact_lists, part_counts = test_graphs.test_graph0()
+	programs += [("graph0", build_program(root, nodes, contact_lists, part_counts))]
+	for name in ["test_graph1", "test_graph2", "test_graph1and2", "test_graph123", "test_graph1234"]:
+		for parallelize in [False, True]:
+			nodes, root, contact_lists, part_counts = getattr(test_graphs, name)(IDGen(0), parallelize=parallelize)
+			order = [root]
+			greedy_order(root, [root.ID], order, fasteners_first)
+			programs += [(f"{name} parallelize={parallelize}", build_program(root, nodes, contact_lists, part_counts, order))]
+	return programs
+
+
+def check_same_program(name, decoded, program):
+	assert get_program_str(decoded) == get_program_str(program), name
+	assert len(decoded) == len(program), name
+	for decoded_statement, statement in zip(decoded, program):
+		assert type(decoded_statement) is type(statement), name
+		decoded_primary, decoded_others = statement_parts(decoded_statement)
+		primary, others = statement_parts(statement)
+		assert [part.ID for part in decoded_primary] == [part.ID for part in primary], name
+		assert [part.ID for part in decoded_others] == [part.ID for part in others], name
+
+
+def test_binary_round_trip():
+	for name, program in fixture_programs():
+		check_same_program(name, decode_program(encode_program(program)), program)
+
+
+def test_json_round_trip():
+	for name, program in fixture_programs():
+		f = io.StringIO()
+		assert write_program_json(program, f) == len(program), name
+		check_same_program(name, read_program_json(io.StringIO(f.getvalue())), program)
+
+
+def test_only_used_part_types_are_stored():
+	part_types.code("a type no program uses")
+	for name, program in fixture_programs():
+		used = set([part.part_type for statement in program for parts in statement_parts(statement) for part in parts])
+		buf = encode_program(program)
+		magic, version, meta_len = HEADER.unpack_from(buf, 0)
+		assert sorted(json.loads(buf[HEADER.size:HEADER.size + meta_len])["part_types"]) == sorted(used), name
+		lines = list(iter_program_json(program))
+		assert sorted([name for line in lines[1:] for name in json.loads(line).get("types", [])]) == sorted(used), name
+
+
+def test_unencodable_IDs():
+	part = Node(("a", 0), [], [], False, "block", True)
+	try:
+		encode_program([PlacementOp(part, [])])
+	except Exception as e:
+		assert "node IDs" in str(e)
+	else:
+		assert False, "tuple IDs were encoded"
+
+
+if __name__ == "__main__":
+	test_binary_round_trip()
+	test_json_round_trip()
+	test_only_used_part_types_are_stored()
+	test_unencodable_IDs()
+	print("program encoding round trips ok")
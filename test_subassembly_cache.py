@@ -0,0 +1,77 @@
+import test_graphs
+from benchmarks import generate_assembly, generate_repeated_assembly
+from grammar import *
+from json_to_graph import json2graph, records2graph, parallelize_graph, build_greedy_program
+from subassembly_cache import *
+
+
+def compiled(graph):
+	return get_program_str(build_greedy_program(*parallelize_graph(*graph)))
+
+
+def compiled_with_cache(graph, cache):
+	return "".join(compile_with_cache(*graph, cache)).strip()
+
+
+def test_assembly_info():
+	cache = SubassemblyCache()
+	program = compiled(json2graph("assembly_info.json"))
+	assert compiled_with_cache(json2graph("assembly_info.json"), cache) == program
+	assert compiled_with_cache(json2graph("assembly_info.json"), cache) == program
+	assert cache.hits == cache.misses
+
+
+def test_fixture_graph():
+	# the support brackets share the backing plate, neither is a region
+	nodes, root, contact_lists, part_counts = test_graphs.test_graph1234(IDGen(0), parallelize=False)
+	parallelize_where_possible(root, contact_lists, nodes, IDGen(len(nodes)))
+	program = get_program_str(build_greedy_program(root, nodes, contact_lists, part_counts))
+	nodes, root, contact_lists, part_counts = test_graphs.test_graph1234(IDGen(0), parallelize=False)
+	cache = SubassemblyCache()
+	assert compiled_with_cache((root, nodes, contact_lists, part_counts), cache) == program
+	assert cache.hits + cache.misses == 0
+
+
+def test_repeated_subassemblies():
+	cache = SubassemblyCache()
+	for seed in range(4):
+		records = generate_repeated_assembly(2000, subassembly_size=30, seed=seed)
+		assert compiled_with_cache(records2graph(records), cache) == compiled(records2graph(records))
+	# every copy after the first of each subassembly comes from the cache
+	assert len(cache.entries) == 4
+	assert cache.hits > 200
+
+
+def test_generated_assemblies():
+	cache = SubassemblyCache()
+	small_cache = SubassemblyCache(max_size=8)
+	for seed in range(4):
+		for generator_args in [{}, {"multi_parent_fraction": 0.0}, {"multi_parent_fastener_fraction": 1.0},
+							{"repeat_fraction": 0.9, "num_part_types": 2}]:
+			records = generate_assembly(2000, seed=seed, **generator_args)
+			program = compiled(records2graph(records))
+			assert compiled_with_cache(records2graph(records), cache) == program
+			assert compiled_with_cache(records2graph(records), small_cache) == program
+	assert cache.hits > 0
+
+
+def test_entries_are_bounded():
+	cache = SubassemblyCache(max_entries=2)
+	for seed in range(4):
+		records = generate_repeated_assembly(500, subassembly_size=30, seed=seed)
+		assert compiled_with_cache(records2graph(records), cache) == compiled(records2graph(records))
+		assert len(cache.entries) <= 2
+	# the last assembly's subassembly is the most recently used
+	records = generate_repeated_assembly(500, subassembly_size=30, seed=3)
+	hits = cache.hits
+	compiled_with_cache(records2graph(records), cache)
+	assert cache.hits > hits
+
+
+if __name__ == "__main__":
+	test_assembly_info()
+	test_fixture_graph()
+	test_repeated_subassemblies()
+	test_generated_assemblies()
+	test_entries_are_bounded()
+	print("subassembly cache ok")
@@ -0,0 +1,227 @@
+"""
+structural validation of disassembly graphs
+
+validate_graph checks a whole graph in one pass over its nodes and
+edges, using sets instead of list membership:
+- symmetry: every child edge has a matching parent edge and vice versa
+- contact lists: no part in a fastener's contact list is a child of a
+	part listed before it (contact lists go from closest to furthest part),
+	checked against a set of the parts listed before it
+- a single root: the root is the only node without parents
+- acyclicity
+- parallel groups: the members of every parallel node share their
+	parents, part type and contact list
+It returns every violation found rather than stopping at the first.
+
+The module level mode decides what the compiler does with violations:
+STRICT   raise a ValidationError as soon as a check fails (the default)
+DEFERRED keep going and collect the violations in deferred_violations,
+	to be taken with take_deferred() or raised with raise_deferred()
+	once the compile is done
+OFF      skip the checks altogether
+The command line tools choose it with --validation, see add_mode_argument.
+"""
+
+STRICT = "strict"
+DEFERRED = "deferred"
+OFF = "off"
+MODES = [STRICT, DEFERRED, OFF]
+
+mode = STRICT
+deferred_violations = []
+
+
+def format_violations(violations):
+	return f"{len(violations)} graph violation(s):\n" + "\n".join(violations)
+
+
+class ValidationError(AssertionError):
+	def __init__(self, violations):
+		self.violations = list(violations)
+		super().__init__(format_violations(self.violations))
+
+
+def set_mode(new_mode):
+	global mode
+	if not new_mode in MODES:
+		raise Exception(f"unknown validation mode {new_mode!r}")
+	mode = new_mode
+
+
+"""
+adds the --validation option choosing the mode to an argparse parser
+"""
+def add_mode_argument(parser):
+	parser.add_argument("--validation", choices=MODES, default=STRICT,
+						help="strict stops at the first violation, deferred compiles anyway and reports them, off skips the checks")
+
+
+"""
+handles violations according to the current mode
+"""
+def report(violations):
+	if len(violations) == 0:
+		return
+	if mode == STRICT:
+		raise ValidationError(violations)
+	if mode == DEFERRED:
+		deferred_violations.extend(violations)
+
+
+"""
+returns the violations collected in deferred mode so far, clearing
+them. Called once per compile so they don't pile up from one compile
+to the next in a long running process.
+"""
+def take_deferred():
+	violations = list(deferred_violations)
+	deferred_violations.clear()
+	return violations
+
+
+"""
+raises one ValidationError for every violation collected in
+deferred mode so far, clearing them
+"""
+def raise_deferred():
+	violations = take_deferred()
+	if len(violations) != 0:
+		raise ValidationError(violations)
+
+
+"""
+validates the graph and reports the violations according to the mode
+"""
+def check_graph(root, id2node_map, contact_lists=None):
+	if mode != OFF:
+		report(validate_graph(root, id2node_map, contact_lists))
+
+
+"""
+checks that nodes can be merged into one parallel node:
+same parents, same part type and, for fasteners with a contact
+list, the same contact list
+returns the list of violations
+"""
+def check_parallel_group(nodes, contact_lists=None):
+	violations = []
+	first = nodes[0]
+	parent_IDs = [parent.ID for parent in first.parents]
+	contact_IDs = None
+	if contact_lists is not None and first.ID in contact_lists:
+		contact_IDs = [part.ID for part in contact_lists[first.ID]]
+	for node in nodes[1:]:
+		if [parent.ID for parent in node.parents] != parent_IDs:
+			violations += [f"parallel group member {node.ID} has parents {[parent.ID for parent in node.parents]} but {first.ID} has {parent_IDs}"]
+		if node.part_type_code != first.part_type_code:
+			violations += [f"parallel group member {node.ID} is a {node.part_type} but {first.ID} is a {first.part_type}"]
+		if contact_IDs is not None:
+			node_contact_IDs = [part.ID for part in contact_lists[node.ID]] if node.ID in contact_lists else None
+			if node_contact_IDs != contact_IDs:
+				violations += [f"parallel group member {node.ID} has contact list {node_contact_IDs} but {first.ID} has {contact_IDs}"]
+	return violations
+
+
+"""
+runs every check on the graph in O(V+E) and returns the
+list of violations, empty if the graph is well formed.
+The nodes checked are everything reachable from the root,
+id2node_map and contact_lists through children, parents and
+parallel node members. Without contact_lists only the structure
+of the graph is checked.
+"""
+def validate_graph(root, id2node_map, contact_lists=None):
+	from grammar import ParallelNode
+
+	if contact_lists is None:
+		contact_lists = {}
+
+	violations = []
+
+	nodes = {} # id(node) -> node, in the order found
+	stack = [root] + list(id2node_map.values()) + [part for contact_list in contact_lists.values() for part in contact_list]
+	while stack:
+		node = stack.pop()
+		if id(node) in nodes:
+			continue
+		nodes[id(node)] = node
+		stack += node.children
+		stack += node.parents
+		if isinstance(node, ParallelNode):
+			stack += node.nodes
+
+	# members of a parallel node stand in for it: they keep the edges
+	# to their children and parents, which only list the parallel node
+	group_of = {}
+	for node in nodes.values():
+		if isinstance(node, ParallelNode):
+			for member in node.nodes:
+				group_of[id(member)] = id(node)
+			violations += check_parallel_group(node.nodes, contact_lists)
+			if len(node.nodes) != 0 and [parent.ID for parent in node.parents] != [parent.ID for parent in node.nodes[0].parents]:
+				violations += [f"parallel node {node.ID} has different parents than its members"]
+
+	canonical = {key: key for key in nodes}
+	for key in group_of:
+		group = group_of[key]
+		while group in group_of:
+			group = group_of[group]
+		canonical[key] = group
+
+	# symmetry
+	child_edges = {(canonical[key], canonical[id(child)]) for key, node in nodes.items() for child in node.children}
+	parent_edges = {(canonical[id(parent)], canonical[key]) for key, node in nodes.items() for parent in node.parents}
+	for parent, child in child_edges - parent_edges:
+		violations += [f"node {nodes[parent].ID} has child {nodes[child].ID} but {nodes[child].ID} does not have {nodes[parent].ID} as parent"]
+	for parent, child in parent_edges - child_edges:
+		violations += [f"node {nodes[child].ID} has parent {nodes[parent].ID} but {nodes[parent].ID} does not have {nodes[child].ID} as child"]
+
+	# contact list ordering, every part against the parts listed before it
+	parents_of = {} # key -> keys of its parents, in a dict to keep them in order without repeats
+	for key, node in nodes.items():
+		for child in node.children:
+			child_key = canonical[id(child)]
+			if child_key in parents_of:
+				parents_of[child_key][canonical[key]] = True
+			else:
+				parents_of[child_key] = {canonical[key]: True}
+	for fastener_ID, contact_list in contact_lists.items():
+		listed = {} # key -> first part listed with it
+		for part in contact_list:
+			key = canonical[id(part)]
+			for parent in parents_of.get(key, {}):
+				if parent in listed:
+					violations += [f"contact list of {fastener_ID} lists {part.ID} after its parent {listed[parent].ID}"]
+			if not key in listed:
+				listed[key] = part
+
+	# single root
+	if len(root.parents) != 0:
+		violations += [f"root {root.ID} has parents {[parent.ID for parent in root.parents]}"]
+	other_roots = [node.ID for key, node in nodes.items() if len(node.parents) == 0 and node is not root and not key in group_of]
+	if len(other_roots) != 0:
+		violations += [f"nodes {other_roots} have no parents but are not the root {root.ID}"]
+
+	# acyclicity, an iterative depth first search
+	UNVISITED, ACTIVE, DONE = 0, 1, 2
+	state = {}
+	for start in nodes.values():
+		if state.get(id(start), UNVISITED) != UNVISITED:
+			continue
+		state[id(start)] = ACTIVE
+		stack = [(start, iter(start.children))]
+		while stack:
+			node, children = stack[-1]
+			for child in children:
+				child_state = state.get(id(child), UNVISITED)
+				if child_state == UNVISITED:
+					state[id(child)] = ACTIVE
+					stack.append((child, iter(child.children)))
+					break
+				if child_state == ACTIVE:
+					violations += [f"cycle through {node.ID} -> {child.ID}"]
+			else:
+				state[id(node)] = DONE
+				stack.pop()
+
+	return violations